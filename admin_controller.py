@@ -0,0 +1,93 @@
+import hmac
+import os
+
+from flask import request, jsonify
+from flask_restx import Namespace, Resource
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+
+import diagnosis_helper as dh
+import profiling
+
+api = Namespace('admin', description='Administrative operations')
+
+# The token which must be sent in the X-Admin-Token header to use the admin endpoints. When it is not set the admin
+# endpoints are disabled.
+ADMIN_TOKEN = os.environ.get('DIAGNOSIS_ADMIN_TOKEN')
+
+
+def require_admin_token():
+    """
+    This function is used to guard the admin endpoints, raising an exception unless the request carries the admin
+    token.
+    """
+    if not ADMIN_TOKEN:
+        raise NotFound('The admin endpoints are disabled.')
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        raise Forbidden('Invalid admin token.')
+
+
+@api.hide
+@api.route('/reload')
+@api.doc(responses={200: 'OK', 403: 'Forbidden', 404: 'Not Found', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint loads the model data again and swaps it in for new '
+                     'requests. Requests which are already being handled finish on the data they started with. It '
+                     'returns the dataset version in use after the reload.</p> \n \n<p>The other workers of a '
+                     'pre-fork server reload at the start of their next request, within DIAGNOSIS_SYNC_INTERVAL '
+                     'seconds. "workers_notified" is false if the trigger file could not be written, in which case '
+                     'only the worker which handled the request has reloaded.</p>')
+class ReloadModels(Resource):
+    """
+    This class is used to create the reload endpoint, which reloads the model data without restarting the server.
+    """
+
+    @staticmethod
+    def post():
+        require_admin_token()
+        previous = dh.current_snapshot().version
+        snapshot, notified = dh.trigger_reload()
+        return jsonify({'dataset_version': snapshot.version, 'previous_dataset_version': previous,
+                        'workers_notified': notified})
+
+
+@api.hide
+@api.route('/profiling')
+@api.doc(responses={200: 'OK', 400: 'Invalid Argument', 403: 'Forbidden', 404: 'Not Found',
+                    500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint shows and changes the profiling settings. A PUT request '
+                     'takes a JSON object with any of <code>enabled</code>, <code>sample_rate</code> and '
+                     '<code>max_files</code>. While profiling is enabled, diagnosis requests which send the profiling '
+                     'token in the <code>X-Profile</code> header, and a <code>sample_rate</code> fraction of the '
+                     'others, are profiled.</p> \n \n<p>A change is shared with the other workers of a pre-fork '
+                     'server through the profile directory, and "workers_notified" is false if it could not be '
+                     'written there, in which case only the worker which handled the request has changed.</p>')
+class Profiling(Resource):
+    """
+    This class is used to create the profiling endpoint, which switches request profiling on and off at runtime.
+    """
+
+    @staticmethod
+    def get():
+        require_admin_token()
+        profiling.sync()
+        return jsonify(profiling.settings.as_dict())
+
+    @staticmethod
+    def put():
+        require_admin_token()
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            raise BadRequest('The request body must be a JSON object.')
+        enabled = changes.get('enabled')
+        sample_rate = changes.get('sample_rate')
+        max_files = changes.get('max_files')
+        if enabled is not None and not isinstance(enabled, bool):
+            raise BadRequest("'enabled' must be true or false.")
+        if sample_rate is not None and (isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float))):
+            raise BadRequest("'sample_rate' must be a number.")
+        if max_files is not None and (isinstance(max_files, bool) or not isinstance(max_files, int)):
+            raise BadRequest("'max_files' must be an integer.")
+        try:
+            settings = profiling.configure(enabled=enabled, sample_rate=sample_rate, max_files=max_files)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        return jsonify(dict(settings.as_dict(), workers_notified=profiling.publish()))
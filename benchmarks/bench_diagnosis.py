@@ -0,0 +1,214 @@
+"""
+Benchmarks for the diagnosis hot path, over synthetic animals from 10 diseases x 15 signs up to 2,000 x 5,000.
+
+Each benchmark reports its throughput, latency percentiles and peak traced memory as one JSON object, and the whole
+run is written as a JSON document which can be compared with the output of another commit:
+
+    python benchmarks/bench_diagnosis.py --output before.json
+    python benchmarks/bench_diagnosis.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from synthetic import DEFAULT_SIZES, ROOT, animal_name, install_synthetic_animals, make_shown_signs, make_table, \
+    parse_sizes
+
+import diagnosis_helper as dh  # noqa: E402
+import matrix_cache as mc  # noqa: E402
+import result_cache as rc  # noqa: E402
+from diagnosis_controller import _diagnosis_schema as diagnosis_schema  # noqa: E402
+from diagnosis_controller import diagnosis_payload_model  # noqa: E402
+from flask_app import app  # noqa: E402
+
+
+def measure(name, size, func, time_budget, min_iterations):
+    """
+    Call func repeatedly until the time budget is spent, then once more under tracemalloc
+    :param name: The name of the benchmark
+    :param size: The (diseases, signs) size being benchmarked
+    :param func: A function with no arguments which performs one operation
+    :param time_budget: The number of seconds to spend calling func
+    :param min_iterations: The minimum number of calls, even if they exceed the time budget
+    :return: A dictionary of the results
+    """
+    func()  # warm up
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_iterations or time.perf_counter() - start < time_budget:
+        call_start = time.perf_counter_ns()
+        func()
+        latencies.append(time.perf_counter_ns() - call_start)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) / 1e6
+    return {'benchmark': name, 'diseases': size[0], 'signs': size[1], 'iterations': len(latencies),
+            'throughput_per_s': len(latencies) / elapsed,
+            'p50_ms': float(np.percentile(latencies_ms, 50)), 'p95_ms': float(np.percentile(latencies_ms, 95)),
+            'p99_ms': float(np.percentile(latencies_ms, 99)), 'peak_memory_bytes': peak}
+
+
+def benchmarks_for_size(size, max_custom_cells):
+    """
+    :param size: The (diseases, signs) size of the synthetic animal
+    :param max_custom_cells: The largest matrix to send to /diagnosis/custom_diagnose
+    :return: A list of (name, func) pairs, where func is None for a benchmark which is skipped at this size
+    """
+    n_diseases, n_signs = size
+    animal = animal_name(n_diseases, n_signs)
+    diseases, signs, likelihoods = make_table(n_diseases, n_signs)
+    shown_signs = make_shown_signs(signs)
+    priors = dh.get_default_priors(diseases)
+    # Priors which pass validation exactly, as equal shares of 100 may not add up to exactly 100
+    exact_priors = dict.fromkeys(diseases, 0)
+    exact_priors[diseases[0]] = 100
+    matrix = dh.LikelihoodMatrix(diseases, signs, likelihoods)
+    # calculate_results underflows to 0 for long sign vectors, which normalise cannot divide by
+    results = dh.calculate_posteriors(matrix, shown_signs, priors)
+    scores = matrix.scores(shown_signs, priors)
+    client = app.test_client()
+
+    diagnose_body = json.dumps({'animal': animal, 'signs': shown_signs})
+    custom_body = None
+    if n_diseases * n_signs <= max_custom_cells:
+        custom_body = json.dumps({'diseases': diseases, 'signs': signs, 'shown_signs': shown_signs,
+                                  'likelihoods': likelihoods})
+
+    def post(path, body):
+        def call():
+            response = client.post(path, data=body, content_type='application/json')
+            assert response.status_code == 200, response.get_data(as_text=True)
+        return call
+
+    def uncached(func):
+        # Disable the custom matrix cache so every request validates and compiles the matrix
+        def call():
+            cache, mc.custom_matrices = mc.custom_matrices, mc.MatrixCache(0, 0)
+            try:
+                func()
+            finally:
+                mc.custom_matrices = cache
+        return call
+
+    def without_result_cache(func):
+        # Disable the result cache so every request is calculated and serialised
+        def call():
+            cache, rc.results = rc.results, rc.ResultCache(0)
+            try:
+                func()
+            finally:
+                rc.results = cache
+        return call
+
+    diagnose_payload = {'animal': animal, 'signs': shown_signs, 'priors': exact_priors, 'likelihoods': likelihoods}
+    validator = dh.get_model(animal).validator
+
+    def validate_with_jsonschema():
+        # What validate=True and the validate_* functions did before the payload was validated by CompiledSchema
+        diagnosis_payload_model.validate(diagnose_payload)
+        checked = dh.validate_likelihoods(likelihoods, diseases, signs)
+        dh.LikelihoodMatrix(diseases, signs, checked)
+        dh.validate_shown_signs(shown_signs, validator.sign_set, animal)
+        dh.validate_priors(exact_priors, diseases)
+
+    def validate_compiled():
+        diagnosis_schema.validate(diagnose_payload)
+        validator.likelihoods(likelihoods)
+        validator.shown_signs(shown_signs)
+        validator.priors(exact_priors)
+
+    return [
+        ('validate_payload_jsonschema', validate_with_jsonschema),
+        ('validate_payload_compiled', validate_compiled),
+        ('calculate_results', lambda: dh.calculate_results(diseases, likelihoods, shown_signs, priors)),
+        ('normalise', lambda: dh.normalise(results)),
+        ('calculate_posteriors', lambda: dh.calculate_posteriors(matrix, shown_signs, priors)),
+        ('validate_priors', lambda: dh.validate_priors(exact_priors, diseases)),
+        ('validate_likelihoods', lambda: dh.validate_likelihoods(likelihoods, diseases, signs)),
+        ('information_gain', lambda: dh.information_gain(matrix, scores)),
+        ('route_diagnose', post('/diagnosis/diagnose/', diagnose_body)),
+        ('route_diagnose_uncached', without_result_cache(post('/diagnosis/diagnose/', diagnose_body))),
+        ('route_next_sign', post('/diagnosis/next_sign', json.dumps({'animal': animal}))),
+        ('route_custom_diagnose', custom_body and post('/diagnosis/custom_diagnose', custom_body)),
+        ('route_custom_diagnose_uncached',
+         custom_body and uncached(post('/diagnosis/custom_diagnose', custom_body))),
+    ]
+
+
+def compare(results, baseline_path):
+    """
+    Print the change in throughput and p50 latency of each benchmark against a previous run
+    """
+    with open(baseline_path) as f:
+        baseline = {(r['benchmark'], r['diseases'], r['signs']): r for r in json.load(f)['results']}
+    print(f"{'benchmark':<32}{'size':>12}{'throughput':>14}{'p50':>10}", file=sys.stderr)
+    for result in results:
+        before = baseline.get((result['benchmark'], result['diseases'], result['signs']))
+        if before is None or 'skipped' in result or 'skipped' in before:
+            continue
+        print(f"{result['benchmark']:<32}{result['diseases']:>6}x{result['signs']:<5}"
+              f"{result['throughput_per_s'] / before['throughput_per_s']:>13.2f}x"
+              f"{result['p50_ms'] / before['p50_ms']:>9.2f}x", file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=parse_sizes, default=DEFAULT_SIZES,
+                        help='Comma separated DISEASESxSIGNS sizes (default: 10x15,100x200,500x1000,2000x5000)')
+    parser.add_argument('--time-budget', type=float, default=1.0,
+                        help='Seconds to spend on each benchmark (default: 1.0)')
+    parser.add_argument('--min-iterations', type=int, default=3,
+                        help='Minimum calls per benchmark (default: 3)')
+    parser.add_argument('--max-custom-cells', type=int, default=1_000_000,
+                        help='Largest matrix sent to /diagnosis/custom_diagnose (default: 1000000)')
+    parser.add_argument('--only', help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--output', help='Write the results to this file rather than stdout')
+    parser.add_argument('--compare', help='A previous output file to compare the results with')
+    args = parser.parse_args()
+
+    install_synthetic_animals(args.sizes)
+    results = []
+    for size in args.sizes:
+        for name, func in benchmarks_for_size(size, args.max_custom_cells):
+            if args.only and args.only not in name:
+                continue
+            if func is None:
+                result = {'benchmark': name, 'diseases': size[0], 'signs': size[1], 'skipped': 'too large'}
+            else:
+                result = measure(name, size, func, args.time_budget, args.min_iterations)
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'engine': dh.DEFAULT_ENGINE, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
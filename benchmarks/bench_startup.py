@@ -0,0 +1,132 @@
+"""
+Benchmarks the cold start of the API: the time a fresh interpreter takes to import the app factory, create the app
+and answer its first diagnosis, with the model data preloaded and loaded lazily.
+
+Each measurement runs in a new process, so nothing is cached between runs apart from the operating system's page
+cache. The median of each phase is written as a JSON document which can be compared with the output of another
+commit, and --max-ms makes the run fail when a cold start regresses past a limit:
+
+    python benchmarks/bench_startup.py --output before.json
+    python benchmarks/bench_startup.py --output after.json --compare before.json --max-ms 1000
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from synthetic import ROOT
+
+# Run in a fresh interpreter for each measurement. Prints the seconds spent in each phase as JSON.
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from flask_app import create_app
+imported = time.perf_counter()
+app = create_app(preload={preload})
+created = time.perf_counter()
+import diagnosis_helper as dh
+animal = dh.get_animals()[0]
+response = app.test_client().post('/diagnosis/diagnose/', json={{'animal': animal,
+                                                                 'signs': dict.fromkeys(dh.get_signs(animal), 0)}})
+assert response.status_code == 200, response.get_data(as_text=True)
+answered = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'create_app': created - imported, 'first_request': answered - created}}))
+'''
+
+MODES = {'preload': True, 'lazy': False}
+
+
+def run_once(preload):
+    """
+    Start a new interpreter which creates the app and answers one request
+    :param preload: Whether create_app preloads the model data
+    :return: A dictionary of the milliseconds spent in each phase, and in the whole process
+    """
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD.format(preload=preload)], cwd=ROOT, capture_output=True,
+                            text=True, check=True, env=dict(os.environ, DIAGNOSIS_DATA_PATH=ROOT)).stdout
+    phases = {phase: seconds * 1000 for phase, seconds in json.loads(output.splitlines()[-1]).items()}
+    phases['process'] = (time.perf_counter() - started) * 1000
+    return phases
+
+
+def slowest_imports(count):
+    """
+    :param count: The number of modules to return
+    :return: The modules with the largest cumulative import time in milliseconds, from python -X importtime
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import flask_app'], cwd=ROOT,
+                            capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match and len(match.group(2)) <= 3:
+            imports.append((int(match.group(1)) / 1000, match.group(3).strip()))
+    return [{'module': module, 'cumulative_ms': ms} for ms, module in sorted(imports, reverse=True)[:count]]
+
+
+def compare(results, baseline_path):
+    """
+    Print the change in the median of each phase against a previous run
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"{'mode':<10}{'phase':<16}{'change':>10}", file=sys.stderr)
+    for mode, phases in results.items():
+        for phase, result in phases.items():
+            before = baseline.get(mode, {}).get(phase)
+            if before:
+                print(f"{mode:<10}{phase:<16}{result['median_ms'] / before['median_ms']:>9.2f}x", file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Fresh processes to start for each mode (default: 10)')
+    parser.add_argument('--max-ms', type=float,
+                        help='Exit with an error if the median of import, create_app and the first request exceeds '
+                             'this many milliseconds in any mode')
+    parser.add_argument('--output', help='Write the results to this file rather than stdout')
+    parser.add_argument('--compare', help='A previous output file to compare the results with')
+    args = parser.parse_args()
+
+    run_once(True)  # warm the page cache and the bytecode cache
+    results = {}
+    for mode, preload in MODES.items():
+        runs = [run_once(preload) for _ in range(args.runs)]
+        results[mode] = {phase: {'median_ms': statistics.median(run[phase] for run in runs),
+                                 'min_ms': min(run[phase] for run in runs)} for phase in runs[0]}
+        print(json.dumps({mode: results[mode]}), file=sys.stderr)
+
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'runs': args.runs, 'results': results,
+              'slowest_imports': slowest_imports(10)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.max_ms is not None:
+        for mode, phases in results.items():
+            total = sum(phases[phase]['median_ms'] for phase in ('import', 'create_app', 'first_request'))
+            if total > args.max_ms:
+                sys.exit(f'The cold start in {mode} mode took {total:.0f} ms, more than --max-ms {args.max_ms:.0f}')
+
+
+if __name__ == '__main__':
+    main()
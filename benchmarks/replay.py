@@ -0,0 +1,148 @@
+"""
+Replays requests captured by traffic_capture.py against a running server at a target rate and concurrency, and
+reports the p50/p95/p99 latency, error rate and achieved throughput of each endpoint as JSON.
+
+    DIAGNOSIS_CAPTURE_FILE=capture.ndjson python flask_app.py
+    python benchmarks/replay.py capture.ndjson --url http://127.0.0.1:5000 --qps 200 --concurrency 16
+
+Requests are issued open-loop: each is scheduled at a fixed interval from the start, and its latency is measured from
+that scheduled time, so queueing caused by a slow server is included rather than hidden. A request is an error if it
+fails to connect or returns a 5xx status. Requests whose body was not captured, such as NDJSON batches, are skipped
+rather than sent without one, and the number skipped is reported.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traffic_capture import read_capture  # noqa: E402
+
+_STOP = object()
+
+
+def endpoint_of(path):
+    """
+    Group a request path by the endpoint it is routed to, replacing the animal parameter of the data endpoints
+    :param path: The captured path, which may include a query string
+    :return: The endpoint, such as /data/matrix/<animal>
+    """
+    path = urllib.parse.urlsplit(path).path
+    return re.sub(r'^(/data/[^/]+)/[^/]+$', r'\1/<animal>', path)
+
+
+def worker(url, jobs, results):
+    """
+    Issue requests from the jobs queue over one persistent connection until _STOP is received
+    """
+    parts = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = None
+    while True:
+        job = jobs.get()
+        if job is _STOP:
+            break
+        scheduled, record = job
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        status = None
+        try:
+            if connection is None:
+                connection = connection_class(parts.netloc, timeout=30)
+            headers = {'Content-Type': record['content_type']} if record.get('content_type') else {}
+            connection.request(record['method'], parts.path.rstrip('/') + record['path'], body=record['body'] or None,
+                               headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection = None
+        results.append((endpoint_of(record['path']), time.perf_counter() - scheduled, status))
+
+
+def summarise(results, elapsed):
+    """
+    :param results: A list of (endpoint, latency in seconds, status) tuples, where status is None if the request failed
+    :param elapsed: The duration of the replay in seconds
+    :return: A dictionary of statistics for each endpoint and for all requests
+    """
+    groups = {'all': results}
+    for result in results:
+        groups.setdefault(result[0], []).append(result)
+
+    summary = {}
+    for endpoint, group in sorted(groups.items()):
+        latencies_ms = np.array([latency for _, latency, _ in group]) * 1000
+        errors = sum(1 for _, _, status in group if status is None or status >= 500)
+        summary[endpoint] = {'requests': len(group), 'errors': errors, 'error_rate': errors / len(group),
+                             'throughput_per_s': len(group) / elapsed,
+                             'p50_ms': float(np.percentile(latencies_ms, 50)),
+                             'p95_ms': float(np.percentile(latencies_ms, 95)),
+                             'p99_ms': float(np.percentile(latencies_ms, 99))}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='A capture file written by traffic_capture.py')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='The server to replay against')
+    parser.add_argument('--qps', type=float, default=0,
+                        help='The target requests per second, or 0 to send as fast as possible (default: 0)')
+    parser.add_argument('--concurrency', type=int, default=8, help='The number of connections (default: 8)')
+    parser.add_argument('--requests', type=int,
+                        help='The number of requests to send, looping over the capture if needed (default: one pass)')
+    parser.add_argument('--output', help='Write the report to this file rather than stdout')
+    args = parser.parse_args()
+
+    records = []
+    skipped = 0
+    for record in read_capture(args.capture):
+        if record.get('body_omitted'):
+            skipped += 1
+        else:
+            records.append(record)
+    if not records:
+        parser.error(f'{args.capture} does not contain any requests which can be replayed')
+    total = args.requests or len(records)
+
+    jobs = queue.Queue(maxsize=args.concurrency * 4)
+    results = []
+    threads = [threading.Thread(target=worker, args=(args.url, jobs, results), daemon=True)
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    interval = 1 / args.qps if args.qps > 0 else 0
+    for i, record in enumerate(itertools.islice(itertools.cycle(records), total)):
+        jobs.put((start + i * interval, record))
+    for _ in threads:
+        jobs.put(_STOP)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = {'url': args.url, 'target_qps': args.qps, 'concurrency': args.concurrency,
+              'achieved_qps': len(results) / elapsed, 'duration_s': elapsed, 'skipped_body_omitted': skipped,
+              'endpoints': summarise(results, elapsed)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Synthetic animals and payloads for the benchmarks, so performance can be measured at sizes far beyond the real data.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if sys.path[0] != ROOT:
+    # diagnosis_helper loads the real data from sys.path[0] when it is imported
+    sys.path.insert(0, ROOT)
+
+import diagnosis_helper as dh  # noqa: E402
+
+# The (diseases, signs) sizes benchmarked by default, from the size of the real tables up to the largest we expect
+DEFAULT_SIZES = ((10, 15), (100, 200), (500, 1000), (2000, 5000))
+
+
+def parse_sizes(text):
+    """
+    :param text: A comma separated list of sizes, such as '10x15,2000x5000'
+    :return: A tuple of (diseases, signs) pairs
+    """
+    return tuple(tuple(int(n) for n in size.split('x')) for size in text.split(','))
+
+
+def animal_name(n_diseases, n_signs):
+    """
+    :return: The name of the synthetic animal of the given size, already capitalised as validate_animal expects
+    """
+    return f'Synthetic{n_diseases}x{n_signs}'
+
+
+def make_table(n_diseases, n_signs, seed=0):
+    """
+    Generate a random likelihood table
+    :return: A tuple of the list of diseases, the list of signs and a dictionary of likelihoods formatted as in
+    /diagnosis/custom_diagnose
+    """
+    rng = np.random.default_rng(seed)
+    diseases = [f'disease{i}' for i in range(n_diseases)]
+    signs = [f'sign{j}' for j in range(n_signs)]
+    values = rng.uniform(0.01, 0.99, size=(n_diseases, n_signs)).round(4)
+    likelihoods = {disease: dict(zip(signs, row)) for disease, row in zip(diseases, values.tolist())}
+    return diseases, signs, likelihoods
+
+
+def make_shown_signs(signs, seed=0):
+    """
+    :return: A dictionary of random sign values of -1, 0 or 1 for each sign
+    """
+    rng = np.random.default_rng(seed)
+    return dict(zip(signs, rng.integers(-1, 2, size=len(signs)).tolist()))
+
+
+def make_model(n_diseases, n_signs, seed=0):
+    """
+    :return: An AnimalModel for the synthetic animal of the given size
+    """
+    diseases, signs, likelihoods = make_table(n_diseases, n_signs, seed)
+    matrix = dh.LikelihoodMatrix(diseases, signs, likelihoods)
+    wiki_ids = {disease: f'Q{i}' for i, disease in enumerate(diseases)}
+    return dh.AnimalModel(animal_name(n_diseases, n_signs), matrix, wiki_ids, {})
+
+
+def install_synthetic_animals(sizes):
+    """
+    Swap in a snapshot containing a synthetic animal of each size alongside the real animals
+    :param sizes: A tuple of (diseases, signs) pairs
+    :return: The new snapshot
+    """
+    models = dict(dh.current_snapshot().models)
+    for n_diseases, n_signs in sizes:
+        model = make_model(n_diseases, n_signs)
+        models[model.name] = model
+    return dh.install_snapshot('synthetic', models)
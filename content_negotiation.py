@@ -0,0 +1,88 @@
+"""
+MessagePack content negotiation. Requests may send their body as MessagePack with a Content-Type of
+application/msgpack, and responses are sent as MessagePack when the Accept header prefers it over JSON. JSON remains
+the default, and floats are packed as 64 bit doubles so results keep their full precision.
+"""
+
+import json
+
+from flask import current_app, g, jsonify as _jsonify, request
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+
+import metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# The other names MessagePack is commonly sent under, which are accepted as well
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+
+
+def wants_msgpack():
+    """
+    :return: Whether the client's Accept header prefers MessagePack to JSON. JSON is chosen when they are equally
+    preferred, when there is no Accept header, or when msgpack is not installed.
+    """
+    if msgpack is None:
+        return False
+    wanted = g.get('wants_msgpack')
+    if wanted is None:
+        best = request.accept_mimetypes.best_match((JSON_MIMETYPE,) + MSGPACK_MIMETYPES, default=JSON_MIMETYPE)
+        wanted = g.wants_msgpack = best in MSGPACK_MIMETYPES
+    return wanted
+
+
+def packb(data):
+    """
+    :param data: The data to serialise
+    :return: The data serialised as MessagePack
+    """
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def jsonify(data):
+    """
+    A replacement for flask.jsonify which serialises the data in the format negotiated with the client. Like
+    flask.jsonify it is not timed itself, the callers time it as their 'serialise' stage.
+    :param data: The data to serialise
+    :return: A JSON or MessagePack response
+    """
+    if wants_msgpack():
+        return current_app.response_class(packb(data), mimetype=MSGPACK_MIMETYPE)
+    return _jsonify(data)
+
+
+def init_app(app):
+    """
+    Register the hooks which decode MessagePack request bodies and convert JSON responses for clients which prefer
+    MessagePack
+    """
+    @app.before_request
+    def decode_msgpack_body():
+        if request.mimetype not in MSGPACK_MIMETYPES or not request.content_length:
+            return
+        if msgpack is None:
+            raise UnsupportedMediaType('MessagePack is not supported by this server, please send JSON.')
+        with metrics.timed('parse'):
+            try:
+                data = msgpack.unpackb(request.get_data(cache=True), raw=False)
+            except (ValueError, TypeError, msgpack.UnpackException) as e:
+                raise BadRequest(f'The MessagePack body could not be decoded: {e}')
+        # Every request.get_json() call, including the payload validation of flask-restx, now returns the body
+        request._cached_json = (data, data)
+
+    @app.after_request
+    def encode_msgpack_response(response):
+        if response.mimetype not in (JSON_MIMETYPE, MSGPACK_MIMETYPE):
+            return response
+        response.vary.add('Accept')
+        # Most endpoints serialise in the negotiated format directly, this converts the rest, such as error messages
+        if (response.mimetype == JSON_MIMETYPE and response.status_code != 304 and not response.is_streamed and
+                'Content-Encoding' not in response.headers and wants_msgpack()):
+            response.set_data(packb(json.loads(response.get_data())))
+            response.mimetype = MSGPACK_MIMETYPE
+        return response
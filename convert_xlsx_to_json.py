@@ -1,14 +1,23 @@
 """
-One-time script to convert data.xlsx into data.json.
+One-time script to convert data.xlsx into data.json and the memory-mapped binary bundle data.bin.
 Re-run this whenever the Excel data changes.
 """
 
+import argparse
+import hashlib
 import json
 import os
 import sys
 
 from openpyxl import load_workbook
 
+from model_bundle import DTYPES, write_bundle
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--dtype', choices=DTYPES, default='float64',
+                    help='The precision of the matrices stored in data.bin (default: float64)')
+args = parser.parse_args()
+
 wb = load_workbook(filename=os.path.join(sys.path[0], "data.xlsx"), read_only=True, data_only=True)
 
 animals = [name for name in wb.sheetnames if "_Abbr" not in name and "_Codes" not in name]
@@ -63,8 +72,17 @@ for animal in animals:
 
 wb.close()
 
+# Identify the dataset by its contents, so the JSON and the bundle written from it report the same version
+data["dataset_version"] = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+# Write each file under a temporary name and rename it into place, so a running server never reads a partial file
 output_path = os.path.join(sys.path[0], "data.json")
-with open(output_path, "w") as f:
+with open(output_path + ".tmp", "w") as f:
     json.dump(data, f, indent=2)
+os.replace(output_path + ".tmp", output_path)
+
+bundle_path = os.path.join(sys.path[0], "data.bin")
+write_bundle(data, bundle_path + ".tmp", dtype=args.dtype)
+os.replace(bundle_path + ".tmp", bundle_path)
 
-print(f"Wrote {output_path} with animals: {animals}")
+print(f"Wrote {output_path} and {bundle_path} (dataset {data['dataset_version']}) with animals: {animals}")
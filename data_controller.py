@@ -1,10 +1,13 @@
-import copy
-import random
-
-from flask import jsonify
+import numpy as np
+from flask import request
 from flask_restx import Namespace, Resource
+from werkzeug.exceptions import BadRequest
 
+import content_negotiation as cn
 import diagnosis_helper as dh
+import matrix_delta as md
+import metrics
+from response_cache import cached_json_response
 
 api = Namespace('data', description='Data related operations')
 
@@ -38,9 +41,11 @@ class GetRequiredInputData(Resource):
         if animal is False:
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
 
-        return jsonify(
-            {'diseases': dh.get_disease_wiki_ids(animal), 'signs': dh.get_sign_names_and_codes(animal)})
+        return cached_json_response(
+            ('full_animal_data', animal),
+            lambda: {'diseases': dh.get_disease_wiki_ids(animal), 'signs': dh.get_sign_names_and_codes(animal)})
 
 
 @api.hide
@@ -74,22 +79,66 @@ class GetDiseaseSignMatrix(Resource):
         if animal is False:
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
+
+        return cached_json_response(('matrix', animal), lambda: dh.get_likelihood_data(animal), public=False)
+
+
+@api.hide
+@api.route('/matrix_delta/<string:animal>')
+@api.doc(required=True, responses={200: 'OK', 404: 'Not Found', 500: 'Internal Server Error'},
+         params={'animal': 'The species of animal you wish to retrieve the changes to the disease sign matrix for. '
+                           'This must be a valid animal as returned by /data/valid_animals. \n \n',
+                 'since': 'The dataset version of the matrix the client has, from the X-Dataset-Version header or '
+                          'the dataset_version of an earlier response'},
+         description='<h1>Description</h1><p>This endpoint returns the changes to the disease-sign matrix of an '
+                     'animal since the dataset version given in the since query parameter, so a mobile app can '
+                     'update its copy without downloading the whole matrix. The response holds the current '
+                     'dataset_version and, when full is false, the changed cells grouped by disease, the added '
+                     'diseases and signs with all of their values, and the removed diseases and signs. When full is '
+                     'true the whole matrix is returned in likelihoods instead, which happens when the version is '
+                     'unknown to the server, the animal is new or most of the matrix has changed.</p>'
+                     '<h1>URL Parameters</h1><ul><li><p>animal: The species of animal you wish to retrieve the '
+                     'changes for. This must be a valid animal as returned by /data/valid_animals.</p></li></ul>')
+class GetDiseaseSignMatrixDelta(Resource):
+    """
+    This class is used to create the matrix_delta endpoint which returns the changes to the disease sign matrix of an
+    animal since an earlier dataset version. Like the matrix endpoint it is hidden from the Swagger UI, as it is only
+    used to update the data on mobile apps which perform calculations offline.
+    """
+
+    @staticmethod
+    def get(animal):
+        animal = dh.validate_animal(animal)
+        if animal is False:
+            return {'error': 'Invalid animal. Please use a valid animal '
+                             'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
 
-        return jsonify(dh.get_likelihood_data(animal))
+        since = request.args.get('since')
+        if since is not None and dh.get_snapshot(since) is None:
+            # Every unknown version gets the full matrix, so they share one cached body
+            since = None
+        return cached_json_response(('matrix_delta', animal, since), lambda: md.matrix_delta(animal, since),
+                                    public=False)
 
 
 @api.route('/example_matrix/<string:animal>')
 @api.doc(example='Sheep', required=True,
-         responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}, params={
-        'animal': 'The species of animal you wish to retrieve the disease sign matrix for. This must be a valid '
-                  'animal as returned by /data/valid_animals. \n \n'},
+         responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'},
+         params={'animal': 'The species of animal you wish to retrieve the disease sign matrix for. This must be a '
+                           'valid animal as returned by /data/valid_animals. \n \n',
+                 'seed': {'description': 'An optional integer seed. The same seed always returns the same matrix for '
+                                         'the same animal and dataset version.', 'in': 'query', 'type': 'integer'}},
          description='<h1>Description</h1><p>This endpoint returns a '
                      '<a href="https://developer.mozilla.org/en-US/docs/Learn/JavaScript/Objects/JSON">JSON</a> '
                      'object containing an example disease-sign Bayesian matrix for the given animal. '
                      'This matrix contains randomly generated '
                      'likelihoods of each sign being present for each disease.</p><h1>URL Parameters</h1><ul><li>'
                      '<p>animal: The species of animal you wish to retrieve the disease-sign matrix for. '
-                     'This must be a valid animal as returned by /data/valid_animals. </p></li></ul>\n \n ')
+                     'This must be a valid animal as returned by /data/valid_animals. </p></li><li><p>seed: An '
+                     'optional integer which makes the matrix reproducible, for use in documentation and tests.'
+                     '</p></li></ul>\n \n ')
 class GetExampleMatrix(Resource):
     """
     This class is used to create the example_matrix endpoint which returns a randomly generated disease sign matrix
@@ -106,15 +155,34 @@ class GetExampleMatrix(Resource):
         if animal is False:
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
+
+        seed = request.args.get('seed')
+        if seed is None:
+            return cn.jsonify(_generate_example_matrix(animal, None))
+        try:
+            seed = int(seed)
+        except ValueError:
+            raise BadRequest(f'Invalid seed: {seed}. The seed must be an integer.')
+        if seed < 0:
+            raise BadRequest(f'Invalid seed: {seed}. The seed must not be negative.')
 
-        data = copy.deepcopy(dh.get_likelihood_data(animal))
+        # A seeded matrix never changes for the same animal and dataset, so it is generated once and cached
+        return cached_json_response(('example_matrix', animal, seed), lambda: _generate_example_matrix(animal, seed))
 
-        # Replace correct data with random data
-        for disease in data:
-            for sign in data[disease]:
-                data[disease][sign] = round(random.uniform(0.00001, 0.99999), 4)
 
-        return jsonify(data)
+def _generate_example_matrix(animal, seed):
+    """
+    Generate a random matrix with the same diseases and signs as the animal's likelihood matrix, without reading the
+    real likelihoods
+    :param animal: The animal to generate the matrix for
+    :param seed: The seed of the random number generator, or None for a different matrix every time
+    :return: A dictionary of random likelihoods for each disease, formatted as in /data/matrix
+    """
+    model = dh.get_model(animal)
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(0.00001, 0.99999, size=(len(model.diseases), len(model.signs))).round(4)
+    return {disease: dict(zip(model.signs, row)) for disease, row in zip(model.diseases, values.tolist())}
 
 
 @api.route('/valid_animals')
@@ -139,7 +207,7 @@ class GetAnimals(Resource):
         # Return the names by getting every worksheet with doesn't contain _Abbr or _Codes
         # I'm using list comprehension as it is cleaner than a for loop, but syntacitically slightly more advanced
 
-        return jsonify(dh.get_animals())
+        return cached_json_response(('valid_animals',), dh.get_animals)
 
 
 @api.route('/full_sign_data/<string:animal>')
@@ -184,8 +252,10 @@ class GetSignCodesAndTerminology(Resource):
         if animal is False:
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
 
-        return jsonify({'full_sign_data': dh.get_sign_names_and_codes(animal)})
+        return cached_json_response(('full_sign_data', animal),
+                                    lambda: {'full_sign_data': dh.get_sign_names_and_codes(animal)})
 
 
 @api.route('/full_disease_data/<string:animal>')
@@ -228,5 +298,38 @@ class GetDiseaseCodes(Resource):
         if animal is False:
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
+
+        return cached_json_response(('full_disease_data', animal),
+                                    lambda: {'disease_codes': dh.get_disease_wiki_ids(animal)})
+
+
+@api.route('/canonical_order/<string:animal>')
+@api.doc(required=True, responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint returns the canonical order of the signs and diseases of '
+                     'an animal along with the dataset version it belongs to. It is used by the compact diagnosis '
+                     'mode at /diagnosis/diagnose_compact, which takes the signs by position in this order and '
+                     'returns the results by position in the order of the diseases. Fetch it again whenever '
+                     '/diagnosis/diagnose_compact returns 409, as the order can change when the data is updated.</p>'
+                     '<h1>URL Parameters</h1><ul><li><p>animal: The species of animal you wish to retrieve the order '
+                     'for. This must be a valid animal as returned by /data/valid_animals.</p></li></ul>',
+         params={'animal': 'The species of animal you wish to retrieve the order for. This must be a valid animal as '
+                           'returned by /data/valid_animals. \n \n'})
+class GetCanonicalOrder(Resource):
+    """
+    This class is used to create the canonical_order endpoint which returns the order of the signs and diseases used
+    by the compact diagnosis mode.
+    """
+
+    @staticmethod
+    def get(animal):
+        animal = dh.validate_animal(animal)
+        if animal is False:
+            return {'error': 'Invalid animal. Please use a valid animal '
+                             'from /data/valid_animals.', 'status': 404}, 404
+        metrics.set_animal(animal)
 
-        return jsonify({'disease_codes': dh.get_disease_wiki_ids(animal)})
\ No newline at end of file
+        model = dh.get_model(animal)
+        return cached_json_response(('canonical_order', animal),
+                                    lambda: {'dataset_version': dh.get_dataset_version(), 'signs': list(model.signs),
+                                             'diseases': list(model.diseases)})
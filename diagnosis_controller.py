@@ -1,8 +1,21 @@
-from flask import request, jsonify
+import json
+
+import numpy as np
+from flask import current_app, request, Response, stream_with_context
 from flask_restx import Namespace, Resource, fields
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, HTTPException
 
+import content_negotiation as cn
 import diagnosis_helper as dh
+import metrics
+import matrix_cache as mc
+import micro_batch as mb
+import offload
+import payload_schema
+import profiling
+import result_cache as rc
+import session_store as ss
+import streaming_payload as sp
 
 api = Namespace('diagnosis', description='Diagnosis related operations')
 
@@ -96,21 +109,53 @@ diagnosis_payload_model = api.model('Diagnose', {
                 "Stare": 0.59, "Stunt": 0.1479, "Weak": 0.8633, "Wght_L": 0.085},
             "ZZ_Other": {"Anae": 0.6361, "Anrx": 0.1729, "Atax": 0.3008, "Const": 0.6395, "Diarr": 0.3737,
                 "Dysnt": 0.858, "Dyspn": 0.9196, "Icter": 0.3255, "Lymph": 0.4681, "Pyrx": 0.7769, "SV_Oedm": 0.0234,
-                "Stare": 0.9337, "Stunt": 0.3675, "Weak": 0.1286, "Wght_L": 0.0943}})})
+                "Stare": 0.9337, "Stunt": 0.3675, "Weak": 0.1286, "Wght_L": 0.0943}}),
+    'top_k': fields.Integer(required=False, min=1,
+                            description='Return only this many of the most likely diseases, most likely first. The '
+                                        'results are then a list of {"disease", "probability"} objects rather than '
+                                        'an object keyed by disease'),
+    'min_probability': fields.Float(required=False, min=0, max=100,
+                                    description='Return only the diseases with a result of at least this value, '
+                                                'most likely first. Can be combined with top_k')})
 
 custom_diagnosis_payload_model = api.model('Custom Diagnosis Payload', {
 
-    'diseases': fields.List(fields.String, required=True, description='The diseases to be diagnosed',
+    'diseases': fields.List(fields.String, required=False, description='The diseases to be diagnosed. Required '
+                                                                       'unless matrix_id is given',
                             example=['Rabies', 'Cold']),
-    'signs': fields.List(fields.String, required=True, description='The symptoms to be diagnosed',
+    'signs': fields.List(fields.String, required=False, description='The symptoms to be diagnosed. Required unless '
+                                                                    'matrix_id is given',
                          example=['Fever', 'Cough', 'Diarrhoea']),
     'shown_signs': fields.Raw(required=True, description='The symptoms that are shown',
                               example={"Fever": 1, "Cough": 0, "Diarrhoea": -1}),
-    'likelihoods': fields.Raw(required=True, description='The likelihoods to be diagnosed',
+    'likelihoods': fields.Raw(required=False, description='The likelihoods to be diagnosed. Required unless '
+                                                          'matrix_id is given',
                               example={"Rabies": {"Fever": 0.6, "Cough": 0.1, "Diarrhoea": 0.1},
                                        "Cold": {"Fever": 0.9, "Cough": 0.9, "Diarrhoea": 0.1}}),
+    'matrix_id': fields.String(required=False, description='The id of a matrix registered with '
+                                                           '/diagnosis/custom_matrix, used in place of diseases, signs '
+                                                           'and likelihoods'),
     'priors': fields.Raw(required=False, description='The priors to be diagnosed', example={"Rabies": 20, "Cold": 80}),
-    'animal': fields.String(required=False, description='The animal to be diagnosed', example='Dog')})
+    'animal': fields.String(required=False, description='The animal to be diagnosed', example='Dog'),
+    'top_k': fields.Integer(required=False, min=1,
+                            description='Return only this many of the most likely diseases, formatted as in '
+                                        '/diagnose'),
+    'min_probability': fields.Float(required=False, min=0, max=100,
+                                    description='Return only the diseases with a result of at least this value, '
+                                                'formatted as in /diagnose')})
+
+# Checked by hand in Diagnose.post and CustomDiagnose.post rather than with validate=True, see payload_schema
+_diagnosis_schema = payload_schema.CompiledSchema(diagnosis_payload_model)
+_custom_diagnosis_schema = payload_schema.CompiledSchema(custom_diagnosis_payload_model)
+
+custom_matrix_payload_model = api.model('Custom Matrix Payload', {
+    'diseases': fields.List(fields.String, required=True, description='The diseases in the matrix',
+                            example=['Rabies', 'Cold']),
+    'signs': fields.List(fields.String, required=True, description='The signs in the matrix',
+                         example=['Fever', 'Cough', 'Diarrhoea']),
+    'likelihoods': fields.Raw(required=True, description='The likelihoods, formatted as in /custom_diagnose',
+                              example={"Rabies": {"Fever": 0.6, "Cough": 0.1, "Diarrhoea": 0.1},
+                                       "Cold": {"Fever": 0.9, "Cough": 0.9, "Diarrhoea": 0.1}})})
 
 
 @api.route('/diagnose/', methods=['POST'])
@@ -428,13 +473,16 @@ custom_diagnosis_payload_model = api.model('Custom Diagnosis Payload', {
                      '      "Wght_L": 0.0943'
                      '    }'
                      ' }\n \t }\n } ')
-class Diagnose(Resource):
+class Diagnose(metrics.InstrumentedResource):
 
     @staticmethod
-    @api.expect(diagnosis_payload_model, validate=True)
+    @api.expect(diagnosis_payload_model)
+    @profiling.profiled
     def post():
 
         data = request.get_json()
+        with metrics.timed('schema'):
+            _diagnosis_schema.validate(data)
         animal = data['animal']
 
         animal = dh.validate_animal(animal)
@@ -442,41 +490,237 @@ class Diagnose(Resource):
             return {'error': 'Invalid animal. Please use a valid animal '
                              'from /data/valid_animals.', 'status': 404}, 404
 
-        valid_signs = dh.get_signs(animal)
-        diseases = dh.get_diseases(animal)
-        wiki_ids = dh.get_disease_wiki_ids(animal)
+        model = dh.get_model(animal)
+        metrics.set_animal(animal)
 
-        # Check if the likelihoods are included in the API request data
-        if data.get('likelihoods') is not None:
-            likelihoods = dh.validate_likelihoods(data['likelihoods'], diseases, valid_signs)
-        else:
-            likelihoods = dh.get_likelihood_data(animal)
+        with metrics.timed('validate'):
+            validator = model.validator
+            # Check if the likelihoods are included in the API request data
+            if data.get('likelihoods') is not None:
+                matrix = validator.likelihoods(data['likelihoods'])
+            else:
+                matrix = model.matrix
 
-        # Get the signs from the API request data
-        shown_signs = data['signs']
-        if set(shown_signs.keys()) != set(valid_signs):
-            raise BadRequest(f'Invalid signs: {list(set(shown_signs.keys()) - set(valid_signs))}. '
-                             f'Please use valid sign from /data/valid_signs/{animal}.')
+            # Get the signs from the API request data
+            shown_signs = validator.shown_signs(data['signs'])
 
-        for sign, value in shown_signs.items():
-            if value not in (0, 1, -1):
-                raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+            # Check if the priors are included in the API request data
+            if data.get('priors') is not None:
+                priors = validator.priors(data['priors'])
+            else:
+                priors = model.default_priors
 
-        # Check if the priors are included in the API request data
-        if data.get('priors') is not None:
-            priors = dh.validate_priors(data.get('priors'), diseases)
-        else:
-            priors = dh.get_default_priors(diseases)
+            top_k, min_probability = dh.validate_ranking(data.get('top_k'), data.get('min_probability'))
+
+        if top_k is not None or min_probability is not None:
+            posteriors = _posterior_vector(model, matrix, shown_signs, priors)
+            return _ranked_response(dh.rank_posteriors(model.diseases, posteriors, top_k, min_probability),
+                                    model.disease_wiki_ids)
+
+        msgpack = cn.wants_msgpack()
+        mimetype = cn.MSGPACK_MIMETYPE if msgpack else cn.JSON_MIMETYPE
+
+        # Only the default likelihoods and priors are cached, the result depends on nothing but the signs
+        cache_key = None
+        if matrix is model.matrix and priors is model.default_priors:
+            cache_key = (rc.pack_signs(model.signs, shown_signs), msgpack)
+            body = rc.results.get(animal, dh.get_dataset_version(), cache_key)
+            if body is not None:
+                return current_app.response_class(body, mimetype=mimetype)
 
         # Perform calculations and normalisation
-        results = dh.calculate_results(diseases, likelihoods, shown_signs, priors)
-        normalised_results = dh.normalise(results)
+        normalised_results = dict(zip(model.diseases, _posterior_vector(model, matrix, shown_signs, priors).tolist()))
 
-        return jsonify({'results': normalised_results, 'wiki_ids': wiki_ids})
+        with metrics.timed('serialise'):
+            if msgpack:
+                body = cn.packb({'results': normalised_results, 'wiki_ids': model.disease_wiki_ids})
+            else:
+                body = _diagnosis_body(normalised_results, model)
+        if cache_key is not None:
+            rc.results.put(animal, dh.get_dataset_version(), cache_key, body)
+        return current_app.response_class(body, mimetype=mimetype)
 
 
-@api.route('/custom_diagnose', methods=['POST'])
+def _posterior_vector(model, matrix, shown_signs, priors):
+    """
+    Calculate the posteriors of a diagnosis of one of the built-in animals, batched with other requests for the same
+    animal when micro-batching is enabled
+    :param model: The AnimalModel of the animal being diagnosed
+    :param matrix: The LikelihoodMatrix being used, only the animal's own matrix is batched
+    :param shown_signs: A dictionary of validated signs
+    :param priors: A dictionary of validated priors
+    :return: A vector of normalised results aligned to model.diseases
+    """
+    if mb.batcher.enabled and matrix is model.matrix and dh.DEFAULT_ENGINE == 'numpy':
+        log_priors = model.default_log_priors if priors is model.default_priors else matrix.log_priors(priors)
+        return mb.batcher.posteriors(model.name, matrix, matrix.evidence(shown_signs), log_priors)
+    return dh.calculate_posterior_vector(matrix, shown_signs, priors)
+
+
+def _diagnosis_body(results, model):
+    """
+    Serialise the response of the diagnose endpoint, splicing in the animal's pre-serialised WikiData IDs rather than
+    serialising them again on every request
+    :param results: A dictionary of normalised results for each disease
+    :param model: The AnimalModel of the animal that was diagnosed
+    :return: A JSON body equivalent to that of cn.jsonify({'results': results, 'wiki_ids': model.disease_wiki_ids})
+    """
+    return ('{"results":' + json.dumps(results, sort_keys=True, separators=(',', ':')) +
+            ',"wiki_ids":' + model.disease_wiki_ids_json + '}\n')
+
+
+def _ranked_response(ranked, wiki_ids=None):
+    """
+    Build the response of a diagnosis which asked for top_k or min_probability
+    :param ranked: A list of (disease, result) tuples, most likely first, as returned by dh.rank_posteriors
+    :param wiki_ids: A dictionary of WikiData IDs for each disease, of which only those of the ranked diseases are
+    returned, or None to leave them out of the response
+    :return: A JSON response with the ranked results as a list of {"disease", "probability"} objects
+    """
+    with metrics.timed('serialise'):
+        response = {'results': [{'disease': disease, 'probability': probability} for disease, probability in ranked]}
+        if wiki_ids is not None:
+            response['wiki_ids'] = {disease: wiki_ids[disease] for disease, _ in ranked if disease in wiki_ids}
+        return cn.jsonify(response)
+
+
+# The number of cases read from a batch before they are grouped by animal and evaluated, which bounds the memory used
+# by /diagnose_batch regardless of the size of the batch
+BATCH_CHUNK_SIZE = 1024
+
+diagnosis_batch_case_model = api.model('Diagnose Batch Case', {
+    'id': fields.Raw(required=False, description='An optional identifier for the case which is echoed back in its '
+                                                 'result', example='case-1'),
+    'animal': fields.String(required=True, description='The species of animal', example='Goat'),
+    'signs': fields.Raw(required=True, description='The signs shown by the animal, formatted as in /diagnose',
+                        example={"Anae": 0, "Anrx": 1}),
+    'priors': fields.Raw(required=False, description='The optional priors, formatted as in /diagnose')})
+
+
+@api.route('/diagnose_batch', methods=['POST'])
 @api.doc(responses={200: 'OK', 400: 'Bad Request', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint diagnoses many cases in one request. The body is either a '
+                     '<a href="https://developer.mozilla.org/en-US/docs/Learn/JavaScript/Objects/JSON">JSON</a> '
+                     'array of cases or, with the Content-Type "application/x-ndjson", one JSON case per line. Each '
+                     'case contains "animal" and "signs" and can optionally contain "priors" and "id", formatted as '
+                     'in /diagnosis/diagnose. The cases for each animal are evaluated together and the results are '
+                     'streamed back as <a href="https://github.com/ndjson/ndjson-spec">NDJSON</a>, one line per case '
+                     'in the order they were sent.</p> \n \n<p>Each line contains "index", the position of the case '
+                     'in the batch, and "id" if one was given. A successful case also contains "animal" and '
+                     '"results", while a case which could not be diagnosed contains "error" and "status" instead, '
+                     'without affecting the rest of the batch. Custom likelihoods are not supported in a '
+                     'batch.</p>')
+class DiagnoseBatch(Resource):
+    """
+    This class is used to create the diagnose_batch endpoint, which evaluates many cases per request and streams the
+    results back as NDJSON.
+    """
+
+    @staticmethod
+    @api.expect([diagnosis_batch_case_model], validate=False)
+    def post():
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            cases = _read_ndjson_cases(request.stream)
+        else:
+            data = request.get_json()
+            if not isinstance(data, list):
+                raise BadRequest('The batch must be a JSON array of cases.')
+            cases = iter(data)
+
+        def generate():
+            chunk = []
+            for case in cases:
+                chunk.append(case)
+                if len(chunk) == BATCH_CHUNK_SIZE:
+                    yield from _diagnose_chunk(chunk)
+                    chunk = []
+            if chunk:
+                yield from _diagnose_chunk(chunk)
+
+        return Response(stream_with_context(_number_lines(generate())), mimetype='application/x-ndjson')
+
+
+def _read_ndjson_cases(stream):
+    """
+    Lazily parse the cases in an NDJSON request body, skipping blank lines
+    :param stream: The request body stream
+    :return: A generator of cases, where a line that is not valid JSON is returned as None
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def _number_lines(lines):
+    """
+    Add the index of each case to its result and serialise it as a line of NDJSON
+    :param lines: A generator of result dictionaries, in the order of the cases
+    :return: A generator of NDJSON lines
+    """
+    for index, line in enumerate(lines):
+        yield json.dumps({'index': index, **line}) + '\n'
+
+
+def _diagnose_chunk(chunk):
+    """
+    Diagnose a chunk of batch cases, evaluating the cases for each animal as a single matrix operation
+    :param chunk: A list of cases
+    :return: A generator of result dictionaries in the order of the cases
+    """
+    outputs = [None] * len(chunk)
+    groups = {}
+    for position, case in enumerate(chunk):
+        try:
+            if not isinstance(case, dict) or not isinstance(case.get('signs'), dict):
+                raise BadRequest('Each case must be a JSON object containing "animal" and "signs".')
+            animal = dh.validate_animal(str(case.get('animal', '')))
+            if animal is False:
+                outputs[position] = {'error': 'Invalid animal. Please use a valid animal '
+                                              'from /data/valid_animals.', 'status': 404}
+                continue
+            model = dh.get_model(animal)
+            dh.validate_shown_signs(case['signs'], model.sign_set, animal)
+            if case.get('priors') is not None:
+                if not isinstance(case['priors'], dict):
+                    raise BadRequest('Priors must be a JSON object mapping each disease to its prior.')
+                log_priors = model.matrix.log_priors(model.validator.priors(case['priors']))
+            else:
+                log_priors = model.default_log_priors
+            groups.setdefault(animal, []).append((position, model.matrix.evidence(case['signs']), log_priors))
+        except HTTPException as e:
+            outputs[position] = {'error': e.description, 'status': e.code}
+
+    for animal, group in groups.items():
+        matrix = dh.get_model(animal).matrix
+        positions, evidence, log_priors = zip(*group)
+        scores = np.vstack(evidence) @ matrix.log_table.T + np.vstack(log_priors)
+        # A case whose priors give every disease a probability of 0, or are negative, fails on its own rather than
+        # ending the response for the whole batch
+        finite = np.isfinite(scores.max(axis=1))
+        posteriors = iter(dh.log_normalise(scores[finite]).tolist())
+        for position, row_is_finite, row in zip(positions, finite, scores):
+            if row_is_finite:
+                outputs[position] = {'animal': animal, 'results': dict(zip(matrix.diseases, next(posteriors)))}
+            else:
+                try:
+                    dh.log_normalise(row)
+                except HTTPException as e:
+                    outputs[position] = {'error': e.description, 'status': e.code}
+
+    for case, output in zip(chunk, outputs):
+        if isinstance(case, dict) and 'id' in case:
+            output = {'id': case['id'], **output}
+        yield output
+
+
+@api.route('/custom_diagnose', methods=['POST'])
+@api.doc(responses={200: 'OK', 400: 'Bad Request', 500: 'Internal Server Error',
+                    503: 'Service Unavailable'},
          description='<h1>Description</h1><p>This endpoint takes a <a '
                      'href="https://developer.mozilla.org/en-US/docs/Learn/JavaScript/Objects/JSON">JSON</a> '
                      'object containing the list of possible diseases for the animal you wish to diagnose,'
@@ -518,39 +762,504 @@ class Diagnose(Resource):
                      '"likelihoods": {"Rabies": {"Fever": 0.6, "Cough": 0.1, "Diarrhoea": 0.1},"Cold": '
                      '{"Fever": 0.9,"Cough": 0.9,"Diarrhoea": 0.1}},\n '
                      '"priors": {"Rabies": 20,"Cold": 80 },\n "animal": "Dog" \n}')
-class CustomDiagnose(Resource):
+class CustomDiagnose(metrics.InstrumentedResource):
     """
     This class is used to create the custom_diagnose endpoint.
     """
 
+    # The body is parsed incrementally by _read_custom_diagnosis rather than up front, see streaming_payload
+    streams_body = True
+
     @staticmethod
-    @api.expect(custom_diagnosis_payload_model, validate=True)
+    @api.expect(custom_diagnosis_payload_model)
+    @profiling.profiled
     def post():
         # This is the POST method for the custom_diagnose endpoint which allows the user to input their own data,
         # meaning the API can be used in a larger number of contexts.
 
-        data = request.get_json()
+        data = _read_custom_diagnosis()
         shown_signs = data.get('shown_signs')
-        likelihoods = data.get('likelihoods')
-        diseases = data.get('diseases')
         priors = data.get('priors')
-        sign_list = data.get('signs')
 
-        # Check if the signs values are all valid
-        for sign, value in shown_signs.items():
-            if value not in (0, 1, -1):
-                raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+        with metrics.timed('validate'):
+            # Check if the signs values are all valid
+            for sign, value in shown_signs.items():
+                if value not in (0, 1, -1):
+                    raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+
+            if data.get('matrix_id') is not None:
+                matrix = mc.custom_matrices.get(data['matrix_id'])
+                if matrix is None:
+                    return {'error': 'Unknown matrix_id. The matrix may have been evicted, please register it '
+                                     'again with /diagnosis/custom_matrix.', 'status': 404}, 404
+            else:
+                missing = [field for field in ('diseases', 'signs', 'likelihoods') if data.get(field) is None]
+                if missing:
+                    api.abort(400, 'Input payload validation failed',
+                              errors={field: f"'{field}' is a required property" for field in missing})
+                if isinstance(data['likelihoods'], sp.LikelihoodPacker):
+                    # Already checked while the body was read
+                    values = data['likelihoods'].pack(data['diseases'], data['signs'])
+                    if offload.pool.should_offload(*values.shape):
+                        return _offloaded_custom_diagnosis(data, shown_signs, priors, values)
+                    matrix = _get_packed_matrix(data['diseases'], data['signs'], values)
+                elif offload.pool.should_offload(len(data['diseases']), len(data['signs'])):
+                    return _offloaded_custom_diagnosis(data, shown_signs, priors)
+                else:
+                    matrix = _get_custom_matrix(data['diseases'], data['signs'], data['likelihoods'])
+
+            # Check to make sure the priors are valid
+            if priors is not None:
+                dh.validate_priors(priors, matrix.diseases)
+            else:
+                priors = dh.get_default_priors(matrix.diseases)
 
-        # Check to make sure the likelihoods are valid
-        dh.validate_likelihoods(likelihoods, diseases, sign_list)
+            top_k, min_probability = dh.validate_ranking(data.get('top_k'), data.get('min_probability'))
+
+        if top_k is not None or min_probability is not None:
+            posteriors = dh.calculate_posterior_vector(matrix, shown_signs, priors)
+            return _ranked_response(dh.rank_posteriors(matrix.diseases, posteriors, top_k, min_probability))
+
+        normalised_results = dh.calculate_posteriors(matrix, shown_signs, priors)
+
+        with metrics.timed('serialise'):
+            return cn.jsonify({'results': normalised_results})
+
+
+@api.hide
+@api.route('/custom_matrix', methods=['POST'])
+@api.doc(responses={201: 'Created', 400: 'Bad Request', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint validates and stores a custom likelihood matrix, '
+                     'formatted as in /diagnosis/custom_diagnose, and returns its "matrix_id". The id can then be '
+                     'sent to /diagnosis/custom_diagnose in place of "diseases", "signs" and "likelihoods". Matrices '
+                     'are kept in a bounded cache, so a request with an id which has been evicted returns 404 and the '
+                     'matrix must be registered again. The id is derived from the contents of the matrix, so '
+                     'registering the same matrix twice returns the same id.</p>')
+class CustomMatrix(Resource):
+    """
+    This class is used to create the custom_matrix endpoint, which registers a custom likelihood matrix once so later
+    requests can refer to it by id.
+    """
+
+    @staticmethod
+    @api.expect(custom_matrix_payload_model, validate=True)
+    def post():
+        data = request.get_json()
+        matrix_key = mc.matrix_key(data['diseases'], data['signs'], data['likelihoods'])
+        _get_custom_matrix(data['diseases'], data['signs'], data['likelihoods'], matrix_key)
+        return {'matrix_id': matrix_key}, 201
 
-        # Check to make sure the priors are valid
-        if priors is not None:
-            dh.validate_priors(priors, diseases)
+
+@api.hide
+@api.route('/custom_matrix/stats')
+class CustomMatrixStats(Resource):
+    """
+    This class is used to create the custom_matrix/stats endpoint, which reports the size and the hit, miss and
+    eviction counters of the custom matrix cache.
+    """
+
+    @staticmethod
+    def get():
+        return cn.jsonify(mc.custom_matrices.stats())
+
+
+@api.hide
+@api.route('/result_cache/stats')
+class ResultCacheStats(Resource):
+    """
+    This class is used to create the result_cache/stats endpoint, which reports the size, the hit, miss and eviction
+    counters and the hit ratio of the /diagnose result cache for each animal.
+    """
+
+    @staticmethod
+    def get():
+        return cn.jsonify(rc.results.stats())
+
+
+def _read_custom_diagnosis():
+    """
+    Read and validate the body of /diagnosis/custom_diagnose. A JSON body is parsed incrementally when ijson is
+    installed, so its likelihoods are checked and packed as they arrive, other bodies are read with get_json.
+    :return: The request body, in which likelihoods may be a LikelihoodPacker
+    """
+    if request.is_json and sp.available():
+        try:
+            with metrics.timed('parse'):
+                data = sp.parse_custom_diagnosis(request.stream)
+        except sp.JSONError as e:
+            data = request.on_json_loading_failed(e)
+    else:
+        data = request.get_json()
+
+    with metrics.timed('schema'):
+        if isinstance(data, dict) and isinstance(data.get('likelihoods'), sp.LikelihoodPacker):
+            _custom_diagnosis_schema.validate(dict(data, likelihoods={}))
         else:
-            priors = dh.get_default_priors(diseases)
+            _custom_diagnosis_schema.validate(data)
+    return data
+
+
+def _offloaded_custom_diagnosis(data, shown_signs, priors, values=None):
+    """
+    Validate and score a large custom table in the offload pool, so the worker can keep serving other requests
+    :param data: The validated request body
+    :param shown_signs: The validated shown signs
+    :param priors: The priors in the request body, or None
+    :param values: The likelihoods packed by LikelihoodPacker.pack, or None to send the likelihoods of the body
+    :return: The response of /diagnosis/custom_diagnose, or a 503 response if the pool is full or the job timed out
+    """
+    diseases = data['diseases']
+    try:
+        with metrics.timed('offload'):
+            if values is not None:
+                posteriors = offload.pool.packed_diagnosis(diseases, data['signs'], values, shown_signs, priors)
+            else:
+                posteriors = offload.pool.custom_diagnosis(diseases, data['signs'], data['likelihoods'], shown_signs,
+                                                           priors)
+    except offload.PoolSaturated:
+        return {'error': 'The server is busy with other large custom diagnoses. Please try again shortly.',
+                'status': 503}, 503, {'Retry-After': '1'}
+    except offload.PoolTimeout:
+        return {'error': 'The custom diagnosis did not finish in time. Please try a smaller matrix or try again '
+                         'later.', 'status': 503}, 503, {'Retry-After': '5'}
+
+    top_k, min_probability = dh.validate_ranking(data.get('top_k'), data.get('min_probability'))
+    if top_k is not None or min_probability is not None:
+        return _ranked_response(dh.rank_posteriors(diseases, posteriors, top_k, min_probability))
+    with metrics.timed('serialise'):
+        return cn.jsonify({'results': dict(zip(diseases, posteriors.tolist()))})
+
+
+def _get_custom_matrix(diseases, signs, likelihoods, matrix_key=None):
+    """
+    Get the compiled matrix for a custom likelihood table from the cache, validating and compiling it on a miss
+    :param diseases: A list of the diseases in the matrix
+    :param signs: A list of the signs in the matrix
+    :param likelihoods: A dictionary of likelihoods for each disease, formatted as in /custom_diagnose
+    :param matrix_key: The content address of the matrix, if it has already been calculated
+    :return: The LikelihoodMatrix, otherwise a BadRequest exception is raised
+    """
+    if matrix_key is None:
+        matrix_key = mc.matrix_key(diseases, signs, likelihoods)
+    matrix = mc.custom_matrices.get(matrix_key)
+    if matrix is None:
+        dh.validate_likelihoods(likelihoods, diseases, signs)
+        matrix = dh.LikelihoodMatrix(diseases, signs, likelihoods)
+        mc.custom_matrices.put(matrix_key, matrix)
+    return matrix
+
+
+def _get_packed_matrix(diseases, signs, values):
+    """
+    Get the compiled matrix for a custom likelihood table parsed incrementally from the cache, compiling it on a miss
+    :param diseases: A list of the diseases in the matrix
+    :param signs: A list of the signs in the matrix
+    :param values: The likelihoods packed by LikelihoodPacker.pack
+    :return: The LikelihoodMatrix
+    """
+    matrix_key = mc.packed_key(diseases, signs, values)
+    matrix = mc.custom_matrices.get(matrix_key)
+    if matrix is None:
+        matrix = dh.LikelihoodMatrix.from_arrays(diseases, signs, values,
+                                                 dh.LikelihoodMatrix.compute_log_table(values))
+        mc.custom_matrices.put(matrix_key, matrix)
+    return matrix
+
+
+session_payload_model = api.model('Diagnosis Session', {
+    'animal': fields.String(required=True, description='The species of animal', example='Cattle'),
+    'signs': fields.Raw(required=False, description='The signs recorded so far, formatted as in /diagnose. Signs '
+                                                    'which are left out start as 0, not observed',
+                        example={"Anrx": 1, "Lymph": -1}),
+    'priors': fields.Raw(required=False, description='The optional priors, formatted as in /diagnose')})
+
+session_update_model = api.model('Diagnosis Session Update', {
+    'signs': fields.Raw(required=True, description='The signs recorded since the last update, formatted as in '
+                                                   '/diagnose. Signs which are left out keep their value',
+                        example={"Pyrx": 1})})
+
+
+@api.route('/sessions', methods=['POST'])
+@api.doc(responses={201: 'Created', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint starts an incremental diagnosis session for an animal, '
+                     'for when signs are recorded one at a time. It returns a "session_id" and the results for the '
+                     'signs given so far. Each further sign is then sent to /diagnosis/sessions/\'session_id\' with a '
+                     'PATCH request, which returns the updated results without sending the whole case again.</p> \n '
+                     '\n<p>Sessions which are not used for 30 minutes (by default) expire, after which the session '
+                     'must be started again.</p>')
+class DiagnosisSessions(metrics.InstrumentedResource):
+    """
+    This class is used to create the sessions endpoint, which starts an incremental diagnosis session.
+    """
+
+    @staticmethod
+    @api.expect(session_payload_model, validate=True)
+    def post():
+        data = request.get_json()
+        animal = dh.validate_animal(data['animal'])
+        if animal is False:
+            return {'error': 'Invalid animal. Please use a valid animal '
+                             'from /data/valid_animals.', 'status': 404}, 404
+
+        model = dh.get_model(animal)
+        metrics.set_animal(animal)
+
+        with metrics.timed('validate'):
+            signs = dh.validate_sign_updates(data.get('signs') or {}, model.sign_set, animal)
+            if data.get('priors') is not None:
+                if not isinstance(data['priors'], dict):
+                    raise BadRequest('Priors must be a JSON object mapping each disease to its prior.')
+                log_priors = model.matrix.log_priors(model.validator.priors(data['priors']))
+            else:
+                log_priors = model.default_log_priors
+
+        session = ss.DiagnosisSession(model, log_priors)
+        with metrics.timed('calculate'):
+            session.update(signs)
+        # Only a session which could be scored is kept
+        response = _session_response(session)
+        ss.sessions.add(session)
+        response.status_code = 201
+        return response
+
+
+@api.route('/sessions/<string:session_id>', methods=['GET', 'PATCH', 'DELETE'])
+@api.doc(responses={200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+                    500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint reads, updates and ends a diagnosis session started '
+                     'with /diagnosis/sessions. A PATCH request records the values of one or more signs and returns '
+                     'the updated results. Only the signs whose values changed are applied, so an update costs the '
+                     'same however many signs have been recorded. A GET request returns the signs recorded so far '
+                     'and the results, and a DELETE request ends the session.</p>')
+class DiagnosisSession(metrics.InstrumentedResource):
+    """
+    This class is used to create the endpoint of a single diagnosis session.
+    """
+
+    @staticmethod
+    def get(session_id):
+        session = ss.sessions.get(session_id)
+        if session is None:
+            return _unknown_session()
+        metrics.set_animal(session.model.name)
+        with session.lock:
+            return _session_response(session, include_signs=True)
+
+    @staticmethod
+    @api.expect(session_update_model, validate=True)
+    def patch(session_id):
+        session = ss.sessions.get(session_id)
+        if session is None:
+            return _unknown_session()
+        metrics.set_animal(session.model.name)
+
+        with metrics.timed('validate'):
+            signs = dh.validate_sign_updates(request.get_json()['signs'], session.model.sign_set, session.model.name)
+        with session.lock:
+            with metrics.timed('calculate'):
+                session.update(signs)
+            return _session_response(session)
+
+    @staticmethod
+    def delete(session_id):
+        if not ss.sessions.remove(session_id):
+            return _unknown_session()
+        return '', 204
+
+
+def _unknown_session():
+    return {'error': 'Unknown session_id. The session may have expired, please start a new one with '
+                     '/diagnosis/sessions.', 'status': 404}, 404
+
+
+def _session_response(session, include_signs=False):
+    """
+    Build the response of the session endpoints from the session's running log posteriors
+    :param session: The DiagnosisSession
+    :param include_signs: Whether to include the values of the signs recorded so far
+    :return: A JSON response with the session id, the animal and the normalised results for each disease
+    """
+    with metrics.timed('normalise'):
+        results = dict(zip(session.model.diseases, dh.log_normalise(session.scores).tolist()))
+    with metrics.timed('serialise'):
+        response = {'session_id': session.id, 'animal': session.model.name, 'results': results}
+        if include_signs:
+            response['signs'] = session.signs()
+        return cn.jsonify(response)
+
+
+next_sign_payload_model = api.model('Next Sign', {
+    'animal': fields.String(required=True, description='The species of animal', example='Cattle'),
+    'signs': fields.Raw(required=False, description='The signs observed so far, formatted as in /diagnose. Signs '
+                                                    'which are left out or are 0 are treated as not yet observed',
+                        example={"Anrx": 1, "Lymph": -1}),
+    'priors': fields.Raw(required=False, description='The optional priors, formatted as in /diagnose'),
+    'top_k': fields.Integer(required=False, min=1, description='Return only this many signs')})
+
+
+@api.route('/next_sign', methods=['POST'])
+@api.doc(responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint recommends which sign to check next for a partially '
+                     'observed case. For every sign which has not been observed yet, it calculates the expected '
+                     'information gain of observing it: how much, in bits, knowing whether the sign is present is '
+                     'expected to reduce the uncertainty (entropy) of the diagnosis. The signs are returned with the '
+                     'most informative first, along with the entropy of the current results.</p>')
+class NextSign(metrics.InstrumentedResource):
+    """
+    This class is used to create the next_sign endpoint, which ranks the unobserved signs by expected information
+    gain.
+    """
+
+    @staticmethod
+    @api.expect(next_sign_payload_model, validate=True)
+    def post():
+        data = request.get_json()
+        animal = dh.validate_animal(data['animal'])
+        if animal is False:
+            return {'error': 'Invalid animal. Please use a valid animal '
+                             'from /data/valid_animals.', 'status': 404}, 404
+
+        model = dh.get_model(animal)
+        metrics.set_animal(animal)
+
+        with metrics.timed('validate'):
+            signs = dh.validate_sign_updates(data.get('signs') or {}, model.sign_set, animal)
+            if data.get('priors') is not None:
+                if not isinstance(data['priors'], dict):
+                    raise BadRequest('Priors must be a JSON object mapping each disease to its prior.')
+                priors = model.validator.priors(data['priors'])
+            else:
+                priors = model.default_priors
+            top_k, _ = dh.validate_ranking(data.get('top_k'), None)
+
+        with metrics.timed('calculate'):
+            scores = model.matrix.scores(signs, priors)
+        unobserved = [model.sign_index[sign] for sign in model.signs if not signs.get(sign)]
+        return _next_sign_response(model, scores, unobserved, top_k)
+
+
+@api.route('/sessions/<string:session_id>/next_sign')
+@api.doc(responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'},
+         params={'top_k': 'Return only this many signs'},
+         description='<h1>Description</h1><p>This endpoint recommends which sign to check next for a diagnosis '
+                     'session, formatted as in /diagnosis/next_sign. Only the signs which are 0 in the session are '
+                     'ranked.</p>')
+class SessionNextSign(metrics.InstrumentedResource):
+    """
+    This class is used to create the next_sign endpoint of a diagnosis session.
+    """
+
+    @staticmethod
+    def get(session_id):
+        session = ss.sessions.get(session_id)
+        if session is None:
+            return _unknown_session()
+        metrics.set_animal(session.model.name)
+
+        top_k = request.args.get('top_k')
+        if top_k is not None:
+            try:
+                top_k = int(top_k)
+            except ValueError:
+                raise BadRequest(f"Invalid top_k: {top_k}. top_k must be a positive integer.")
+        dh.validate_ranking(top_k, None)
+
+        with session.lock:
+            scores = session.scores.copy()
+            unobserved = np.flatnonzero(session.sign_values == 0)
+        return _next_sign_response(session.model, scores, unobserved, top_k)
+
+
+def _next_sign_response(model, scores, unobserved, top_k):
+    """
+    Build the response of the next_sign endpoints
+    :param model: The AnimalModel of the animal being diagnosed
+    :param scores: A vector of unnormalised log posteriors for the evidence so far
+    :param unobserved: The indexes of the signs which have not been observed
+    :param top_k: The number of signs to return, or None to return every unobserved sign
+    :return: A JSON response with the entropy of the current results and the ranked signs
+    """
+    with metrics.timed('calculate'):
+        gains = dh.information_gain(model.matrix, scores)
+        posteriors = dh.log_normalise(scores) / 100
+        entropy = float(-np.sum(posteriors[posteriors > 0] * np.log2(posteriors[posteriors > 0])))
+        unobserved = np.asarray(unobserved, dtype=np.intp)
+        ranked = dh.rank_posteriors([model.signs[i] for i in unobserved], gains[unobserved], top_k)
+    with metrics.timed('serialise'):
+        return cn.jsonify({'entropy': entropy,
+                           'signs': [{'sign': sign, 'name': model.sign_names_and_codes.get(sign, {}).get('name'),
+                                      'information_gain': gain} for sign, gain in ranked]})
+
+
+class PositionalSigns(fields.Raw):
+    """
+    The signs of the compact diagnosis mode, which may be either a string or a list
+    """
+    __schema_type__ = ['string', 'array']
+
+
+diagnosis_compact_payload_model = api.model('Diagnose Compact', {
+    'animal': fields.String(required=True, description='The species of animal', example='Cattle'),
+    'dataset_version': fields.String(required=True, description='The dataset version returned by '
+                                                                '/data/canonical_order/\'animal\' with the order the '
+                                                                'signs are given in', example='6e5e89dc238b8221'),
+    'signs': PositionalSigns(required=True,
+                             description='The signs in the order of /data/canonical_order/\'animal\', either as a '
+                                         'string with one character per sign, "+" for present, "0" for not observed '
+                                         'and "-" for not present, or as a list of 1, 0 or -1 for each sign',
+                             example='0+000+0-0000+00'),
+    'priors': fields.List(fields.Float, required=False, description='The optional priors in the order of the '
+                                                                    'diseases of /data/canonical_order/\'animal\', '
+                                                                    'which must add up to 100')})
+
+
+@api.route('/diagnose_compact', methods=['POST'])
+@api.doc(responses={200: 'OK', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 500: 'Internal Server Error'},
+         description='<h1>Description</h1><p>This endpoint is a compact form of /diagnosis/diagnose for '
+                     'low-bandwidth clients. Rather than naming every sign, the signs are sent by position in the '
+                     'canonical order returned by /data/canonical_order/\'animal\', and the results are returned as '
+                     'a list in the canonical order of the diseases, without the WikiData IDs.</p>\n \n<p>The '
+                     'request must include the dataset version the order was fetched with. If the data has been '
+                     'updated since, the order may have changed, so the endpoint returns 409 along with the current '
+                     'dataset version and the order must be fetched again.</p>')
+class DiagnoseCompact(metrics.InstrumentedResource):
+    """
+    This class is used to create the diagnose_compact endpoint, which takes positional signs and returns positional
+    results.
+    """
+
+    @staticmethod
+    @api.expect(diagnosis_compact_payload_model, validate=True)
+    def post():
+        data = request.get_json()
+        animal = dh.validate_animal(data['animal'])
+        if animal is False:
+            return {'error': 'Invalid animal. Please use a valid animal '
+                             'from /data/valid_animals.', 'status': 404}, 404
+
+        model = dh.get_model(animal)
+        metrics.set_animal(animal)
+
+        dataset_version = dh.get_dataset_version()
+        if data['dataset_version'] != dataset_version:
+            return {'error': f'The dataset has been updated. Please fetch /data/canonical_order/{animal} again.',
+                    'dataset_version': dataset_version, 'status': 409}, 409
 
-        results = dh.calculate_results(diseases, likelihoods, shown_signs, priors)
-        normalised_results = dh.normalise(results)
+        with metrics.timed('validate'):
+            values = dh.parse_positional_signs(data['signs'], len(model.signs), animal)
+            if data.get('priors') is not None:
+                if len(data['priors']) != len(model.diseases):
+                    raise BadRequest(f"Expected {len(model.diseases)} priors in the order of "
+                                     f"/data/canonical_order/{animal}, got {len(data['priors'])}.")
+                priors = dh.validate_priors(dict(zip(model.diseases, data['priors'])), model.diseases,
+                                            model.disease_set)
+                log_priors = model.matrix.log_priors(priors)
+            else:
+                log_priors = model.default_log_priors
 
-        return jsonify({'results': normalised_results})
+        with metrics.timed('calculate'):
+            scores = model.matrix.log_table @ model.matrix.positional_evidence(values) + log_priors
+        with metrics.timed('normalise'):
+            results = dh.log_normalise(scores)
+        with metrics.timed('serialise'):
+            return cn.jsonify({'dataset_version': dataset_version, 'results': results.tolist()})
@@ -2,34 +2,192 @@
 A helper file used to perform the calculations and get the data for the diagnosis_controller.py file.
 """
 
+import collections.abc
+import contextvars
+import hashlib
 import json
 import os
 import sys
+import threading
+import time
 
+import numpy as np
 from werkzeug.exceptions import BadRequest
 
-# Load pre-converted JSON data (generated by convert_xlsx_to_json.py)
-with open(os.path.join(sys.path[0], "data.json")) as f:
-    _data = json.load(f)
+import metrics
+import model_bundle
+import worker_sync
 
+# The engine used by calculate_posteriors. 'numpy' is the vectorised log-space engine, 'dict' is the original
+# implementation (calculate_results followed by normalise) which is kept as a reference.
+ENGINES = ('numpy', 'dict')
+DEFAULT_ENGINE = os.environ.get('DIAGNOSIS_ENGINE', 'numpy')
 
-def validate_priors(priors, diseases):
+
+class LikelihoodMatrix:
+    """
+    A dense disease x sign likelihood table used by the numpy engine. log(L) and log(1 - L) are precomputed once and
+    stored side by side, so scoring a case is a single matrix-vector product.
+    """
+
+    def __init__(self, diseases, signs, likelihoods):
+        """
+        :param diseases: A list of the diseases, in the order of the rows of the matrix
+        :param signs: A list of the signs, in the order of the columns of the matrix
+        :param likelihoods: A dictionary of likelihoods for each disease, where the key is the disease and the value
+        is a dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
+        """
+        self.diseases = list(diseases)
+        self.signs = list(signs)
+        self.sign_index = {sign: i for i, sign in enumerate(self.signs)}
+        self._sign_entropy = None
+        if likelihoods is not None:
+            self.values = np.array([[likelihoods[disease][sign] for sign in self.signs] for disease in self.diseases],
+                                   dtype=np.float64).reshape(len(self.diseases), len(self.signs))
+            self.log_table = self.compute_log_table(self.values)
+
+    @staticmethod
+    def compute_log_table(values):
+        """
+        :param values: An n_diseases x n_signs array of likelihoods
+        :return: An n_diseases x (2 * n_signs) array where columns [0, n_signs) score a present sign and
+        [n_signs, 2 * n_signs) score an absent sign
+        """
+        with np.errstate(divide='ignore'):
+            return np.hstack([np.log(values), np.log1p(-values)])
+
+    @classmethod
+    def from_arrays(cls, diseases, signs, values, log_table):
+        """
+        Create a matrix from precomputed arrays, such as the read-only arrays mapped from the binary model bundle
+        :param diseases: A list of the diseases, in the order of the rows of the matrix
+        :param signs: A list of the signs, in the order of the columns of the matrix
+        :param values: An n_diseases x n_signs array of likelihoods
+        :param log_table: An n_diseases x (2 * n_signs) array of log(L) followed by log(1 - L)
+        :return: The LikelihoodMatrix, which uses the arrays without copying them
+        """
+        matrix = cls(diseases, signs, None)
+        matrix.values = values
+        matrix.log_table = log_table
+        return matrix
+
+    @property
+    def likelihoods(self):
+        """
+        The likelihoods as a dictionary, rebuilt from the matrix so the caller's dictionary is not kept alive
+        :return: A dictionary of likelihoods for each disease, where the key is the disease and the value is a
+        dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
+        """
+        return {disease: dict(zip(self.signs, row)) for disease, row in zip(self.diseases, self.values.tolist())}
+
+    @property
+    def sign_entropy(self):
+        """
+        The entropy in bits of whether each sign is present, given each disease, computed from the precomputed logs on
+        first use and kept, as it is used by every next-best-sign recommendation
+        :return: An n_diseases x n_signs array of -(L log L + (1 - L) log(1 - L)) / log 2
+        """
+        if self._sign_entropy is None:
+            n_signs = len(self.signs)
+            values = np.asarray(self.values, dtype=np.float64)
+            self._sign_entropy = -(values * self.log_table[:, :n_signs] +
+                                   (1 - values) * self.log_table[:, n_signs:]) / np.log(2)
+        return self._sign_entropy
+
+    @property
+    def nbytes(self):
+        """
+        :return: An estimate of the memory used by the matrix, in bytes
+        """
+        names = sum(sys.getsizeof(name) for name in self.diseases) + sum(sys.getsizeof(name) for name in self.signs)
+        return self.values.nbytes + self.log_table.nbytes + 2 * names
+
+    def evidence(self, shown_signs):
+        """
+        Convert the shown signs into the evidence vector that log_table is multiplied by
+        :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the
+        presence
+        :return: A vector of length 2 * n_signs with a 1 in the present column or the absent column of each sign
+        """
+        n_signs = len(self.signs)
+        evidence = np.zeros(2 * n_signs, dtype=np.float64)
+        for sign, presence in shown_signs.items():
+            index = self.sign_index.get(sign)
+            if index is None:
+                raise BadRequest(f"Sign '{sign}' in 'shown_signs' is not a valid sign.")
+            if presence == 1:
+                evidence[index] = 1.0
+            elif presence == -1:
+                evidence[n_signs + index] = 1.0
+        return evidence
+
+    def positional_evidence(self, values):
+        """
+        Convert a vector of sign values in the order of the columns of the matrix into an evidence vector
+        :param values: A vector of -1, 0 or 1 for each sign, as returned by parse_positional_signs
+        :return: A vector of length 2 * n_signs, as returned by evidence()
+        """
+        return np.concatenate((values == 1, values == -1)).astype(np.float64)
+
+    def log_priors(self, priors):
+        """
+        :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
+        :return: A vector of log priors aligned to the rows of the matrix, in which a negative prior is NaN
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(np.array([priors[disease] for disease in self.diseases], dtype=np.float64))
+
+    def posteriors(self, shown_signs, priors):
+        """
+        Calculate the normalised posterior of every disease in log space, so long sign vectors cannot underflow
+        :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the
+        presence
+        :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
+        :return: A vector of posteriors aligned to the rows of the matrix which add up to 100
+        """
+        return log_normalise(self.scores(shown_signs, priors))
+
+    def scores(self, shown_signs, priors):
+        """
+        Calculate the unnormalised log posterior of every disease
+        :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the
+        presence
+        :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
+        :return: A vector of log posteriors aligned to the rows of the matrix
+        """
+        return self.log_table @ self.evidence(shown_signs) + self.log_priors(priors)
+
+    def batch_posteriors(self, evidence, log_priors):
+        """
+        Calculate the normalised posteriors of many cases at once as a single matrix product
+        :param evidence: An n_cases x (2 * n_signs) array of evidence vectors, as returned by evidence()
+        :param log_priors: An n_cases x n_diseases array of log priors, or a single vector shared by every case
+        :return: An n_cases x n_diseases array of posteriors where each row adds up to 100
+        """
+        scores = evidence @ self.log_table.T + log_priors
+        return log_normalise(scores)
+
+
+def validate_priors(priors, diseases, disease_set=None):
     """
     A function used to validate the priors provided by the user
     :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
     :param diseases: A list of the diseases that are valid for the animal
+    :param disease_set: An optional precomputed set of the diseases, such as AnimalModel.disease_set
     :return: The priors dictionary if it is valid, otherwise a BadRequest exception is raised
     """
-    provided_keys = []
+    if disease_set is None:
+        disease_set = frozenset(diseases)
+
     for key in priors.keys():
-        if key not in diseases:
-            raise BadRequest(f"Disease '{key}' is not a valid disease. Please use a valid disease from {diseases}.")
-        provided_keys.append(key)
+        if key not in disease_set:
+            raise BadRequest(f"Disease '{key}' is not a valid disease. Please use a valid disease from "
+                             f"{list(diseases)}.")
 
-    for disease in diseases:
-        if disease not in provided_keys:
-            raise BadRequest(
-                f"Missing '{disease}' in priors. Please provide a prior likelihood value for all diseases.")
+    # Every provided key is valid, so a disease can only be missing if fewer keys were provided
+    if len(priors) != len(disease_set):
+        missing = next(disease for disease in diseases if disease not in priors)
+        raise BadRequest(f"Missing '{missing}' in priors. Please provide a prior likelihood value for all diseases.")
 
     total_value = sum(priors.values())
     if total_value != 100:
@@ -38,39 +196,42 @@ def validate_priors(priors, diseases):
     return priors
 
 
-def validate_likelihoods(likelihoods, diseases, signs):
+def validate_likelihoods(likelihoods, diseases, signs, disease_set=None, sign_set=None):
     """
     A function used to validate the likelihoods provided by the user
     :param likelihoods: A dictionary of likelihoods for each disease, where the key is the disease and the value is a
     dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
     :param diseases: A list of the diseases that are valid for the animal
     :param signs: A list of the signs that are valid for the animal
+    :param disease_set: An optional precomputed set of the diseases, such as AnimalModel.disease_set
+    :param sign_set: An optional precomputed set of the signs, such as AnimalModel.sign_set
     :return: A dictionary of likelihoods for each disease, where the key is the disease and the value is a
     """
-    provided_keys = []
+    if disease_set is None:
+        disease_set = frozenset(diseases)
+    if sign_set is None:
+        sign_set = frozenset(signs)
+
     for key in likelihoods.keys():
-        if key not in diseases:
+        if key not in disease_set:
             raise BadRequest(f"Disease '{key}' in \'likelihoods\' is not a valid disease.")
-        provided_keys.append(key)
 
-    for disease in diseases:
-        if disease not in provided_keys:
-            raise BadRequest(f"Missing '{disease}' in likelihoods. Please provide a likelihood value for all diseases.")
+    if len(likelihoods) != len(disease_set):
+        missing = next(disease for disease in diseases if disease not in likelihoods)
+        raise BadRequest(f"Missing '{missing}' in likelihoods. Please provide a likelihood value for all diseases.")
 
     for disease in likelihoods:
         current_likelihoods = likelihoods[disease]
-        provided_keys = []
         for key in current_likelihoods.keys():
-            if key not in signs:
+            if key not in sign_set:
                 raise BadRequest(f"Sign '{key}' in {disease} within \'likelihoods\' is not a valid sign. "
-                                 f"Please use a valid signs from {signs}.")
-            provided_keys.append(key)
+                                 f"Please use a valid signs from {list(signs)}.")
 
-        for sign in signs:
-            if sign not in provided_keys:
-                raise BadRequest(
-                    f"Missing '{sign}' in likelihoods for disease '{disease}'. Please provide a likelihood value "
-                    f"for all signs.")
+        if len(current_likelihoods) != len(sign_set):
+            missing = next(sign for sign in signs if sign not in current_likelihoods)
+            raise BadRequest(
+                f"Missing '{missing}' in likelihoods for disease '{disease}'. Please provide a likelihood value "
+                f"for all signs.")
 
         for sign in current_likelihoods:
             if (not current_likelihoods[sign] > 0) or (current_likelihoods[sign] >= 1):
@@ -122,6 +283,192 @@ def normalise(results):
     return normalised_results
 
 
+def log_normalise(scores):
+    """
+    A function used to normalise log posterior scores with the log-sum-exp trick
+    :param scores: A vector of unnormalised log posteriors, or a 2D array with one case per row
+    :return: An array of the same shape where each vector of posteriors adds up to 100, which is empty if there are
+    no diseases
+    """
+    if np.shape(scores)[-1] == 0:
+        return np.empty(np.shape(scores))
+    peak = np.max(scores, axis=-1, keepdims=True)
+    if not np.all(np.isfinite(peak)):
+        raise BadRequest("The priors and likelihoods give every disease a probability of 0.")
+    weights = np.exp(scores - peak)
+    return weights * (100 / weights.sum(axis=-1, keepdims=True))
+
+
+def validate_shown_signs(shown_signs, valid_signs, animal):
+    """
+    A function used to validate the signs provided by the user for one of the built-in animals
+    :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the presence
+    :param valid_signs: A set of the signs that are valid for the animal, such as AnimalModel.sign_set
+    :param animal: The animal that is being diagnosed
+    :return: The shown_signs dictionary if it is valid, otherwise a BadRequest exception is raised
+    """
+    if shown_signs.keys() != valid_signs:
+        raise BadRequest(f'Invalid signs: {list(shown_signs.keys() - valid_signs)}. '
+                         f'Please use valid sign from /data/valid_signs/{animal}.')
+
+    for sign, value in shown_signs.items():
+        if value not in (0, 1, -1):
+            raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+
+    return shown_signs
+
+
+def validate_sign_updates(signs, valid_signs, animal):
+    """
+    A function used to validate some of the signs of one of the built-in animals, such as the signs recorded in one
+    update of a diagnosis session
+    :param signs: A dictionary of signs, where the key is the sign and the value is the presence
+    :param valid_signs: A set of the signs that are valid for the animal, such as AnimalModel.sign_set
+    :param animal: The animal that is being diagnosed
+    :return: The signs dictionary if it is valid, otherwise a BadRequest exception is raised
+    """
+    if not isinstance(signs, dict):
+        raise BadRequest(f'Invalid signs: {signs}. The signs must be an object mapping each sign to -1, 0 or 1.')
+    if not signs.keys() <= valid_signs:
+        raise BadRequest(f'Invalid signs: {list(signs.keys() - valid_signs)}. '
+                         f'Please use valid sign from /data/valid_signs/{animal}.')
+
+    for sign, value in signs.items():
+        if isinstance(value, bool) or value not in (0, 1, -1):
+            raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+
+    return signs
+
+
+# The characters of a positional sign string, see parse_positional_signs
+POSITIONAL_SIGN_CHARACTERS = {'-': -1, '0': 0, '+': 1}
+_positional_lookup = np.full(256, -2, dtype=np.int8)
+for _character, _value in POSITIONAL_SIGN_CHARACTERS.items():
+    _positional_lookup[ord(_character)] = _value
+
+
+def parse_positional_signs(signs, n_signs, animal):
+    """
+    A function used to parse the signs of the compact diagnosis mode, which are given by position in the canonical
+    sign order of the animal rather than by name
+    :param signs: Either a string with one character per sign, '+' for present, '0' for not observed and '-' for not
+    present, or a list of -1, 0 or 1 for each sign
+    :param n_signs: The number of signs of the animal
+    :param animal: The animal that is being diagnosed
+    :return: A vector of -1, 0 or 1 for each sign, otherwise a BadRequest exception is raised
+    """
+    if isinstance(signs, str):
+        if len(signs) != n_signs:
+            raise BadRequest(f'Expected a string of {n_signs} signs in the order of /data/canonical_order/{animal}, '
+                             f'got {len(signs)} characters.')
+        # Characters outside latin-1 cannot be valid, replace them so they are reported below
+        values = _positional_lookup[np.frombuffer(signs.encode('latin-1', 'replace'), dtype=np.uint8)]
+        if (values == -2).any():
+            position = int(np.argmax(values == -2))
+            raise BadRequest(f"Error with sign {position}: '{signs[position]}'. Sign characters must be either "
+                             f"'+', '0' or '-'.")
+        return values
+    if isinstance(signs, list):
+        if len(signs) != n_signs:
+            raise BadRequest(f'Expected a list of {n_signs} signs in the order of /data/canonical_order/{animal}, '
+                             f'got {len(signs)}.')
+        for position, value in enumerate(signs):
+            if isinstance(value, bool) or value not in (0, 1, -1):
+                raise BadRequest(f'Error with sign {position}: {value}. Sign values must be either -1, 0 or 1')
+        return np.array(signs, dtype=np.int8)
+    raise BadRequest(f'The signs must be a string or a list in the order of /data/canonical_order/{animal}.')
+
+
+def calculate_posteriors(matrix, shown_signs, priors, engine=None):
+    """
+    A function used to calculate the normalised results of the Bayes Theorem with the selected engine
+    :param matrix: A LikelihoodMatrix holding the diseases, signs and likelihoods being used
+    :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the presence
+    :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
+    :param engine: The engine to use, one of ENGINES. Defaults to DEFAULT_ENGINE
+    :return: A dictionary of normalised results for each disease, where the key is the disease and the value is the
+    normalised result
+    """
+    return dict(zip(matrix.diseases, calculate_posterior_vector(matrix, shown_signs, priors, engine).tolist()))
+
+
+def calculate_posterior_vector(matrix, shown_signs, priors, engine=None):
+    """
+    A function used to calculate the normalised results of the Bayes Theorem as a vector, see calculate_posteriors
+    :return: A vector of normalised results aligned to matrix.diseases
+    """
+    engine = engine or DEFAULT_ENGINE
+    if engine == 'dict':
+        with metrics.timed('calculate'):
+            results = calculate_results(matrix.diseases, matrix.likelihoods, shown_signs, priors)
+        with metrics.timed('normalise'):
+            results = normalise(results)
+            return np.fromiter((results[disease] for disease in matrix.diseases), float, len(matrix.diseases))
+    if engine != 'numpy':
+        raise ValueError(f"Unknown engine '{engine}'. Please use one of {list(ENGINES)}.")
+    with metrics.timed('calculate'):
+        scores = matrix.scores(shown_signs, priors)
+    with metrics.timed('normalise'):
+        return log_normalise(scores)
+
+
+def information_gain(matrix, scores):
+    """
+    A function used to calculate the expected information gain of observing each sign, which is the expected
+    reduction in the entropy of the posteriors once it is known whether the sign is present. For a sign with
+    likelihoods L and posteriors p this is the mutual information H(p . L) - sum_d p_d H(L_d), where H is the binary
+    entropy, so every sign is evaluated at once with two vector-matrix products.
+    :param matrix: A LikelihoodMatrix holding the diseases, signs and likelihoods being used
+    :param scores: A vector of unnormalised log posteriors for the evidence so far, aligned to matrix.diseases
+    :return: A vector of the expected information gain in bits of each sign, aligned to matrix.signs
+    """
+    posteriors = log_normalise(scores) / 100
+    present = np.clip(posteriors @ matrix.values, 1e-300, 1 - 1e-16)
+    outcome_entropy = -(present * np.log2(present) + (1 - present) * np.log2(1 - present))
+    return np.maximum(outcome_entropy - posteriors @ matrix.sign_entropy, 0)
+
+
+def validate_ranking(top_k, min_probability):
+    """
+    A function used to validate the top_k and min_probability options of the diagnosis endpoints
+    :param top_k: The number of most likely diseases to return, or None
+    :param min_probability: The smallest normalised result to return, between 0 and 100, or None
+    :return: A tuple of top_k and min_probability if they are valid, otherwise a BadRequest exception is raised
+    """
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1):
+        raise BadRequest(f"Invalid top_k: {top_k}. top_k must be a positive integer.")
+    if min_probability is not None and (isinstance(min_probability, bool) or
+                                        not isinstance(min_probability, (int, float)) or
+                                        not 0 <= min_probability <= 100):
+        raise BadRequest(f"Invalid min_probability: {min_probability}. min_probability must be a number between 0 "
+                         f"and 100.")
+    return top_k, min_probability
+
+
+def rank_posteriors(diseases, posteriors, top_k=None, min_probability=None):
+    """
+    A function used to select the most likely diseases without sorting every result. The diseases below
+    min_probability are dropped, the top_k of the rest are found with a partial selection, and only those are
+    sorted.
+    :param diseases: The diseases the posteriors are aligned to
+    :param posteriors: A vector of normalised results, as returned by calculate_posterior_vector
+    :param top_k: The number of diseases to return, or None to return every disease above min_probability
+    :param min_probability: The smallest normalised result to return, or None
+    :return: A list of (disease, result) tuples, most likely first. Ties are ordered as in diseases.
+    """
+    if min_probability is None:
+        candidates = np.arange(len(posteriors))
+    else:
+        candidates = np.flatnonzero(posteriors >= min_probability)
+    if top_k is not None and top_k < len(candidates):
+        values = posteriors[candidates]
+        # The k-th largest result, found in linear time. Diseases tied with it are taken in order until k are chosen
+        kth = -np.partition(-values, top_k - 1)[top_k - 1]
+        above = candidates[values > kth]
+        candidates = np.concatenate((above, candidates[values == kth][:top_k - len(above)]))
+    order = candidates[np.argsort(-posteriors[candidates], kind='stable')]
+    return [(diseases[i], float(posteriors[i])) for i in order]
+
 
 def get_default_priors(diseases):
     """
@@ -135,12 +482,536 @@ def get_default_priors(diseases):
     return priors
 
 
+class DiagnosisValidator:
+    """
+    Validates the signs, priors and likelihoods of a /diagnosis/diagnose payload for one animal. The indexes and error
+    messages of the animal are compiled once, each part of the payload is checked in a single pass, and the errors
+    are those of validate_shown_signs, validate_priors and validate_likelihoods.
+    """
+
+    __slots__ = ('name', 'diseases', 'signs', 'disease_index', 'sign_index', 'sign_set', 'invalid_sign_hint',
+                 'invalid_disease_hint')
+
+    def __init__(self, name, matrix):
+        """
+        :param name: The name of the animal
+        :param matrix: The LikelihoodMatrix of the animal
+        """
+        self.name = name
+        self.diseases = tuple(matrix.diseases)
+        self.signs = tuple(matrix.signs)
+        self.disease_index = {disease: i for i, disease in enumerate(self.diseases)}
+        self.sign_index = matrix.sign_index
+        self.sign_set = frozenset(self.signs)
+        self.invalid_sign_hint = f'Please use valid sign from /data/valid_signs/{name}.'
+        self.invalid_disease_hint = f'Please use a valid disease from {list(self.diseases)}.'
+
+    def shown_signs(self, shown_signs):
+        """
+        :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is the
+        presence
+        :return: The shown_signs dictionary if it is valid, otherwise a BadRequest exception is raised
+        """
+        if shown_signs.keys() != self.sign_set:
+            raise BadRequest(f'Invalid signs: {list(shown_signs.keys() - self.sign_set)}. {self.invalid_sign_hint}')
+        for sign, value in shown_signs.items():
+            if value not in (0, 1, -1):
+                raise BadRequest(f'Error with value of {sign}: {value}. Sign values must be either -1, 0 or 1')
+        return shown_signs
+
+    def priors(self, priors):
+        """
+        :param priors: A dictionary of priors for each disease, where the key is the disease and the value is the prior
+        :return: The priors dictionary if it is valid, otherwise a BadRequest exception is raised
+        """
+        total_value = 0
+        invalid_value = None
+        for disease, value in priors.items():
+            if disease not in self.disease_index:
+                raise BadRequest(f"Disease '{disease}' is not a valid disease. {self.invalid_disease_hint}")
+            if invalid_value is None:
+                try:
+                    total_value += value
+                except TypeError:
+                    invalid_value = disease
+        if len(priors) != len(self.diseases):
+            missing = next(disease for disease in self.diseases if disease not in priors)
+            raise BadRequest(f"Missing '{missing}' in priors. Please provide a prior likelihood value for all "
+                             f"diseases.")
+        if invalid_value is not None:
+            raise BadRequest(f"Prior for disease '{invalid_value}' is not a valid value. Please use a number.")
+        if total_value != 100:
+            raise BadRequest(f"Priors must add up to 100. Currently they add up to {total_value}.")
+        return priors
+
+    def likelihoods(self, likelihoods):
+        """
+        Validate the likelihoods and pack them into the array of a LikelihoodMatrix. A valid table is packed row by
+        row and its values are range checked as one array; the cells are only checked one at a time to find the
+        error in a table which fails.
+        :param likelihoods: A dictionary of likelihoods for each disease, where the key is the disease and the value
+        is a dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
+        :return: The LikelihoodMatrix if the likelihoods are valid, otherwise a BadRequest exception is raised
+        """
+        for disease in likelihoods:
+            if disease not in self.disease_index:
+                raise BadRequest(f"Disease '{disease}' in \'likelihoods\' is not a valid disease.")
+        if len(likelihoods) != len(self.diseases):
+            missing = next(disease for disease in self.diseases if disease not in likelihoods)
+            raise BadRequest(f"Missing '{missing}' in likelihoods. Please provide a likelihood value for all "
+                             f"diseases.")
+
+        rows = []
+        for disease in self.diseases:
+            row = likelihoods[disease]
+            if not isinstance(row, dict) or row.keys() != self.sign_set:
+                break
+            rows.append([row[sign] for sign in self.signs])
+        else:
+            try:
+                values = np.array(rows)
+            except (ValueError, TypeError):
+                # A mix of numbers and lists can not be made into an array
+                values = None
+            # Booleans, strings and nulls give an array of another kind, and lists give an array of another shape
+            if (values is not None and values.shape == (len(self.diseases), len(self.signs)) and
+                    values.dtype.kind in 'fi' and ((values > 0) & (values < 1)).all()):
+                values = values.astype(np.float64, copy=False)
+                return LikelihoodMatrix.from_arrays(self.diseases, self.signs, values,
+                                                    LikelihoodMatrix.compute_log_table(values))
+        return self._check_likelihood_cells(likelihoods)
+
+    def _check_likelihood_cells(self, likelihoods):
+        # Check the likelihoods one cell at a time, in the order of the payload, so the first error is reported
+        values = np.empty((len(self.diseases), len(self.signs)), dtype=np.float64)
+        for disease, row in likelihoods.items():
+            if not isinstance(row, dict):
+                raise BadRequest(f"Likelihoods for disease '{disease}' must be an object mapping each sign to a "
+                                 f"likelihood.")
+            row_values = values[self.disease_index[disease]]
+            invalid_value = None
+            for sign, value in row.items():
+                index = self.sign_index.get(sign)
+                if index is None:
+                    raise BadRequest(f"Sign '{sign}' in {disease} within \'likelihoods\' is not a valid sign. "
+                                     f"Please use a valid signs from {list(self.signs)}.")
+                try:
+                    valid = 0 < value < 1
+                except TypeError:
+                    valid = False
+                if valid:
+                    row_values[index] = value
+                elif invalid_value is None:
+                    invalid_value = sign
+            if len(row) != len(self.signs):
+                missing = next(sign for sign in self.signs if sign not in row)
+                raise BadRequest(f"Missing '{missing}' in likelihoods for disease '{disease}'. Please provide a "
+                                 f"likelihood value for all signs.")
+            if invalid_value is not None:
+                raise BadRequest(f"Likelihood for sign '{invalid_value}' in disease '{disease}' is not a valid value. "
+                                 f"Please use a value greater than 0 and less than 1.")
+
+        return LikelihoodMatrix.from_arrays(self.diseases, self.signs, values,
+                                            LikelihoodMatrix.compute_log_table(values))
+
+
+class AnimalModel:
+    """
+    The data for one animal, compiled once at load into the indexes and precomputed values used on every request.
+    Instances are immutable so they can be shared freely between requests.
+    """
+
+    __slots__ = ('name', 'diseases', 'signs', 'disease_index', 'sign_index', 'disease_set', 'sign_set',
+                 'default_priors', 'default_log_priors', 'matrix', 'disease_wiki_ids', 'disease_wiki_ids_json',
+                 'sign_names_and_codes', 'validator')
+
+    def __init__(self, name, matrix, disease_wiki_ids, sign_names_and_codes):
+        """
+        :param name: The name of the animal
+        :param matrix: The LikelihoodMatrix of the animal
+        :param disease_wiki_ids: A dictionary of WikiData IDs for each disease
+        :param sign_names_and_codes: A dictionary of the full name and WikiData code for each sign
+        """
+        default_priors = get_default_priors(matrix.diseases)
+        fields = {
+            'name': name,
+            'diseases': tuple(matrix.diseases),
+            'signs': tuple(matrix.signs),
+            'disease_index': {disease: i for i, disease in enumerate(matrix.diseases)},
+            'sign_index': matrix.sign_index,
+            'disease_set': frozenset(matrix.diseases),
+            'sign_set': frozenset(matrix.signs),
+            'default_priors': default_priors,
+            'default_log_priors': matrix.log_priors(default_priors),
+            'matrix': matrix,
+            'disease_wiki_ids': disease_wiki_ids,
+            'disease_wiki_ids_json': json.dumps(disease_wiki_ids, sort_keys=True, separators=(',', ':')),
+            'sign_names_and_codes': sign_names_and_codes,
+            'validator': DiagnosisValidator(name, matrix),
+        }
+        for key, value in fields.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"AnimalModel is immutable, cannot set '{key}'.")
+
+
+class LazyModels(collections.abc.Mapping):
+    """
+    A read-only mapping of animal to AnimalModel which compiles each model the first time it is looked up, so
+    starting the server does not pay for animals which are never used
+    """
+
+    def __init__(self, builders):
+        """
+        :param builders: A dictionary of functions which each build the AnimalModel of an animal, keyed by the animal
+        """
+        self._builders = builders
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, animal):
+        model = self._models.get(animal)
+        if model is None:
+            builder = self._builders[animal]
+            with self._lock:
+                model = self._models.get(animal)
+                if model is None:
+                    model = self._models[animal] = builder()
+        return model
+
+    def __iter__(self):
+        return iter(self._builders)
+
+    def __len__(self):
+        return len(self._builders)
+
+    def __contains__(self, animal):
+        return animal in self._builders
+
+
+def load_models(directory):
+    """
+    A function used to load the model data generated by convert_xlsx_to_json.py. The memory-mapped binary bundle
+    (data.bin) is used when it exists and is at least as new as data.json, otherwise data.json is parsed. Each animal
+    is compiled into an AnimalModel the first time it is used.
+    :param directory: The directory containing data.bin and/or data.json
+    :return: A tuple of the dataset version and a LazyModels mapping of AnimalModels, where the key is the animal
+    """
+    bundle_path = os.path.join(directory, "data.bin")
+    json_path = os.path.join(directory, "data.json")
+    if os.path.exists(bundle_path) and (not os.path.exists(json_path) or
+                                        os.path.getmtime(bundle_path) >= os.path.getmtime(json_path)):
+        try:
+            header, arrays = model_bundle.read_bundle(bundle_path)
+        except model_bundle.BundleError as e:
+            print(f"Falling back to data.json: {e}", file=sys.stderr)
+        else:
+            def bundle_builder(animal, entry):
+                return lambda: AnimalModel(animal, LikelihoodMatrix.from_arrays(entry["diseases"], entry["signs"],
+                                                                                *arrays[animal]),
+                                           entry["disease_wiki_ids"], entry["sign_names_and_codes"])
+
+            return header["dataset_version"], LazyModels({animal: bundle_builder(animal, entry)
+                                                          for animal, entry in header["animals"].items()})
+
+    with open(json_path, "rb") as f:
+        raw = f.read()
+    data = json.loads(raw)
+
+    def json_builder(animal, values):
+        return lambda: AnimalModel(animal, LikelihoodMatrix(values["diseases"], values["signs"], values["likelihoods"]),
+                                   values["disease_wiki_ids"], values["sign_names_and_codes"])
+
+    models = LazyModels({animal: json_builder(animal, values) for animal, values in data["animals"].items()})
+    return data.get("dataset_version") or hashlib.sha256(raw).hexdigest()[:16], models
+
+
+class ModelSnapshot:
+    """
+    One loaded version of the model data. A snapshot is never modified, reloading the data creates a new snapshot
+    and swaps it in, so a request which holds a snapshot keeps a consistent view of the data until it finishes.
+    """
+
+    __slots__ = ('version', 'models')
+
+    def __init__(self, version, models):
+        """
+        :param version: A string identifying the dataset the models were compiled from
+        :param models: A dictionary of AnimalModels, where the key is the animal
+        """
+        self.version = version
+        self.models = models
+
+
+def _data_files_state(directory):
+    """
+    :param directory: The directory containing the model data
+    :return: The modification time and size of data.bin and data.json, used to detect a new data file
+    """
+    state = []
+    for name in ("data.bin", "data.json"):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+            state.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+
+# The directory the model data is loaded from, and the snapshot currently used by new requests. The data is loaded on
+# first use rather than at import, see _latest_snapshot
+_data_directory = os.environ.get('DIAGNOSIS_DATA_PATH') or sys.path[0]
+_data_state = None
+_snapshot = None
+_reload_lock = threading.Lock()
+# The reload watcher of this process and its interval, restarted after a fork, and whether warm_up() has run
+_watcher = None
+_watcher_interval = None
+_watcher_lock = threading.Lock()
+_ready = False
+
+# The file written by trigger_reload so every worker of a pre-fork server reloads, not only the one which handled
+# /admin/reload. Defaults to .reload in the data directory
+RELOAD_TRIGGER = os.environ.get('DIAGNOSIS_RELOAD_TRIGGER')
+_reload_trigger = worker_sync.SharedFile(RELOAD_TRIGGER or os.path.join(_data_directory, '.reload'))
+
+# The snapshots replaced by a reload, most recent last, kept so clients can be sent the changes since their version
+SNAPSHOT_HISTORY = int(os.environ.get('DIAGNOSIS_SNAPSHOT_HISTORY', 4))
+_history = collections.OrderedDict()
+
+# The snapshot pinned by the request being handled in the current context, see pin_snapshot
+_pinned_snapshot = contextvars.ContextVar('pinned_snapshot', default=None)
+
+
+def _latest_snapshot():
+    """
+    :return: The snapshot used by new requests, loading the model data if it has not been loaded yet
+    """
+    global _snapshot, _data_state
+    if _snapshot is None:
+        with _reload_lock:
+            if _snapshot is None:
+                _data_state = _data_files_state(_data_directory)
+                _snapshot = ModelSnapshot(*load_models(_data_directory))
+    return _snapshot
+
+
+def set_data_path(directory):
+    """
+    A function used to choose the directory the model data is loaded from, instead of the DIAGNOSIS_DATA_PATH
+    environment variable or the directory of the script being run. The data is loaded from it on first use.
+    :param directory: The directory containing data.bin and/or data.json
+    """
+    global _data_directory, _data_state, _snapshot, _ready, _reload_trigger
+    with _reload_lock:
+        _data_directory = directory
+        if not RELOAD_TRIGGER:
+            _reload_trigger = worker_sync.SharedFile(os.path.join(directory, '.reload'))
+        _data_state = None
+        _snapshot = None
+        _history.clear()
+        _ready = False
+
+
+def current_snapshot():
+    """
+    A function used to get the snapshot of the model data used by the current request
+    :return: The snapshot pinned by pin_snapshot if there is one, otherwise the latest snapshot
+    """
+    return _pinned_snapshot.get() or _latest_snapshot()
+
+
+def pin_snapshot():
+    """
+    Pin the latest snapshot for the current context, so every lookup made while handling a request uses the same
+    data even if it is reloaded part way through
+    :return: The pinned snapshot
+    """
+    snapshot = _latest_snapshot()
+    _pinned_snapshot.set(snapshot)
+    return snapshot
+
+
+def unpin_snapshot():
+    """
+    Release the snapshot pinned by pin_snapshot once the request has finished
+    """
+    _pinned_snapshot.set(None)
+
+
+def _replace_snapshot(snapshot):
+    """
+    Swap in a new snapshot, keeping the one it replaces in the bounded history. Must be called with _reload_lock held.
+    :param snapshot: The new ModelSnapshot
+    """
+    global _snapshot
+    if _snapshot is not None and SNAPSHOT_HISTORY > 0:
+        _history.pop(_snapshot.version, None)
+        _history[_snapshot.version] = _snapshot
+        while len(_history) > SNAPSHOT_HISTORY:
+            _history.popitem(last=False)
+    _history.pop(snapshot.version, None)
+    _snapshot = snapshot
+
+
+def get_snapshot(version):
+    """
+    A function used to find an earlier version of the model data, such as the version a client last synchronised
+    :param version: The dataset version
+    :return: The ModelSnapshot of that version if it is the latest or is still in the history, otherwise None
+    """
+    snapshot = _latest_snapshot()
+    if snapshot.version == version:
+        return snapshot
+    return _history.get(version)
+
+
+def install_snapshot(version, models):
+    """
+    A function used to swap in model data which was built in memory rather than loaded from the data files, such as
+    the synthetic animals used by the benchmarks
+    :param version: A string identifying the dataset
+    :param models: A dictionary of AnimalModels, where the key is the animal
+    :return: The new snapshot
+    """
+    with _reload_lock:
+        _replace_snapshot(ModelSnapshot(version, models))
+        return _snapshot
+
+
+def reload_models(force=False):
+    """
+    A function used to load the model data again and atomically swap it in for new requests. Requests which have
+    already pinned a snapshot finish on the old one.
+    :param force: Reload even if the data files have not changed
+    :return: The snapshot in use after the reload
+    """
+    global _data_state
+    with _reload_lock:
+        state = _data_files_state(_data_directory)
+        if not force and state == _data_state:
+            return _snapshot
+        version, models = load_models(_data_directory)
+        _data_state = state
+        if _snapshot is None or version != _snapshot.version:
+            _replace_snapshot(ModelSnapshot(version, models))
+        return _snapshot
+
+
+def trigger_reload():
+    """
+    A function used to reload the model data in this process and tell the other workers of a pre-fork server to
+    reload it too, which they do at the start of their next request, see check_reload_trigger
+    :return: A tuple of the snapshot in use after the reload and whether the other workers were told, which fails if
+    the trigger file can not be written
+    """
+    notified = _reload_trigger.write({'time': time.time(), 'pid': os.getpid()})
+    return reload_models(force=True), notified
+
+
+def check_reload_trigger():
+    """
+    Reload the model data if another worker has called trigger_reload since this one last loaded it. Called at the
+    start of every request, and only checks the trigger file once every DIAGNOSIS_SYNC_INTERVAL seconds.
+    """
+    if _snapshot is not None and _reload_trigger.poll() is not None:
+        try:
+            reload_models(force=True)
+        except Exception as e:
+            # Keep serving the current snapshot rather than failing the request
+            print(f"Unable to reload the model data: {e}", file=sys.stderr)
+
+
+def start_reload_watcher(interval):
+    """
+    Start a background thread which checks the data files for changes every interval seconds and reloads them. Only
+    one watcher runs in a process, so calling this again, such as from another create_app(), returns the running one.
+    :param interval: The number of seconds between checks
+    :return: The watcher thread
+    """
+    global _watcher, _watcher_interval
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_models()
+            except Exception as e:
+                # Keep serving the current snapshot, the next check will retry once the file is complete
+                print(f"Unable to reload the model data: {e}", file=sys.stderr)
+
+    with _watcher_lock:
+        if _watcher is not None and _watcher.is_alive():
+            return _watcher
+        _watcher = threading.Thread(target=watch, name='model-reload-watcher', daemon=True)
+        _watcher.start()
+        if _watcher_interval is None:
+            # Threads do not survive a fork, so a pre-fork server's workers each start their own watcher
+            os.register_at_fork(after_in_child=_restart_reload_watcher)
+        _watcher_interval = interval
+        return _watcher
+
+
+def _restart_reload_watcher():
+    """
+    Start the reload watcher again in a forked child. The locks are replaced as a thread of the parent could have
+    held them at the time of the fork.
+    """
+    global _reload_lock, _watcher_lock, _watcher
+    _reload_lock = threading.Lock()
+    _watcher_lock = threading.Lock()
+    _watcher = None
+    start_reload_watcher(_watcher_interval)
+
+
+def warm_up():
+    """
+    A function used to compile and exercise every model of the latest snapshot before the server takes traffic, so
+    the pages of the arrays are resident before a pre-fork server forks its workers, which then share them
+    copy-on-write. Afterwards is_ready() returns True.
+    :return: The warmed snapshot
+    """
+    global _ready
+    snapshot = _latest_snapshot()
+    for model in snapshot.models.values():
+        matrix = model.matrix
+        matrix.batch_posteriors(np.zeros((1, 2 * len(matrix.signs))), model.default_log_priors)
+        matrix.sign_entropy
+    _ready = True
+    return snapshot
+
+
+def is_ready():
+    """
+    :return: Whether the model data has been loaded and warmed with warm_up(), used by the readiness probe
+    """
+    return _ready
+
+
+def get_dataset_version():
+    """
+    A function used to get the version of the model data used by the current request
+    :return: A string identifying the dataset the models were compiled from
+    """
+    return current_snapshot().version
+
+
+def get_model(animal):
+    """
+    A function used to get the compiled model for an animal
+    :param animal: The animal that is being diagnosed
+    :return: The AnimalModel for the animal
+    """
+    return current_snapshot().models[animal]
+
+
 def get_animals():
     """
     A function used to get the list of valid animals
     :return: A list of valid animal names
     """
-    return list(_data["animals"].keys())
+    return list(current_snapshot().models)
 
 
 def get_disease_wiki_ids(animal):
@@ -150,7 +1021,7 @@ def get_disease_wiki_ids(animal):
     :return: A dictionary of WikiData IDs for each disease, where the key is the disease and the value is the
     WikiData ID
     """
-    return _data["animals"][animal]["disease_wiki_ids"]
+    return current_snapshot().models[animal].disease_wiki_ids
 
 
 def get_likelihood_data(animal):
@@ -160,25 +1031,34 @@ def get_likelihood_data(animal):
     :return: A dictionary of likelihoods for each disease, where the key is the disease and the value is a
     dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
     """
-    return _data["animals"][animal]["likelihoods"]
+    return current_snapshot().models[animal].matrix.likelihoods
+
+
+def get_likelihood_matrix(animal):
+    """
+    A function used to get the precomputed likelihood matrix
+    :param animal: The animal that is being diagnosed
+    :return: The LikelihoodMatrix for the animal
+    """
+    return current_snapshot().models[animal].matrix
 
 
 def get_diseases(animal):
     """
     A function used to get the diseases
     :param animal: The animal that is being diagnosed
-    :return: A list of diseases
+    :return: A tuple of diseases
     """
-    return _data["animals"][animal]["diseases"]
+    return current_snapshot().models[animal].diseases
 
 
 def get_signs(animal):
     """
     A function used to get the signs
     :param animal: The animal that is being diagnosed
-    :return: A list of signs
+    :return: A tuple of signs
     """
-    return _data["animals"][animal]["signs"]
+    return current_snapshot().models[animal].signs
 
 
 def get_sign_names_and_codes(animal):
@@ -188,7 +1068,7 @@ def get_sign_names_and_codes(animal):
     :return: A dictionary of full sign data, where the key is the sign and the value is a dictionary of the full name
     and Wikidata code
     """
-    return _data["animals"][animal]["sign_names_and_codes"]
+    return current_snapshot().models[animal].sign_names_and_codes
 
 
 def validate_animal(animal):
@@ -199,7 +1079,7 @@ def validate_animal(animal):
     :return bool/str: False if the animal is not valid, the animal name if it is valid
     """
     animal = animal.capitalize()
-    if animal not in _data["animals"]:
+    if animal not in current_snapshot().models:
         return False
     else:
         return animal
@@ -4,36 +4,118 @@ This file contains the code for the Flask API. It is used to diagnose animals us
 
 """
 
-from flask import Flask
+import os
+import threading
+
+from flask import Flask, jsonify
 from flask_compress import Compress
 from flask_cors import CORS
 from flask_restx import Api
 
+import content_negotiation
+import diagnosis_helper as dh
+import metrics
+from traffic_capture import TrafficCapture
+from admin_controller import api as admin_ns
 from data_controller import api as data_ns
 from diagnosis_controller import api as diagnosis_ns
 
-# set up the api's documentation
-api = Api(version='1.0', title='Diagnosis API', description='A simple API to diagnose animals using Bayes\' Theorem. '
-                                                            'To view the endpoints, use the drop downs below. <br> The '
-                                                            'section titled "Diagnosis" contains the endpoints for '
-                                                            'diagnosing an animal. <br>'
-                                                            'The section titled "Data" contains the endpoints for '
-                                                            'accessing relevant data and obtaining examples of input.'
-                                                            '<br> \'Models\' contains information about the formatting '
-                                                            'of data required in the payloads for the POST requests.',
-          default='Diagnosis API', default_label='Diagnosis API')
-# init the flask app
-app = Flask(__name__)
-Compress(app)
-CORS(app)
-# init the api using factory pattern
-api.init_app(app)
-
-# add the namespaces to the api
-api.add_namespace(diagnosis_ns)
-api.add_namespace(data_ns)
+
+def create_app(data_path=None, preload=None):
+    """
+    The application factory, used by the production entry point in wsgi.py and by the development server below.
+    :param data_path: The directory containing the model data. Defaults to the DIAGNOSIS_DATA_PATH environment
+    variable, or the directory of the script being run
+    :param preload: Whether to load and warm the model data before returning, so a pre-fork server which creates the
+    app in its master process shares the compiled model with every worker. Otherwise the data is warmed in a
+    background thread and each animal is compiled on first use if a request needs it sooner, which keeps cold starts
+    fast. Defaults to True unless the DIAGNOSIS_LAZY_LOAD environment variable is 1
+    :return: The Flask app
+    """
+    if data_path is not None:
+        dh.set_data_path(data_path)
+    if preload is None:
+        preload = os.environ.get('DIAGNOSIS_LAZY_LOAD') != '1'
+
+    # set up the api's documentation
+    api = Api(version='1.0', title='Diagnosis API',
+              description='A simple API to diagnose animals using Bayes\' Theorem. '
+                          'To view the endpoints, use the drop downs below. <br> The '
+                          'section titled "Diagnosis" contains the endpoints for '
+                          'diagnosing an animal. <br>'
+                          'The section titled "Data" contains the endpoints for '
+                          'accessing relevant data and obtaining examples of input.'
+                          '<br> \'Models\' contains information about the formatting '
+                          'of data required in the payloads for the POST requests.',
+              default='Diagnosis API', default_label='Diagnosis API')
+    # init the flask app
+    app = Flask(__name__)
+    Compress(app)
+    CORS(app)
+    # init the api using factory pattern
+    api.init_app(app)
+
+    # add the namespaces to the api
+    api.add_namespace(diagnosis_ns)
+    api.add_namespace(data_ns)
+    api.add_namespace(admin_ns)
+
+    # time and count every request, and expose the results at /metrics
+    metrics.init_app(app)
+    # accept and serve MessagePack as well as JSON
+    content_negotiation.init_app(app)
+
+    @app.before_request
+    def pin_model_snapshot():
+        # Every lookup made while handling the request uses the same model data, even if it is reloaded meanwhile.
+        # A reload requested through another worker is applied first.
+        dh.check_reload_trigger()
+        dh.pin_snapshot()
+
+    @app.after_request
+    def add_dataset_version(response):
+        response.headers['X-Dataset-Version'] = dh.get_dataset_version()
+        return response
+
+    @app.teardown_request
+    def unpin_model_snapshot(exc):
+        dh.unpin_snapshot()
+
+    @app.route('/ready')
+    def ready():
+        # The readiness probe, which only passes once the model data has been loaded and warmed
+        if not dh.is_ready():
+            return jsonify({'status': 'loading'}), 503
+        return jsonify({'status': 'ready', 'dataset_version': dh.get_dataset_version()})
+
+    # Sample requests to a file for benchmarks/replay.py, if a capture file is configured
+    if os.environ.get('DIAGNOSIS_CAPTURE_FILE'):
+        TrafficCapture(os.environ['DIAGNOSIS_CAPTURE_FILE'], float(os.environ.get('DIAGNOSIS_CAPTURE_RATE', 1.0)),
+                       int(os.environ.get('DIAGNOSIS_CAPTURE_MAX_BODY', 1024 * 1024))).init_app(app)
+
+    # Poll the data files for changes and reload them in the background, if an interval in seconds is configured. Only
+    # one watcher runs in a process however many apps are created
+    if os.environ.get('DIAGNOSIS_RELOAD_INTERVAL'):
+        dh.start_reload_watcher(float(os.environ['DIAGNOSIS_RELOAD_INTERVAL']))
+
+    if preload:
+        dh.warm_up()
+    else:
+        threading.Thread(target=dh.warm_up, name='model-warm-up', daemon=True).start()
+    return app
+
+
+def __getattr__(name):
+    # The module level app is only created when it is first imported, so importing create_app does not build one
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
 
 if __name__ == '__main__':
+    app = create_app()
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
     app.debug = True
     app.run(port=5000)
@@ -0,0 +1,33 @@
+"""
+
+The gunicorn configuration for running the API in production with "gunicorn -c gunicorn.conf.py". Each setting can be
+changed with the environment variable next to it.
+
+"""
+
+import gc
+import multiprocessing
+import os
+
+# The diagnosis itself is a single matrix product per request, so give each worker one BLAS thread and scale with
+# workers rather than oversubscribing the CPUs. These must be set before numpy is imported by the preloaded app.
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(variable, '1')
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('DIAGNOSIS_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('DIAGNOSIS_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('DIAGNOSIS_THREADS', 1))
+timeout = int(os.environ.get('DIAGNOSIS_TIMEOUT', 30))
+keepalive = 5
+
+# Import the app, and so load and warm the model data, once in the master process before forking the workers, which
+# then share the model's memory copy-on-write instead of each loading their own copy
+preload_app = True
+
+
+def when_ready(server):
+    # Move everything allocated while loading into the permanent generation, so the garbage collector in the workers
+    # never writes to those objects and their pages stay shared
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,127 @@
+"""
+A bounded, content-addressed cache of the validated likelihood matrices sent to /diagnosis/custom_diagnose, so a
+matrix which is sent repeatedly is only validated and compiled once.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+def matrix_key(diseases, signs, likelihoods):
+    """
+    A function used to get the content address of a custom likelihood matrix
+    :param diseases: A list of the diseases in the matrix
+    :param signs: A list of the signs in the matrix
+    :param likelihoods: A dictionary of likelihoods for each disease, where the key is the disease and the value is a
+    dictionary of likelihoods for each sign, where the key is the sign and the value is the likelihood
+    :return: A hex digest which is the same for any ordering of the diseases, signs and likelihoods
+    """
+    canonical = json.dumps({'diseases': sorted(diseases), 'signs': sorted(signs), 'likelihoods': likelihoods},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def packed_key(diseases, signs, values):
+    """
+    A function used to get the content address of a custom likelihood matrix which has already been packed into an
+    array, as it is when the request body is parsed incrementally
+    :param diseases: A list of the diseases, in the order of the rows of values
+    :param signs: A list of the signs, in the order of the columns of values
+    :param values: An n_diseases x n_signs array of likelihoods
+    :return: A hex digest of the names and the bytes of the array, which depends on the order of the names
+    """
+    digest = hashlib.sha256(json.dumps([diseases, signs], separators=(',', ':')).encode())
+    digest.update(values.tobytes())
+    return 'packed:' + digest.hexdigest()
+
+
+class MatrixCache:
+    """
+    A thread safe LRU cache of LikelihoodMatrix objects, bounded by both the number of entries and their total size
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        """
+        :param max_entries: The maximum number of matrices to keep
+        :param max_bytes: The maximum total size of the matrices to keep, as estimated by LikelihoodMatrix.nbytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: The content address of the matrix, as returned by matrix_key
+        :return: The cached LikelihoodMatrix, or None if it is not in the cache
+        """
+        with self._lock:
+            matrix = self._entries.get(key)
+            if matrix is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return matrix
+
+    def put(self, key, matrix):
+        """
+        Add a matrix to the cache, evicting the least recently used matrices until it is within its bounds. A matrix
+        which is larger than max_bytes on its own is not cached.
+        :param key: The content address of the matrix, as returned by matrix_key
+        :param matrix: The validated LikelihoodMatrix
+        :return: True if the matrix was cached, otherwise False
+        """
+        size = matrix.nbytes
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = matrix
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+        return True
+
+    def stats(self):
+        """
+        :return: A dictionary of the size of the cache and its hit, miss and eviction counters
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+# The cache shared by every request in this process
+custom_matrices = MatrixCache(int(os.environ.get('DIAGNOSIS_MATRIX_CACHE_ENTRIES', 256)),
+                              int(os.environ.get('DIAGNOSIS_MATRIX_CACHE_BYTES', 256 * 1024 * 1024)))
+
+
+def _render_stats():
+    """
+    :return: The counters of the shared cache in the Prometheus text format, for /metrics
+    """
+    stats = custom_matrices.stats()
+    lines = []
+    for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('entries', 'gauge'),
+                       ('bytes', 'gauge')):
+        metric = f'diagnosis_custom_matrix_cache_{name}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# TYPE {metric} {kind}', f'{metric} {stats[name]}']
+    return lines
+
+
+metrics.register_collector(_render_stats)
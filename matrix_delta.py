@@ -0,0 +1,77 @@
+"""
+The changes to an animal's likelihood table between two dataset versions, used by /data/matrix_delta so mobile apps
+which compute offline can update their copy of the table without downloading all of it again.
+"""
+
+import os
+
+import numpy as np
+
+import diagnosis_helper as dh
+
+# A delta is only sent if it has at most this fraction of the cells of the full table, otherwise the table is sent
+MAX_DELTA_RATIO = float(os.environ.get('DIAGNOSIS_DELTA_MAX_RATIO', 0.5))
+
+
+def compute_delta(old, new):
+    """
+    A function used to find the cells of a likelihood table which changed between two versions
+    :param old: The LikelihoodMatrix the client has
+    :param new: The current LikelihoodMatrix
+    :return: A tuple of a dictionary describing the changes and the number of cells it holds. Changed cells are
+    grouped by disease, an added disease has a value for every current sign, and an added sign has a value for every
+    disease which is not itself added.
+    """
+    old_diseases = {disease: i for i, disease in enumerate(old.diseases)}
+    old_signs = old.sign_index
+    new_diseases = set(new.diseases)
+
+    # The rows and columns of the diseases and signs in both versions, in the order of the current table
+    kept_diseases = [i for i, disease in enumerate(new.diseases) if disease in old_diseases]
+    kept_signs = [i for i, sign in enumerate(new.signs) if sign in old_signs]
+    old_rows = [old_diseases[new.diseases[i]] for i in kept_diseases]
+    old_columns = [old_signs[new.signs[i]] for i in kept_signs]
+
+    new_values = np.asarray(new.values)
+    changed = {}
+    kept = new_values[np.ix_(kept_diseases, kept_signs)]
+    for row, column in zip(*np.nonzero(kept != np.asarray(old.values)[np.ix_(old_rows, old_columns)])):
+        disease = new.diseases[kept_diseases[row]]
+        changed.setdefault(disease, {})[new.signs[kept_signs[column]]] = float(kept[row, column])
+
+    added_diseases = {disease: dict(zip(new.signs, new_values[i].tolist()))
+                      for i, disease in enumerate(new.diseases) if disease not in old_diseases}
+    added_signs = {new.signs[j]: {new.diseases[i]: float(new_values[i, j]) for i in kept_diseases}
+                   for j, sign in enumerate(new.signs) if sign not in old_signs}
+
+    delta = {'changed': changed,
+             'added_diseases': added_diseases,
+             'removed_diseases': [disease for disease in old.diseases if disease not in new_diseases],
+             'added_signs': added_signs,
+             'removed_signs': [sign for sign in old.signs if sign not in new.sign_index]}
+    cells = (sum(len(signs) for signs in changed.values()) + len(added_diseases) * len(new.signs) +
+             len(added_signs) * len(kept_diseases))
+    return delta, cells
+
+
+def matrix_delta(animal, since):
+    """
+    A function used to build the response of /data/matrix_delta for the current dataset version
+    :param animal: A validated animal
+    :param since: The dataset version the client has, or None
+    :return: A dictionary with the changes since that version, or with the full table in 'likelihoods' if the version
+    is no longer known, the animal is new, or the changes are more than MAX_DELTA_RATIO of the table
+    """
+    snapshot = dh.current_snapshot()
+    new = snapshot.models[animal].matrix
+    response = {'dataset_version': snapshot.version, 'since': since}
+
+    old_snapshot = dh.get_snapshot(since) if since is not None else None
+    if old_snapshot is not None and animal in old_snapshot.models:
+        delta, cells = compute_delta(old_snapshot.models[animal].matrix, new)
+        if cells <= MAX_DELTA_RATIO * len(new.diseases) * len(new.signs):
+            response.update(delta, full=False)
+            return response
+
+    response.update(full=True, likelihoods=new.likelihoods)
+    return response
@@ -0,0 +1,194 @@
+"""
+In-process metrics for the API, exposed in the Prometheus text format at /metrics.
+
+Every diagnosis request records how long it spends in each stage (JSON parsing, schema validation, the validate_*
+functions, the calculation, normalisation and serialisation) along with a count of requests by endpoint, animal and
+status. Recording a value is a lock and a bisect, and rendering only walks the series which exist, so scraping is
+cheap enough for a local collector.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+from flask_restx import Resource
+
+# The upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """
+    A monotonically increasing count for each combination of label values
+    """
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    A distribution of observed values, counted into cumulative buckets for each combination of label values
+    """
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # One count per bucket plus +Inf, followed by the sum of the observed values
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((label_values, list(series)) for label_values, series in self._series.items())
+        label_names = self.label_names + ('le',)
+        for label_values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(label_names, label_values + (bound,))} '
+                             f'{cumulative}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {series[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('diagnosis_stage_seconds', 'Time spent in each stage of handling a request.', ('stage',))
+REQUEST_SECONDS = Histogram('diagnosis_request_seconds', 'Time spent handling a request.', ('endpoint',))
+REQUESTS = Counter('diagnosis_requests_total', 'Requests handled, by endpoint, animal and status.',
+                   ('endpoint', 'animal', 'status'))
+
+_metrics = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS]
+_collectors = []
+
+
+def register_collector(collector):
+    """
+    Register a function which is called on every scrape and returns extra lines of the exposition, such as the
+    counters of a cache
+    :param collector: A function with no arguments returning a list of lines
+    """
+    _collectors.append(collector)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time the enclosed block as one stage of handling a request
+    :param stage: The name of the stage, such as 'calculate'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+
+
+def set_animal(animal):
+    """
+    Label the metrics of the current request with a validated animal. Only validated names should be used, so the
+    number of series stays bounded.
+    :param animal: The animal being diagnosed
+    """
+    g.metrics_animal = animal
+
+
+def render():
+    """
+    :return: Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedResource(Resource):
+    """
+    A Resource which times the flask-restx schema validation of its payload
+    """
+
+    def validate_payload(self, func):
+        with timed('schema'):
+            super().validate_payload(func)
+
+
+def streams_body():
+    """
+    :return: Whether the Resource handling the current request reads its body incrementally, by setting streams_body,
+    in which case the body must not be read by anything else
+    """
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(getattr(view, 'view_class', None), 'streams_body', False)
+
+
+def init_app(app):
+    """
+    Register the hooks which time and count every request, and the /metrics endpoint
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        if request.method == 'POST' and request.is_json and not streams_body():
+            # Parse the body up front so the parsing is timed on its own, later calls use the cached result. Resources
+            # which read their body incrementally set streams_body and time their own parsing.
+            with timed('parse'):
+                request.get_json(silent=True)
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+        REQUESTS.inc(endpoint, g.get('metrics_animal', ''), str(response.status_code))
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return app.response_class(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,148 @@
+"""
+Micro-batching of concurrent diagnoses. When enabled, diagnoses of the same animal which arrive within a short window
+are evaluated together as one matrix product against the animal's log likelihood table, and each waiting request is
+handed its own row of the result. This only helps a server which handles requests concurrently in threads, and it
+adds up to the window to the latency of every batched request, so it is off unless DIAGNOSIS_BATCH_WINDOW_MS is set.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+import diagnosis_helper as dh
+import metrics
+
+BATCH_SIZE = metrics.Histogram('diagnosis_batch_size', 'Diagnoses evaluated together in one micro-batch.',
+                               ('animal',), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+QUEUE_SECONDS = metrics.Histogram('diagnosis_batch_queue_seconds',
+                                  'Time a diagnosis waited for its micro-batch to be evaluated.', ('animal',))
+
+
+class _Pending:
+    """
+    One diagnosis waiting in a batch, and its result once the batch has been evaluated
+    """
+
+    __slots__ = ('evidence', 'log_priors', 'queued', 'result', 'error', 'done')
+
+    def __init__(self, evidence, log_priors):
+        self.evidence = evidence
+        self.log_priors = log_priors
+        self.queued = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch:
+    __slots__ = ('items', 'full')
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Collects the diagnoses of each likelihood table into batches. The first request to arrive for a table leads the
+    batch: it waits for the window, or until the batch holds max_size requests, evaluates the batch and wakes the
+    others. Batches are keyed by the LikelihoodMatrix itself, so requests pinned to different dataset versions are
+    never mixed.
+    """
+
+    def __init__(self, window, max_size):
+        """
+        :param window: The number of seconds the first request of a batch waits for others to join it
+        :param max_size: The most requests in one batch, a full batch is evaluated without waiting for the window
+        """
+        self.window = window
+        self.max_size = max_size
+        self._open = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    def posteriors(self, animal, matrix, evidence, log_priors):
+        """
+        Calculate the normalised posteriors of one case as part of a batch
+        :param animal: The animal being diagnosed, used to label the metrics
+        :param matrix: The LikelihoodMatrix of the animal
+        :param evidence: The evidence vector of the case, as returned by matrix.evidence()
+        :param log_priors: The log priors of the case, aligned to the diseases of the matrix
+        :return: A vector of posteriors aligned to the diseases of the matrix which add up to 100
+        """
+        item = _Pending(evidence, log_priors)
+        with self._lock:
+            batch = self._open.get(matrix)
+            leader = batch is None
+            if leader:
+                batch = self._open[matrix] = _Batch()
+            batch.items.append(item)
+            if len(batch.items) >= self.max_size:
+                # Close the batch so the next request starts a new one
+                del self._open[matrix]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(matrix) is batch:
+                    del self._open[matrix]
+            self._evaluate(animal, matrix, batch.items)
+        else:
+            item.done.wait()
+
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    @staticmethod
+    def _evaluate(animal, matrix, items):
+        # Items can no longer be added, the batch was removed from _open before this is called
+        started = time.perf_counter()
+        BATCH_SIZE.observe(len(items), animal)
+        for item in items:
+            QUEUE_SECONDS.observe(started - item.queued, animal)
+        try:
+            with metrics.timed('calculate'):
+                scores = (np.vstack([item.evidence for item in items]) @ matrix.log_table.T +
+                          np.vstack([item.log_priors for item in items]))
+            with metrics.timed('normalise'):
+                finite = np.isfinite(scores.max(axis=1))
+                posteriors = dh.log_normalise(scores[finite])
+            results = iter(posteriors)
+            for item, row_is_finite, row in zip(items, finite, scores):
+                if row_is_finite:
+                    item.result = next(results)
+                else:
+                    # Only the case whose every disease has a probability of 0 fails, not the whole batch
+                    try:
+                        dh.log_normalise(row)
+                    except BadRequest as e:
+                        item.error = e
+        except Exception as e:
+            for item in items:
+                item.error = e
+        finally:
+            for item in items:
+                item.done.set()
+
+
+# The batcher shared by every request in this process, disabled unless DIAGNOSIS_BATCH_WINDOW_MS is set
+batcher = MicroBatcher(float(os.environ.get('DIAGNOSIS_BATCH_WINDOW_MS', 0)) / 1000,
+                       int(os.environ.get('DIAGNOSIS_BATCH_MAX_SIZE', 32)))
+
+
+def _render_stats():
+    """
+    :return: The batch size and queueing delay histograms in the Prometheus text format, for /metrics
+    """
+    return BATCH_SIZE.render() + QUEUE_SECONDS.render()
+
+
+metrics.register_collector(_render_stats)
@@ -0,0 +1,118 @@
+"""
+Reading and writing the binary model bundle (data.bin) produced by convert_xlsx_to_json.py.
+
+The bundle holds the likelihood matrix of every animal, and its precomputed log(L) and log(1 - L) table, as raw
+little-endian float32 or float64 arrays which the server memory-maps read-only. Forked workers therefore share one
+physical copy of the matrices through the page cache, and loading the bundle does not create a Python object per
+likelihood. The layout is:
+
+    8 bytes     MAGIC
+    uint32      FORMAT_VERSION
+    uint32      length of the header
+    header      UTF-8 JSON holding the dataset version, the dtype and the string tables of every animal (diseases,
+                signs, WikiData IDs and sign names), along with the offset of each animal's arrays
+    arrays      for each animal, its values followed by its log table, each aligned to ALIGNMENT bytes
+"""
+
+import json
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b'DIAGMDL\0'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+DTYPES = ('float32', 'float64')
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+class BundleError(Exception):
+    """
+    Raised when a bundle is missing, corrupt or was written in an unsupported format
+    """
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(data, path, dtype='float64'):
+    """
+    A function used to write the binary model bundle
+    :param data: The converted data, in the same format as data.json
+    :param path: The path to write the bundle to
+    :param dtype: The dtype of the stored matrices, either 'float32' or 'float64'
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype '{dtype}'. Please use one of {list(DTYPES)}.")
+    dtype = np.dtype(dtype).newbyteorder('<')
+
+    arrays = []
+    header = {'dataset_version': data.get('dataset_version'), 'dtype': dtype.str, 'animals': {}}
+    offset = 0
+    for animal, values in data['animals'].items():
+        matrix = np.array([[values['likelihoods'][disease][sign] for sign in values['signs']]
+                           for disease in values['diseases']], dtype=np.float64)
+        matrix = matrix.reshape(len(values['diseases']), len(values['signs']))
+        with np.errstate(divide='ignore'):
+            log_table = np.hstack([np.log(matrix), np.log1p(-matrix)])
+        header['animals'][animal] = {
+            'diseases': values['diseases'],
+            'signs': values['signs'],
+            'disease_wiki_ids': values['disease_wiki_ids'],
+            'sign_names_and_codes': values['sign_names_and_codes'],
+            'values_offset': offset,
+            'log_table_offset': _align(offset + matrix.size * dtype.itemsize),
+        }
+        offset = _align(header['animals'][animal]['log_table_offset'] + log_table.size * dtype.itemsize)
+        arrays.append((matrix.astype(dtype), log_table.astype(dtype)))
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for (matrix, log_table), entry in zip(arrays, header['animals'].values()):
+            f.seek(data_start + entry['values_offset'])
+            f.write(matrix.tobytes())
+            f.seek(data_start + entry['log_table_offset'])
+            f.write(log_table.tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_bundle(path):
+    """
+    A function used to memory-map the binary model bundle
+    :param path: The path of the bundle
+    :return: A tuple of the header and a dictionary of animals, where the key is the animal and the value is a tuple
+    of its read-only values array and log table
+    """
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        raise BundleError(f"Unable to map '{path}': {e}") from e
+
+    if len(buffer) < _PREAMBLE.size:
+        raise BundleError(f"'{path}' is not a model bundle.")
+    magic, version, header_length = _PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise BundleError(f"'{path}' is not a model bundle.")
+    if version != FORMAT_VERSION:
+        raise BundleError(f"'{path}' uses bundle format {version}, but only format {FORMAT_VERSION} is supported.")
+    header = json.loads(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length])
+    dtype = np.dtype(header['dtype'])
+    data_start = _align(_PREAMBLE.size + header_length)
+
+    arrays = {}
+    for animal, entry in header['animals'].items():
+        shape = (len(entry['diseases']), len(entry['signs']))
+        size = shape[0] * shape[1]
+        if data_start + entry['log_table_offset'] + 2 * size * dtype.itemsize > len(buffer):
+            raise BundleError(f"'{path}' is truncated.")
+        values = np.frombuffer(buffer, dtype=dtype, count=size, offset=data_start + entry['values_offset'])
+        log_table = np.frombuffer(buffer, dtype=dtype, count=2 * size, offset=data_start + entry['log_table_offset'])
+        arrays[animal] = (values.reshape(shape), log_table.reshape(shape[0], 2 * shape[1]))
+    return header, arrays
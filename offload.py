@@ -0,0 +1,172 @@
+"""
+A bounded process pool for the custom diagnoses whose likelihood tables are too large to validate and score inline.
+Validating and compiling a large table holds the GIL for as long as it runs, which stalls every other request handled
+by the same worker, so tables with more than DIAGNOSIS_OFFLOAD_CELLS cells are sent to a separate process instead.
+The pool only accepts a bounded number of jobs at once and each job has a deadline, so a burst of huge tables is
+turned away with 503 rather than queueing without limit.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+
+from werkzeug.exceptions import BadRequest
+
+import diagnosis_helper as dh
+import metrics
+
+OFFLOADS = metrics.Counter('diagnosis_offload_total', 'Custom diagnoses sent to the process pool, by outcome.',
+                           ('outcome',))
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when the pool already has as many jobs as it accepts
+    """
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when a job does not finish before its deadline
+    """
+
+
+def _custom_diagnosis(diseases, signs, likelihoods, shown_signs, priors):
+    """
+    Validate, compile and score a custom likelihood table, run in a process of the pool
+    :param diseases: A list of the diseases in the table
+    :param signs: A list of the signs in the table
+    :param likelihoods: A dictionary of likelihoods for each disease, formatted as in /custom_diagnose
+    :param shown_signs: A dictionary of validated signs
+    :param priors: A dictionary of priors for each disease, or None for equal priors
+    :return: A tuple of the error message of the first invalid value, or None, and the vector of normalised results
+    aligned to diseases. The message is returned rather than raised as exceptions do not keep their message when
+    they are sent back from the pool.
+    """
+    try:
+        dh.validate_likelihoods(likelihoods, diseases, signs)
+        return None, _score(dh.LikelihoodMatrix(diseases, signs, likelihoods), shown_signs, priors)
+    except BadRequest as e:
+        return e.description, None
+
+
+def _packed_diagnosis(diseases, signs, values, shown_signs, priors):
+    """
+    Compile and score a custom likelihood table which was checked and packed while the request body was parsed, run
+    in a process of the pool
+    :param diseases: A list of the diseases in the table
+    :param signs: A list of the signs in the table
+    :param values: An n_diseases x n_signs array of the likelihoods, as returned by LikelihoodPacker.pack
+    :param shown_signs: A dictionary of validated signs
+    :param priors: A dictionary of priors for each disease, or None for equal priors
+    :return: A tuple of the error message, or None, and the vector of normalised results, as for _custom_diagnosis
+    """
+    try:
+        matrix = dh.LikelihoodMatrix.from_arrays(diseases, signs, values, dh.LikelihoodMatrix.compute_log_table(values))
+        return None, _score(matrix, shown_signs, priors)
+    except BadRequest as e:
+        return e.description, None
+
+
+def _score(matrix, shown_signs, priors):
+    # Check the priors and calculate the normalised posteriors of a compiled custom table
+    if priors is not None:
+        dh.validate_priors(priors, matrix.diseases)
+    else:
+        priors = dh.get_default_priors(matrix.diseases)
+    return dh.calculate_posterior_vector(matrix, shown_signs, priors)
+
+
+class OffloadPool:
+    """
+    A process pool which is started on first use, so a pre-fork server starts one pool in each worker rather than
+    sharing one made before the fork
+    """
+
+    def __init__(self, min_cells, workers, max_pending, timeout):
+        """
+        :param min_cells: The number of cells above which a table is offloaded, 0 never offloads
+        :param workers: The number of processes in the pool
+        :param max_pending: The most jobs running or queued at once, further jobs are rejected
+        :param timeout: The number of seconds to wait for a job before giving up on it
+        """
+        self.min_cells = min_cells
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def should_offload(self, n_diseases, n_signs):
+        """
+        :param n_diseases: The number of diseases in the table
+        :param n_signs: The number of signs in the table
+        :return: Whether a table of this size is scored in the pool
+        """
+        return 0 < self.min_cells < n_diseases * n_signs
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, as forking a server with running threads can copy a held lock
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def custom_diagnosis(self, diseases, signs, likelihoods, shown_signs, priors):
+        """
+        Score a custom diagnosis in the pool, see _custom_diagnosis
+        :return: A vector of normalised results aligned to diseases, otherwise a BadRequest exception is raised for
+        an invalid table, PoolSaturated if the pool is full or PoolTimeout if it did not finish in time
+        """
+        return self._run(_custom_diagnosis, diseases, signs, likelihoods, shown_signs, priors)
+
+    def packed_diagnosis(self, diseases, signs, values, shown_signs, priors):
+        """
+        Score a custom diagnosis whose table has already been packed in the pool, see _packed_diagnosis
+        :return: A vector of normalised results aligned to diseases, raising the same exceptions as custom_diagnosis
+        """
+        return self._run(_packed_diagnosis, diseases, signs, values, shown_signs, priors)
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            OFFLOADS.inc('rejected')
+            raise PoolSaturated()
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job has actually finished, even if the request stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            error, posteriors = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            OFFLOADS.inc('timeout')
+            raise PoolTimeout()
+        if error is not None:
+            OFFLOADS.inc('invalid')
+            raise BadRequest(error)
+        OFFLOADS.inc('completed')
+        return posteriors
+
+    def shutdown(self):
+        """
+        Stop the processes of the pool, if it was started
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+
+# The pool shared by every request in this process
+pool = OffloadPool(int(os.environ.get('DIAGNOSIS_OFFLOAD_CELLS', 250_000)),
+                   int(os.environ.get('DIAGNOSIS_OFFLOAD_WORKERS', 2)),
+                   int(os.environ.get('DIAGNOSIS_OFFLOAD_MAX_PENDING', 4)),
+                   float(os.environ.get('DIAGNOSIS_OFFLOAD_TIMEOUT', 30)))
+
+metrics.register_collector(OFFLOADS.render)
@@ -0,0 +1,152 @@
+"""
+Payload validation compiled ahead of time from a flask-restx model. @api.expect(model, validate=True) builds a
+jsonschema validator and walks the whole schema on every request, which costs far more than the handful of type and
+range checks the diagnosis payloads need. CompiledSchema turns the schema into those checks once, and reports
+failures with the same 400 response and messages as flask-restx.
+"""
+
+from flask_restx import abort
+
+# The keywords of a property schema which do not constrain the value
+_ANNOTATIONS = frozenset(('description', 'example', 'title', 'default', 'readOnly'))
+
+_TYPES = {
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: (isinstance(value, int) and not isinstance(value, bool)) or
+                             (isinstance(value, float) and value.is_integer()),
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'boolean': lambda value: isinstance(value, bool),
+    'null': lambda value: value is None,
+}
+
+
+def _type_check(types):
+    if isinstance(types, str):
+        types = [types]
+    unknown = [name for name in types if name not in _TYPES]
+    if unknown:
+        raise ValueError(f'Unsupported schema type {unknown[0]!r}.')
+    checks = [_TYPES[name] for name in types]
+    expected = ', '.join(repr(name) for name in types)
+
+    def check(value):
+        if not any(type_check(value) for type_check in checks):
+            return f'{value!r} is not of type {expected}'
+    return check
+
+
+def _minimum_check(minimum):
+    def check(value):
+        if _TYPES['number'](value) and value < minimum:
+            return f'{value!r} is less than the minimum of {minimum!r}'
+    return check
+
+
+def _maximum_check(maximum):
+    def check(value):
+        if _TYPES['number'](value) and value > maximum:
+            return f'{value!r} is greater than the maximum of {maximum!r}'
+    return check
+
+
+def _items_check(schema):
+    checks = _compile_checks(schema, 'items')
+
+    def check(value):
+        # The errors of an item are keyed by its index, which is appended to the name of the property
+        if not isinstance(value, list):
+            return None
+        errors = {}
+        for index, item in enumerate(value):
+            for item_check in checks:
+                message = item_check(item)
+                if isinstance(message, dict):
+                    errors.update((f'{index}.{path}', item_message) for path, item_message in message.items())
+                elif message is not None:
+                    errors[str(index)] = message
+        return errors or None
+    return check
+
+
+_KEYWORDS = {'type': _type_check, 'minimum': _minimum_check, 'maximum': _maximum_check, 'items': _items_check}
+
+
+def _compile_checks(schema, name):
+    """
+    :param schema: The schema of one property
+    :param name: The name of the property, used in the error raised for an unsupported keyword
+    :return: A list of functions which each return None for a valid value, otherwise the error message
+    """
+    checks = []
+    # Checked in the order of the keywords, so when a value fails several the last message is reported, as with
+    # jsonschema
+    for keyword, argument in schema.items():
+        if keyword in _ANNOTATIONS:
+            continue
+        if keyword not in _KEYWORDS:
+            raise ValueError(f"Unsupported keyword '{keyword}' in '{name}'.")
+        checks.append(_KEYWORDS[keyword](argument))
+    return checks
+
+
+class CompiledSchema:
+    """
+    The checks of a flask-restx model's schema, compiled once. Only the keywords used by the flat payload models of
+    this API are supported (required, type, minimum, maximum and items), and compiling a schema with any other keyword
+    raises a ValueError, so a model can not silently lose validation.
+    """
+
+    def __init__(self, model):
+        """
+        :param model: The flask-restx model, such as diagnosis_payload_model
+        """
+        schema = model.__schema__
+        unsupported = set(schema) - {'required', 'properties', 'type'}
+        if unsupported or schema.get('type') != 'object':
+            raise ValueError(f'Cannot compile the schema of {model.name}: only flat objects are supported.')
+        self.name = model.name
+        self.required = tuple(schema.get('required', ()))
+        self.properties = []
+        for name, property_schema in schema.get('properties', {}).items():
+            try:
+                checks = _compile_checks(property_schema, name)
+            except ValueError as e:
+                raise ValueError(f'Cannot compile the schema of {model.name}: {e}')
+            if checks:
+                self.properties.append((name, tuple(checks)))
+
+    def errors(self, data):
+        """
+        :param data: The decoded request body
+        :return: A dictionary of the error message of each invalid property, keyed as flask-restx does, which is
+        empty if the payload is valid
+        """
+        if not isinstance(data, dict):
+            return {'': f"{data!r} is not of type 'object'"}
+        errors = {}
+        for name in self.required:
+            if name not in data:
+                errors[name] = f'{name!r} is a required property'
+        for name, checks in self.properties:
+            if name in data:
+                value = data[name]
+                for check in checks:
+                    message = check(value)
+                    if isinstance(message, dict):
+                        errors.update((f'{name}.{path}', item_message) for path, item_message in message.items())
+                    elif message is not None:
+                        errors[name] = message
+        return errors
+
+    def validate(self, data):
+        """
+        Validate a payload, aborting with the same 400 response as flask-restx if it is invalid
+        :param data: The decoded request body
+        :return: The data if it is valid
+        """
+        errors = self.errors(data)
+        if errors:
+            abort(400, message='Input payload validation failed', errors=errors)
+        return data
@@ -0,0 +1,156 @@
+"""
+On-demand profiling of individual diagnosis requests.
+
+Profiling is off by default and costs a flag check per request until it is switched on, either with
+DIAGNOSIS_PROFILE_ENABLED=1 or at runtime through /admin/profiling. A change made at runtime is written to
+settings.json in the profile directory, which the other workers of a pre-fork server pick up at the start of their
+next profiled endpoint, at most DIAGNOSIS_SYNC_INTERVAL seconds later. While it is on, a request is profiled if it sends
+the profiling token in the X-Profile header, or at random with probability sample_rate. The call-graph stats of each
+profiled request are written to a .prof file in the profile directory, which only keeps the newest max_files files,
+and can be inspected with "python -m pstats <file>" or a viewer such as snakeviz.
+"""
+
+import cProfile
+import functools
+import hmac
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import request, Response
+
+import worker_sync
+
+
+class ProfilingSettings:
+    """
+    The runtime settings of the profiler, changed through configure()
+    """
+
+    def __init__(self):
+        self.enabled = os.environ.get('DIAGNOSIS_PROFILE_ENABLED') == '1'
+        self.sample_rate = float(os.environ.get('DIAGNOSIS_PROFILE_SAMPLE_RATE', 0))
+        self.directory = os.environ.get('DIAGNOSIS_PROFILE_DIR',
+                                        os.path.join(tempfile.gettempdir(), 'diagnosis-profiles'))
+        self.max_files = int(os.environ.get('DIAGNOSIS_PROFILE_MAX_FILES', 100))
+        # The token which forces a request to be profiled, which defaults to the admin token
+        self.token = os.environ.get('DIAGNOSIS_PROFILE_TOKEN') or os.environ.get('DIAGNOSIS_ADMIN_TOKEN')
+
+    def as_dict(self):
+        return {'enabled': self.enabled, 'sample_rate': self.sample_rate, 'directory': self.directory,
+                'max_files': self.max_files}
+
+
+settings = ProfilingSettings()
+
+# Only one request is profiled at a time, as the interpreter only supports one active profiler
+_profiling_lock = threading.Lock()
+_rotation_lock = threading.Lock()
+# The file the settings are shared with the other workers through. It is opened before a pre-fork server forks, so
+# a worker which is started again later still applies the settings published since then.
+_shared = worker_sync.SharedFile(os.path.join(settings.directory, 'settings.json'))
+
+
+def configure(enabled=None, sample_rate=None, max_files=None):
+    """
+    A function used to change the profiling settings at runtime
+    :param enabled: Whether profiling is switched on
+    :param sample_rate: The fraction of requests to profile without the X-Profile header, between 0 and 1
+    :param max_files: The number of profiles to keep
+    :return: The settings after the change
+    """
+    if sample_rate is not None and not 0 <= sample_rate <= 1:
+        raise ValueError('The sample rate must be between 0 and 1.')
+    if max_files is not None and max_files < 1:
+        raise ValueError('At least one profile must be kept.')
+    if sample_rate is not None:
+        settings.sample_rate = sample_rate
+    if max_files is not None:
+        settings.max_files = max_files
+    if enabled is not None:
+        settings.enabled = enabled
+    return settings
+
+
+def _shared_settings():
+    # The file moves with the profile directory
+    global _shared
+    path = os.path.join(settings.directory, 'settings.json')
+    if _shared.path != path:
+        _shared = worker_sync.SharedFile(path)
+    return _shared
+
+
+def publish():
+    """
+    A function used to share the current settings with the other workers of a pre-fork server, after configure()
+    :return: True if the settings were written for the other workers, otherwise False
+    """
+    return _shared_settings().write({'enabled': settings.enabled, 'sample_rate': settings.sample_rate,
+                                     'max_files': settings.max_files})
+
+
+def sync():
+    """
+    Apply the settings published by another worker, if they have changed since this worker last checked
+    """
+    changes = _shared_settings().poll()
+    if isinstance(changes, dict):
+        try:
+            configure(changes.get('enabled'), changes.get('sample_rate'), changes.get('max_files'))
+        except (TypeError, ValueError):
+            pass
+
+
+def _should_profile():
+    header = request.headers.get('X-Profile')
+    if header is not None and settings.token and hmac.compare_digest(header, settings.token):
+        return True
+    return settings.sample_rate > 0 and random.random() < settings.sample_rate
+
+
+def _write_profile(profiler):
+    """
+    Write the stats of a profiled request and delete the oldest profiles beyond max_files
+    :return: The name of the profile file
+    """
+    os.makedirs(settings.directory, exist_ok=True)
+    endpoint = (request.endpoint or 'unknown').replace('/', '_')
+    name = f'{time.strftime("%Y%m%dT%H%M%S")}-{endpoint}-{uuid.uuid4().hex[:8]}.prof'
+    profiler.dump_stats(os.path.join(settings.directory, name))
+
+    with _rotation_lock:
+        profiles = sorted((entry for entry in os.scandir(settings.directory) if entry.name.endswith('.prof')),
+                          key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in profiles[:max(len(profiles) - settings.max_files, 0)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return name
+
+
+def profiled(func):
+    """
+    Decorate a request handler so that it can be profiled. The name of the profile file is returned in the
+    X-Profile-File header of a profiled response.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sync()
+        if not settings.enabled or not _should_profile() or not _profiling_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            profiler = cProfile.Profile()
+            result = profiler.runcall(func, *args, **kwargs)
+        finally:
+            _profiling_lock.release()
+        name = _write_profile(profiler)
+        if isinstance(result, Response):
+            result.headers['X-Profile-File'] = name
+        return result
+
+    return wrapper
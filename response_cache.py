@@ -0,0 +1,116 @@
+"""
+Pre-serialised, pre-compressed responses for the endpoints of the data namespace, which only change when the model
+data is reloaded. Each body is serialised and compressed once per dataset version and served with a strong ETag, so
+a client polling with If-None-Match is answered with 304 without any serialisation or compression.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+import content_negotiation as cn
+import diagnosis_helper as dh
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The number of seconds clients may reuse a cached body before revalidating it
+MAX_AGE = int(os.environ.get('DIAGNOSIS_DATA_MAX_AGE', 300))
+# The maximum number of bodies to keep, the least recently used are evicted first
+MAX_ENTRIES = int(os.environ.get('DIAGNOSIS_RESPONSE_CACHE_ENTRIES', 1024))
+
+
+class CachedBody:
+    """
+    One serialised response body along with its compressed variants and ETags
+    """
+
+    __slots__ = ('bodies', 'etags')
+
+    def __init__(self, body):
+        """
+        :param body: The serialised JSON body
+        """
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body, quality=11)
+        # Each encoding is a different representation, so it gets its own strong ETag
+        self.etags = {encoding: digest if encoding == 'identity' else f'{digest}-{encoding}'
+                      for encoding in self.bodies}
+
+
+_cache = OrderedDict()
+_cache_version = None
+_cache_lock = threading.Lock()
+
+
+def _get_cached_body(key, build, msgpack=False):
+    """
+    Get the cached body for a key, building it if the dataset version has changed since it was cached
+    :param key: A hashable key identifying the response, such as (endpoint, animal)
+    :param build: A function returning the data to serialise
+    :param msgpack: Whether to serialise the data as MessagePack rather than JSON, which is cached separately
+    :return: The CachedBody
+    """
+    global _cache, _cache_version
+    version = dh.get_dataset_version()
+    with _cache_lock:
+        if version != _cache_version:
+            # Drop every body built from the previous dataset at once, including those of removed animals
+            _cache, _cache_version = OrderedDict(), version
+        entry = _cache.get((key, msgpack))
+        if entry is not None:
+            _cache.move_to_end((key, msgpack))
+            return entry
+
+    # Build outside the lock, at worst two requests build the same body at the same time
+    if msgpack:
+        body = cn.packb(build())
+    else:
+        body = (json.dumps(build(), sort_keys=True, separators=(',', ':')) + '\n').encode()
+    entry = CachedBody(body)
+    with _cache_lock:
+        if version == _cache_version:
+            _cache[(key, msgpack)] = entry
+            while len(_cache) > MAX_ENTRIES:
+                _cache.popitem(last=False)
+    return entry
+
+
+def cached_json_response(key, build, public=True):
+    """
+    A function used to serve a JSON or MessagePack body which only changes when the model data is reloaded
+    :param key: A hashable key identifying the response, such as (endpoint, animal)
+    :param build: A function returning the data to serialise, only called when the body is not already cached
+    :param public: Whether shared caches may store the response, otherwise it is marked private
+    :return: A 200 response in the best encoding the client accepts, or a 304 response if the client's copy is
+    current
+    """
+    msgpack = cn.wants_msgpack()
+    entry = _get_cached_body(key, build, msgpack)
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in entry.bodies and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+
+    response = current_app.response_class(mimetype=cn.MSGPACK_MIMETYPE if msgpack else cn.JSON_MIMETYPE)
+    response.set_etag(entry.etags[encoding])
+    response.headers['Cache-Control'] = f"{'public' if public else 'private'}, max-age={MAX_AGE}"
+    response.headers['Vary'] = 'Accept-Encoding, Accept'
+    if any(request.if_none_match.contains(etag) for etag in entry.etags.values()):
+        response.status_code = 304
+        return response
+
+    response.set_data(entry.bodies[encoding])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    return response
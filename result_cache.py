@@ -0,0 +1,119 @@
+"""
+A bounded cache of the serialised responses of /diagnosis/diagnose for the default likelihoods and priors. The signs
+of an animal are packed into a single integer, so a case which has been seen before is answered without calculating
+or serialising anything.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+def pack_signs(signs, shown_signs):
+    """
+    A function used to pack a validated sign vector into an integer, reading the value of each sign as a base 3 digit
+    :param signs: The signs of the animal, in the order of the digits
+    :param shown_signs: A dictionary of signs that are shown, where the key is the sign and the value is -1, 0 or 1
+    :return: An integer which is different for every combination of sign values
+    """
+    key = 0
+    for sign in reversed(signs):
+        # The values may be floats such as 1.0, which would make the key a float and lose its lower digits
+        key = key * 3 + int(shown_signs[sign]) + 1
+    return key
+
+
+class ResultCache:
+    """
+    A thread safe LRU cache of response bodies with one bounded partition per animal. A partition is emptied when
+    the dataset version changes, so a reload never serves results calculated from the old data.
+    """
+
+    def __init__(self, max_entries):
+        """
+        :param max_entries: The maximum number of responses to keep for each animal. 0 disables the cache
+        """
+        self.max_entries = max_entries
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def _partition(self, animal, version):
+        # Get the partition of an animal, replacing it if it holds bodies calculated from another dataset version.
+        # The counters are kept across a reload, only the bodies are dropped.
+        partition = self._partitions.get(animal)
+        if partition is None or partition['version'] != version:
+            counters = {'hits': 0, 'misses': 0, 'evictions': 0} if partition is None else \
+                {counter: partition[counter] for counter in ('hits', 'misses', 'evictions')}
+            partition = self._partitions[animal] = dict(counters, version=version, entries=OrderedDict())
+        return partition
+
+    def get(self, animal, version, key):
+        """
+        :param animal: The animal that was diagnosed
+        :param version: The dataset version the response must have been calculated with
+        :param key: A hashable key of the packed signs, as returned by pack_signs, and the format of the body
+        :return: The cached body, or None if it is not in the cache
+        """
+        with self._lock:
+            partition = self._partition(animal, version)
+            body = partition['entries'].get(key)
+            if body is None:
+                partition['misses'] += 1
+                return None
+            partition['entries'].move_to_end(key)
+            partition['hits'] += 1
+            return body
+
+    def put(self, animal, version, key, body):
+        """
+        Add a response body to the cache, evicting the least recently used bodies of the animal beyond max_entries
+        :param animal: The animal that was diagnosed
+        :param version: The dataset version the response was calculated with
+        :param key: A hashable key of the packed signs, as returned by pack_signs, and the format of the body
+        :param body: The serialised response body
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            partition = self._partition(animal, version)
+            entries = partition['entries']
+            entries[key] = body
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                partition['evictions'] += 1
+
+    def stats(self):
+        """
+        :return: A dictionary of the size, hit, miss and eviction counters and the hit ratio of each animal
+        """
+        with self._lock:
+            stats = {}
+            for animal, partition in self._partitions.items():
+                lookups = partition['hits'] + partition['misses']
+                stats[animal] = {'entries': len(partition['entries']), 'hits': partition['hits'],
+                                 'misses': partition['misses'], 'evictions': partition['evictions'],
+                                 'hit_ratio': partition['hits'] / lookups if lookups else 0.0}
+            return {'max_entries': self.max_entries, 'animals': stats}
+
+
+# The cache shared by every request in this process
+results = ResultCache(int(os.environ.get('DIAGNOSIS_RESULT_CACHE_ENTRIES', 4096)))
+
+
+def _render_stats():
+    """
+    :return: The counters of the shared cache in the Prometheus text format, for /metrics
+    """
+    stats = results.stats()['animals']
+    lines = []
+    for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'), ('entries', 'gauge')):
+        metric = f'diagnosis_result_cache_{name}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {metric} {kind}')
+        lines += [f'{metric}{{animal="{animal}"}} {animal_stats[name]}' for animal, animal_stats in stats.items()]
+    return lines
+
+
+metrics.register_collector(_render_stats)
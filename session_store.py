@@ -0,0 +1,161 @@
+"""
+A bounded store of incremental diagnosis sessions, used by /diagnosis/sessions. A session keeps the unnormalised log
+posterior of every disease for the signs recorded so far, so recording one more sign only adds that sign's column of
+the log likelihoods rather than recalculating the whole case.
+"""
+
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+
+class DiagnosisSession:
+    """
+    The running state of one case. A session holds on to the AnimalModel it was created with, so it keeps working
+    on the same data if the model data is reloaded.
+    """
+
+    def __init__(self, model, log_priors):
+        """
+        :param model: The AnimalModel of the animal being diagnosed
+        :param log_priors: A vector of log priors aligned to model.diseases
+        """
+        self.id = secrets.token_urlsafe(16)
+        self.model = model
+        # The recorded value of each sign, -1, 0 or 1, aligned to model.signs
+        self.sign_values = np.zeros(len(model.signs), dtype=np.int8)
+        self.scores = np.array(log_priors, dtype=np.float64)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def update(self, signs):
+        """
+        Record new values for some of the signs. Only the signs whose value changed are applied, each in
+        O(diseases): the log likelihood column of its old value is subtracted and that of its new value is added.
+        :param signs: A dictionary of signs, where the key is the sign and the value is -1, 0 or 1, already validated
+        """
+        log_table = self.model.matrix.log_table
+        n_signs = len(self.model.signs)
+        for sign, value in signs.items():
+            index = self.model.sign_index[sign]
+            previous = self.sign_values[index]
+            if previous == value:
+                continue
+            if previous == 1:
+                self.scores -= log_table[:, index]
+            elif previous == -1:
+                self.scores -= log_table[:, n_signs + index]
+            if value == 1:
+                self.scores += log_table[:, index]
+            elif value == -1:
+                self.scores += log_table[:, n_signs + index]
+            self.sign_values[index] = value
+
+    def signs(self):
+        """
+        :return: A dictionary of the recorded value of every sign
+        """
+        return dict(zip(self.model.signs, self.sign_values.tolist()))
+
+
+class SessionStore:
+    """
+    A thread safe store of DiagnosisSessions, bounded by the number of sessions. Sessions which have not been used
+    for ttl seconds expire, and the least recently used session is evicted when the store is full.
+    """
+
+    def __init__(self, max_sessions, ttl):
+        """
+        :param max_sessions: The maximum number of sessions to keep
+        :param ttl: The number of seconds a session is kept after it was last used
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.created = 0
+        self.expired = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # The sessions are ordered by when they were last used, so the expired ones are at the start
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def add(self, session):
+        """
+        Add a new session, evicting the least recently used sessions if the store is full
+        :param session: The DiagnosisSession
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            session.last_used = now
+            self._sessions[session.id] = session
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, session_id):
+        """
+        :param session_id: The id of the session
+        :return: The DiagnosisSession, or None if it does not exist or has expired
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def remove(self, session_id):
+        """
+        :param session_id: The id of the session
+        :return: True if the session existed, otherwise False
+        """
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        """
+        :return: A dictionary of the number of sessions and the created, expired and eviction counters
+        """
+        with self._lock:
+            return {'sessions': len(self._sessions), 'max_sessions': self.max_sessions, 'ttl': self.ttl,
+                    'created': self.created, 'expired': self.expired, 'evictions': self.evictions}
+
+
+# The store shared by every request in this process. Sessions are not shared between the workers of a pre-fork
+# server, so route a session's requests to one worker or run a single worker with threads.
+sessions = SessionStore(int(os.environ.get('DIAGNOSIS_SESSION_MAX', 10000)),
+                        float(os.environ.get('DIAGNOSIS_SESSION_TTL', 1800)))
+
+
+def _render_stats():
+    """
+    :return: The counters of the shared store in the Prometheus text format, for /metrics
+    """
+    stats = sessions.stats()
+    lines = []
+    for name, metric, kind in (('created', 'diagnosis_sessions_created_total', 'counter'),
+                               ('expired', 'diagnosis_sessions_expired_total', 'counter'),
+                               ('evictions', 'diagnosis_sessions_evictions_total', 'counter'),
+                               ('sessions', 'diagnosis_sessions_active', 'gauge')):
+        lines += [f'# TYPE {metric} {kind}', f'{metric} {stats[name]}']
+    return lines
+
+
+metrics.register_collector(_render_stats)
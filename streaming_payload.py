@@ -0,0 +1,233 @@
+"""
+Incremental parsing of /diagnosis/custom_diagnose request bodies. request.get_json() builds the whole likelihoods
+object as nested dictionaries before anything is checked, which takes several times the size of the table in memory
+and only rejects a malformed table once all of it has been read. Here the body is read as a stream of JSON events and
+the likelihoods of each disease are checked and packed into a row of doubles as soon as they have been read, so the
+first invalid disease, sign or value ends the request, and the memory used grows with the number of cells rather than
+with the JSON object graph.
+
+The diseases and signs are usually sent before the likelihoods, as in the documented example, and are then used to
+reject unknown names immediately. When they come later the names are checked once the body has been read.
+"""
+
+import math
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_CONTAINERS = ('start_map', 'start_array')
+# Raised by parse_custom_diagnosis for a body which is not valid JSON
+JSONError = ijson.JSONError if ijson is not None else ValueError
+
+
+def available():
+    """
+    :return: Whether the incremental parser can be used, which needs ijson from requirements.txt
+    """
+    return ijson is not None
+
+
+def _is_names(value):
+    return isinstance(value, list) and all(isinstance(name, str) for name in value)
+
+
+def _invalid_value(sign, disease):
+    return BadRequest(f"Likelihood for sign '{sign}' in disease '{disease}' is not a valid value. Please use a value "
+                      f"greater than 0 and less than 1.")
+
+
+class LikelihoodPacker:
+    """
+    Checks the likelihoods of a custom table one disease at a time as they are parsed, and packs each disease's
+    likelihoods into a row of doubles, with NaN marking the signs which have not been given
+    """
+
+    def __init__(self, diseases=None, signs=None):
+        """
+        :param diseases: The diseases of the table if they have already been parsed, otherwise None
+        :param signs: The signs of the table if they have already been parsed, otherwise None
+        """
+        self.disease_set = frozenset(diseases) if _is_names(diseases) else None
+        self.signs = signs if _is_names(signs) else None
+        # The column of each sign. Without the signs a column is added for each new sign, in the order they are seen.
+        self.columns = {sign: i for i, sign in enumerate(self.signs)} if self.signs is not None else {}
+        self.rows = {}
+
+    def add_row(self, disease, signs, values):
+        """
+        Check and store the likelihoods of one disease, in the order validate_likelihoods checks them
+        :param disease: The disease
+        :param signs: A list of the signs given for the disease
+        :param values: A list of the likelihood of each sign, with NaN for a value which is not a number
+        """
+        if self.disease_set is not None and disease not in self.disease_set:
+            raise BadRequest(f"Disease '{disease}' in \'likelihoods\' is not a valid disease.")
+        if self.signs is not None:
+            columns = [self.columns.get(sign) for sign in signs]
+            if None in columns:
+                raise BadRequest(f"Sign '{signs[columns.index(None)]}' in {disease} within \'likelihoods\' is not a "
+                                 f"valid sign. Please use a valid signs from {list(self.signs)}.")
+            if len(set(columns)) != len(self.signs):
+                given = set(signs)
+                missing = next(sign for sign in self.signs if sign not in given)
+                raise BadRequest(f"Missing '{missing}' in likelihoods for disease '{disease}'. Please provide a "
+                                 f"likelihood value for all signs.")
+        else:
+            columns = [self.columns.setdefault(sign, len(self.columns)) for sign in signs]
+
+        values = np.array(values, dtype=np.float64)
+        invalid = ~((values > 0) & (values < 1))
+        if invalid.any():
+            raise _invalid_value(signs[int(np.argmax(invalid))], disease)
+        row = np.full(len(self.columns), np.nan)
+        row[columns] = values
+        self.rows[disease] = row
+
+    def pack(self, diseases, signs):
+        """
+        Complete the checks of validate_likelihoods which could not be made while parsing and pack the table
+        :param diseases: The validated list of diseases
+        :param signs: The validated list of signs
+        :return: An n_diseases x n_signs array of the likelihoods, otherwise a BadRequest exception is raised
+        """
+        disease_set = frozenset(diseases)
+        for disease in self.rows:
+            if disease not in disease_set:
+                raise BadRequest(f"Disease '{disease}' in \'likelihoods\' is not a valid disease.")
+        if len(self.rows) != len(disease_set):
+            missing = next(disease for disease in diseases if disease not in self.rows)
+            raise BadRequest(f"Missing '{missing}' in likelihoods. Please provide a likelihood value for all "
+                             f"diseases.")
+        if not self.rows:
+            return np.empty((0, len(signs)))
+
+        table = np.full((len(self.rows), len(self.columns)), np.nan)
+        for i, row in enumerate(self.rows.values()):
+            table[i, :len(row)] = row
+        present = ~np.isnan(table)
+
+        sign_set = frozenset(signs)
+        unknown = [index for sign, index in self.columns.items() if sign not in sign_set]
+        if unknown and present[:, unknown].any():
+            row_index = int(np.argmax(present[:, unknown].any(axis=1)))
+            sign = next(sign for sign, index in self.columns.items()
+                        if sign not in sign_set and present[row_index, index])
+            raise BadRequest(f"Sign '{sign}' in {list(self.rows)[row_index]} within \'likelihoods\' is not a valid "
+                             f"sign. Please use a valid signs from {list(signs)}.")
+
+        if any(sign not in self.columns for sign in signs):
+            complete = np.zeros(len(self.rows), dtype=bool)
+        else:
+            complete = present[:, [self.columns[sign] for sign in signs]].all(axis=1)
+        if not complete.all():
+            row_index = int(np.argmin(complete))
+            row = present[row_index]
+            missing = next(sign for sign in signs if sign not in self.columns or not row[self.columns[sign]])
+            raise BadRequest(f"Missing '{missing}' in likelihoods for disease '{list(self.rows)[row_index]}'. Please "
+                             f"provide a likelihood value for all signs.")
+
+        row_order = {disease: i for i, disease in enumerate(self.rows)}
+        rows = np.array([row_order[disease] for disease in diseases], dtype=np.intp)
+        columns = np.array([self.columns[sign] for sign in signs], dtype=np.intp)
+        return np.ascontiguousarray(table[np.ix_(rows, columns)])
+
+
+class _Reader:
+    """
+    A wrapper for the request stream. ijson checks whether a stream returns bytes by reading 0 bytes from it, which
+    werkzeug's LimitedStream takes as the client disconnecting.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, size=-1):
+        return self._stream.read(size) if size else b''
+
+
+def _read_value(event, value, events):
+    """
+    Build the value which starts with an event, such as a nested object
+    :param event: The first event of the value
+    :param value: The value of that event
+    :param events: The remaining events
+    :return: The value
+    """
+    if event not in _CONTAINERS:
+        return value
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    for event, value in events:
+        builder.event(event, value)
+        if event in _CONTAINERS:
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return builder.value
+
+
+def _read_likelihoods(events, packer):
+    """
+    Check and pack the likelihoods as they are parsed
+    :param events: The events of the body, positioned at the start of the likelihoods
+    :param packer: The LikelihoodPacker
+    :return: The packer, or the value of the likelihoods if it is not an object, which fails the schema validation
+    """
+    event, value = next(events)
+    if event != 'start_map':
+        return _read_value(event, value, events)
+    for event, disease in events:
+        if event == 'end_map':
+            return packer
+        event, value = next(events)
+        if event != 'start_map':
+            _read_value(event, value, events)
+            raise BadRequest(f"Likelihoods for disease '{disease}' must be an object mapping each sign to a "
+                             f"likelihood.")
+        signs = []
+        values = []
+        for event, sign in events:
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            signs.append(sign)
+            # Anything other than a number, including true and false, is an invalid likelihood
+            if event == 'number':
+                values.append(value)
+            else:
+                _read_value(event, value, events)
+                values.append(math.nan)
+        packer.add_row(disease, signs, values)
+
+
+def parse_custom_diagnosis(stream):
+    """
+    A function used to parse the body of /diagnosis/custom_diagnose incrementally
+    :param stream: The request body, such as request.stream
+    :return: A dictionary of the request body in which the value of likelihoods, when it is an object, is a
+    LikelihoodPacker holding the checked likelihoods. Raises BadRequest for an invalid likelihood, or
+    ijson.JSONError if the body is not valid JSON.
+    """
+    events = ijson.basic_parse(_Reader(stream), use_float=True)
+    event, value = next(events)
+    if event != 'start_map':
+        return _read_value(event, value, events)
+    data = {}
+    for event, key in events:
+        if event == 'end_map':
+            break
+        if key == 'likelihoods':
+            data[key] = _read_likelihoods(events, LikelihoodPacker(data.get('diseases'), data.get('signs')))
+        else:
+            data[key] = _read_value(*next(events), events)
+    # Anything after the object is an error, as it is for json.loads
+    for _ in events:
+        pass
+    return data
@@ -0,0 +1,522 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import msgpack
+from flask import Flask, request
+from flask.views import MethodView
+from werkzeug.exceptions import HTTPException
+
+import diagnosis_helper as dh
+import metrics
+import payload_schema
+import profiling
+import session_store as ss
+import streaming_payload as sp
+from flask_app import app
+from traffic_capture import TrafficCapture, read_capture
+from worker_sync import SharedFile
+
+
+class TestDataResponses(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_matches_uncached_body(self):
+        response = self.client.get('/data/full_disease_data/goat', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Brucellosis', response.get_json()['disease_codes'])
+        self.assertTrue(response.headers['Cache-Control'].startswith('public'))
+
+    def test_compressed_variants(self):
+        identity = self.client.get('/data/valid_animals', headers={'Accept-Encoding': 'identity'})
+        compressed = self.client.get('/data/valid_animals', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.data), identity.data)
+        self.assertNotEqual(compressed.headers['ETag'], identity.headers['ETag'])
+
+    def test_not_modified(self):
+        response = self.client.get('/data/matrix/Goat')
+        self.assertTrue(response.headers['Cache-Control'].startswith('private'))
+        revalidated = self.client.get('/data/matrix/Goat', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.data, b'')
+
+    def test_seeded_example_matrix(self):
+        first = self.client.get('/data/example_matrix/Sheep?seed=42').get_json()
+        second = self.client.get('/data/example_matrix/sheep?seed=42').get_json()
+        other = self.client.get('/data/example_matrix/Sheep?seed=43').get_json()
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        matrix = self.client.get('/data/matrix/Sheep').get_json()
+        self.assertEqual({disease: set(signs) for disease, signs in first.items()},
+                         {disease: set(signs) for disease, signs in matrix.items()})
+        self.assertTrue(all(0 < value < 1 for signs in first.values() for value in signs.values()))
+
+    def test_invalid_seed(self):
+        self.assertEqual(self.client.get('/data/example_matrix/Sheep?seed=abc').status_code, 400)
+
+    def test_invalid_animal(self):
+        response = self.client.get('/data/full_sign_data/Dog')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics_endpoint(self):
+        client = app.test_client()
+        client.get('/data/full_sign_data/Goat')
+        response = client.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn('diagnosis_requests_total{endpoint="/data/full_sign_data/<string:animal>",animal="Goat",'
+                      'status="200"}', body)
+        self.assertIn('# TYPE diagnosis_stage_seconds histogram', body)
+
+
+class TestTrafficCapture(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'capture.ndjson')
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/diagnosis/echo', 'echo', lambda: request.get_json(), methods=['POST'])
+        self.app.add_url_rule('/other', 'other', lambda: 'other')
+
+    def test_captures_matching_requests(self):
+        capture = TrafficCapture(self.path)
+        self.addCleanup(capture.close)
+        capture.init_app(self.app)
+        client = self.app.test_client()
+        client.post('/diagnosis/echo?verbose=1', json={'signs': {'Anae': 1}})
+        client.get('/other')
+
+        records = list(read_capture(self.path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['path'], '/diagnosis/echo?verbose=1')
+        self.assertEqual(json.loads(records[0]['body']), {'signs': {'Anae': 1}})
+        self.assertEqual(records[0]['status'], 200)
+
+    def test_captures_bodies_parsed_while_read(self):
+        class Partial(MethodView):
+            streams_body = True
+
+            def post(self):
+                # Stop part way through, as a body rejected by the incremental parser is
+                return {'read': request.stream.read(5).decode()}
+
+        self.app.add_url_rule('/diagnosis/partial', view_func=Partial.as_view('partial'))
+        capture = TrafficCapture(self.path)
+        self.addCleanup(capture.close)
+        capture.init_app(self.app)
+        response = self.app.test_client().post('/diagnosis/partial', json={'signs': {'Anae': 1}})
+        self.assertEqual(response.json, {'read': '{"sig'})
+
+        records = list(read_capture(self.path))
+        self.assertEqual(json.loads(records[0]['body']), {'signs': {'Anae': 1}})
+        self.assertNotIn('body_omitted', records[0])
+
+    def test_sampling_rate(self):
+        capture = TrafficCapture(self.path, rate=0)
+        self.addCleanup(capture.close)
+        capture.init_app(self.app)
+        self.app.test_client().post('/diagnosis/echo', json={})
+        self.assertEqual(list(read_capture(self.path)), [])
+
+
+class TestRankedDiagnosis(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        signs = dh.get_signs('Cattle')
+        self.payload = {'animal': 'Cattle', 'signs': dict.fromkeys(signs, 0)}
+        self.payload['signs'][signs[0]] = 1
+
+    def test_top_k(self):
+        full = self.client.post('/diagnosis/diagnose/', json=self.payload).json
+        response = self.client.post('/diagnosis/diagnose/', json=dict(self.payload, top_k=3)).json
+        expected = sorted(full['results'].items(), key=lambda item: -item[1])[:3]
+        self.assertEqual([(r['disease'], r['probability']) for r in response['results']], expected)
+        self.assertEqual(response['wiki_ids'], {disease: full['wiki_ids'][disease] for disease, _ in expected
+                                                if disease in full['wiki_ids']})
+
+    def test_min_probability(self):
+        response = self.client.post('/diagnosis/diagnose/', json=dict(self.payload, min_probability=10)).json
+        self.assertTrue(response['results'])
+        self.assertTrue(all(result['probability'] >= 10 for result in response['results']))
+
+    def test_invalid_top_k(self):
+        response = self.client.post('/diagnosis/diagnose/', json=dict(self.payload, top_k=0))
+        self.assertEqual(response.status_code, 400)
+
+    def test_custom_diagnose(self):
+        payload = {'diseases': ['Rabies', 'Cold'], 'signs': ['Fever'], 'shown_signs': {'Fever': 1},
+                   'likelihoods': {'Rabies': {'Fever': 0.6}, 'Cold': {'Fever': 0.9}}, 'top_k': 1}
+        results = self.client.post('/diagnosis/custom_diagnose', json=payload).json['results']
+        self.assertEqual([result['disease'] for result in results], ['Cold'])
+        self.assertAlmostEqual(results[0]['probability'], 60)
+
+    def test_custom_diagnose_without_diseases(self):
+        payload = {'diseases': [], 'signs': ['Fever'], 'shown_signs': {'Fever': 1}, 'likelihoods': {}}
+        response = self.client.post('/diagnosis/custom_diagnose', json=payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'results': {}})
+
+
+class TestDiagnoseBatch(unittest.TestCase):
+    def test_invalid_priors_fail_their_case_only(self):
+        signs = dict.fromkeys(dh.get_signs('Goat'), 0)
+        diseases = dh.get_diseases('Goat')
+        negative = dict.fromkeys(diseases, 0)
+        negative[diseases[0]], negative[diseases[1]] = 150, -50
+        cases = [{'animal': 'Goat', 'signs': signs, 'id': 'ok'},
+                 {'animal': 'Goat', 'signs': signs, 'priors': dict.fromkeys(diseases, 'a')},
+                 {'animal': 'Goat', 'signs': signs, 'priors': negative},
+                 {'animal': 'Goat', 'signs': signs, 'priors': [1]}]
+        response = app.test_client().post('/diagnosis/diagnose_batch', json=cases)
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([line['index'] for line in lines], [0, 1, 2, 3])
+        self.assertEqual(lines[0]['id'], 'ok')
+        self.assertIn('results', lines[0])
+        self.assertEqual([line.get('status') for line in lines[1:]], [400, 400, 400])
+
+
+class TestDiagnosisSessions(unittest.TestCase):
+    def test_session_lifecycle(self):
+        client = app.test_client()
+        response = client.post('/diagnosis/sessions', json={'animal': 'Cattle', 'signs': {'Anrx': 1}})
+        self.assertEqual(response.status_code, 201)
+        url = '/diagnosis/sessions/' + response.json['session_id']
+
+        results = client.patch(url, json={'signs': {'Lymph': -1, 'Anrx': 0}}).json['results']
+        shown_signs = dict(dict.fromkeys(dh.get_signs('Cattle'), 0), Lymph=-1)
+        expected = client.post('/diagnosis/diagnose/', json={'animal': 'Cattle', 'signs': shown_signs}).json
+        for disease, result in expected['results'].items():
+            self.assertAlmostEqual(results[disease], result)
+        self.assertEqual(client.get(url).json['signs'], shown_signs)
+
+        self.assertEqual(client.patch(url, json={'signs': {'Nope': 1}}).status_code, 400)
+        self.assertEqual(client.delete(url).status_code, 204)
+        self.assertEqual(client.get(url).status_code, 404)
+
+    def test_rejected_priors_add_no_session(self):
+        client = app.test_client()
+        diseases = dh.get_diseases('Cattle')
+        negative = dict(dict.fromkeys(diseases, 0), **{diseases[0]: 150, diseases[1]: -50})
+        for priors in (dict(dict.fromkeys(diseases, 0), **{diseases[0]: 'a lot'}), negative, [100]):
+            with self.subTest(priors=priors):
+                before = ss.sessions.stats()['sessions']
+                response = client.post('/diagnosis/sessions', json={'animal': 'Cattle', 'priors': priors})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(ss.sessions.stats()['sessions'], before)
+
+
+class TestNextSign(unittest.TestCase):
+    def test_ranks_unobserved_signs(self):
+        client = app.test_client()
+        response = client.post('/diagnosis/next_sign', json={'animal': 'Cattle', 'signs': {'Anrx': 1, 'Lymph': -1}})
+        self.assertEqual(response.status_code, 200)
+        ranked = response.json['signs']
+        self.assertEqual({r['sign'] for r in ranked}, set(dh.get_signs('Cattle')) - {'Anrx', 'Lymph'})
+        gains = [r['information_gain'] for r in ranked]
+        self.assertEqual(gains, sorted(gains, reverse=True))
+
+        session_id = client.post('/diagnosis/sessions', json={'animal': 'Cattle', 'signs': {'Anrx': 1, 'Lymph': -1}}
+                                 ).json['session_id']
+        session_ranked = client.get(f'/diagnosis/sessions/{session_id}/next_sign?top_k=2').json['signs']
+        self.assertEqual(session_ranked, ranked[:2])
+
+    def test_invalid_priors(self):
+        client = app.test_client()
+        priors = dict.fromkeys(dh.get_diseases('Cattle'), 0)
+        priors[dh.get_diseases('Cattle')[0]] = 'a lot'
+        for value in (priors, [100]):
+            with self.subTest(priors=value):
+                response = client.post('/diagnosis/next_sign', json={'animal': 'Cattle', 'priors': value})
+                self.assertEqual(response.status_code, 400)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_cached_response_matches_and_priors_bypass(self):
+        client = app.test_client()
+        signs = dict.fromkeys(dh.get_signs('Sheep'), 0)
+        signs[dh.get_signs('Sheep')[1]] = -1
+        payload = {'animal': 'Sheep', 'signs': signs}
+        before = client.get('/diagnosis/result_cache/stats').json['animals'].get('Sheep', {'hits': 0, 'misses': 0})
+
+        first = client.post('/diagnosis/diagnose/', json=payload).get_data()
+        second = client.post('/diagnosis/diagnose/', json=payload).get_data()
+        self.assertEqual(first, second)
+        priors = dict.fromkeys(dh.get_diseases('Sheep'), 0)
+        priors[dh.get_diseases('Sheep')[0]] = 100
+        with_priors = client.post('/diagnosis/diagnose/', json=dict(payload, priors=priors))
+        self.assertEqual(with_priors.status_code, 200)
+
+        after = client.get('/diagnosis/result_cache/stats').json['animals']['Sheep']
+        self.assertGreaterEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['hits'] + after['misses'] - before['hits'] - before['misses'], 2)
+
+
+class TestCompactDiagnosis(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.order = self.client.get('/data/canonical_order/Cattle').json
+
+    def test_matches_diagnose(self):
+        values = [1] + [0] * (len(self.order['signs']) - 2) + [-1]
+        shown_signs = dict(zip(self.order['signs'], values))
+        expected = self.client.post('/diagnosis/diagnose/', json={'animal': 'Cattle', 'signs': shown_signs}).json
+        for signs in (values, ''.join('-0+'[value + 1] for value in values)):
+            response = self.client.post('/diagnosis/diagnose_compact', json={
+                'animal': 'Cattle', 'dataset_version': self.order['dataset_version'], 'signs': signs})
+            self.assertEqual(response.status_code, 200)
+            for disease, result in zip(self.order['diseases'], response.json['results']):
+                self.assertAlmostEqual(result, expected['results'][disease])
+
+    def test_stale_dataset_version(self):
+        response = self.client.post('/diagnosis/diagnose_compact', json={
+            'animal': 'Cattle', 'dataset_version': 'stale', 'signs': '0' * len(self.order['signs'])})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['dataset_version'], self.order['dataset_version'])
+
+
+class TestMessagePack(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.payload = {'animal': 'Cattle', 'signs': dict.fromkeys(dh.get_signs('Cattle'), 0)}
+        self.payload['signs'][dh.get_signs('Cattle')[0]] = 1
+
+    def test_json_is_default(self):
+        response = self.client.post('/diagnosis/diagnose/', json=self.payload)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertIn('Accept', response.vary)
+
+    def test_round_trip_keeps_precision(self):
+        expected = json.loads(self.client.post('/diagnosis/diagnose/', json=self.payload).get_data())
+        for _ in range(2):  # the second response comes from the result cache
+            response = self.client.post('/diagnosis/diagnose/', data=msgpack.packb(self.payload),
+                                        content_type='application/msgpack', headers={'Accept': 'application/msgpack'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/msgpack')
+            self.assertEqual(msgpack.unpackb(response.get_data()), expected)
+
+    def test_data_endpoint_variants(self):
+        headers = {'Accept': 'application/msgpack'}
+        response = self.client.get('/data/full_animal_data/Cattle', headers=headers)
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.get_data()), self.client.get('/data/full_animal_data/Cattle').json)
+        self.assertNotEqual(response.get_etag(), self.client.get('/data/full_animal_data/Cattle').get_etag())
+        revalidated = self.client.get('/data/full_animal_data/Cattle',
+                                      headers=dict(headers, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_errors_are_negotiated(self):
+        response = self.client.post('/diagnosis/diagnose/', data=b'\xc1', content_type='application/msgpack',
+                                    headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('message', msgpack.unpackb(response.get_data()))
+
+    def test_serialise_is_timed_once(self):
+        payload = dict(self.payload, top_k=2)
+        with mock.patch.object(metrics.STAGE_SECONDS, 'observe') as observe:
+            response = self.client.post('/diagnosis/diagnose/', json=payload, headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        stages = [call.args[1] for call in observe.call_args_list]
+        self.assertEqual(stages.count('serialise'), 1)
+
+
+class TestPayloadSchema(unittest.TestCase):
+    def test_errors_match_flask_restx(self):
+        from diagnosis_controller import _diagnosis_schema, diagnosis_payload_model
+        signs = dict.fromkeys(dh.get_signs('Cattle'), 0)
+        payloads = [{}, [], None, {'animal': 1, 'signs': signs}, {'animal': 'Cattle', 'signs': []},
+                    {'animal': 'Cattle', 'signs': signs, 'top_k': 0, 'min_probability': 'x'},
+                    {'animal': 'Cattle', 'signs': signs, 'top_k': 0.5, 'min_probability': 101},
+                    {'animal': 'Cattle', 'signs': signs, 'top_k': True, 'priors': None},
+                    {'animal': 'Cattle', 'signs': signs, 'top_k': 1.0, 'min_probability': 0}]
+        for payload in payloads:
+            with app.test_request_context():
+                try:
+                    diagnosis_payload_model.validate(payload)
+                    expected = {}
+                except HTTPException as e:
+                    expected = e.data['errors']
+            self.assertEqual(_diagnosis_schema.errors(payload), expected)
+
+    def test_response_matches_flask_restx(self):
+        response = app.test_client().post('/diagnosis/diagnose/', data='null', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {'errors': {'': "None is not of type 'object'"},
+                                         'message': 'Input payload validation failed'})
+
+    def test_unsupported_keywords_are_rejected(self):
+        from flask_restx import Model, fields
+        with self.assertRaises(ValueError):
+            payload_schema.CompiledSchema(Model('Pattern', {'name': fields.String(pattern='^a')}))
+
+
+class TestMatrixDelta(unittest.TestCase):
+    def test_current_version_has_no_changes(self):
+        client = app.test_client()
+        version = dh.get_dataset_version()
+        response = client.get(f'/data/matrix_delta/Cattle?since={version}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['changed'], {})
+        self.assertFalse(response.json['full'])
+        response = client.get('/data/matrix_delta/Cattle?since=unknown')
+        self.assertEqual(response.json['likelihoods'], client.get('/data/matrix/Cattle').json)
+        self.assertEqual(client.get('/data/matrix_delta/Unicorn').status_code, 404)
+
+
+class TestMicroBatching(unittest.TestCase):
+    def test_batched_diagnosis_matches(self):
+        import micro_batch as mb
+        payload = {'animal': 'Goat', 'signs': dict.fromkeys(dh.get_signs('Goat'), 0),
+                   'priors': dict.fromkeys(dh.get_diseases('Goat'), 0), 'top_k': 3}
+        payload['priors'][dh.get_diseases('Goat')[1]] = 100
+        client = app.test_client()
+        expected = client.post('/diagnosis/diagnose/', json=payload).json
+        with mock.patch.object(mb, 'batcher', mb.MicroBatcher(0.001, 8)):
+            response = client.post('/diagnosis/diagnose/', json=payload)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, expected)
+
+
+class TestOffload(unittest.TestCase):
+    def setUp(self):
+        import offload
+        self.offload = offload
+        pool = offload.OffloadPool(min_cells=1, workers=1, max_pending=1, timeout=30)
+        self.addCleanup(pool.shutdown)
+        patch = mock.patch.object(offload, 'pool', pool)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.payload = {'diseases': ['Rabies', 'Cold'], 'signs': ['Fever', 'Cough'],
+                        'shown_signs': {'Fever': 1, 'Cough': 0},
+                        'likelihoods': {'Rabies': {'Fever': 0.6, 'Cough': 0.1}, 'Cold': {'Fever': 0.9, 'Cough': 0.9}}}
+
+    def test_large_matrix_is_offloaded(self):
+        client = app.test_client()
+        response = client.post('/diagnosis/custom_diagnose', json=dict(self.payload, top_k=1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['results'][0]['disease'], 'Cold')
+        with mock.patch.object(self.offload.pool, 'min_cells', 0):
+            inline = client.post('/diagnosis/custom_diagnose', json=self.payload).json
+        self.assertEqual(client.post('/diagnosis/custom_diagnose', json=self.payload).json, inline)
+
+    def test_streamed_table_is_packed_before_offloading(self):
+        client = app.test_client()
+        with mock.patch.object(sp, 'parse_custom_diagnosis', wraps=sp.parse_custom_diagnosis) as parse, \
+                mock.patch.object(self.offload.pool, 'packed_diagnosis',
+                                  wraps=self.offload.pool.packed_diagnosis) as packed:
+            response = client.post('/diagnosis/custom_diagnose', json=self.payload)
+            invalid = json.loads(json.dumps(self.payload))
+            invalid['likelihoods']['Cold']['Cough'] = 'a'
+            rejected = client.post('/diagnosis/custom_diagnose', json=invalid)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((parse.call_count, packed.call_count), (2, 1))
+        self.assertEqual(rejected.status_code, 400)
+        self.assertIn("Likelihood for sign 'Cough' in disease 'Cold'", rejected.json['message'])
+
+    def test_saturated_pool_returns_503(self):
+        with mock.patch.object(self.offload.pool, 'packed_diagnosis', side_effect=self.offload.PoolSaturated):
+            response = app.test_client().post('/diagnosis/custom_diagnose', json=self.payload)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+
+class TestStreamedCustomDiagnosis(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        self.payload = {'diseases': ['Rabies', 'Cold'], 'signs': ['Fever', 'Cough'],
+                        'shown_signs': {'Fever': 1, 'Cough': -1},
+                        'likelihoods': {'Rabies': {'Fever': 0.6, 'Cough': 0.1}, 'Cold': {'Fever': 0.9, 'Cough': 0.9}}}
+
+    def post_both(self, body, **kwargs):
+        streamed = self.client.post('/diagnosis/custom_diagnose', data=body, **kwargs)
+        with mock.patch.object(sp, 'ijson', None):
+            parsed = self.client.post('/diagnosis/custom_diagnose', data=body, **kwargs)
+        return streamed, parsed
+
+    def test_matches_get_json(self):
+        invalid = json.loads(json.dumps(self.payload))
+        invalid['likelihoods']['Cold']['Cough'] = 1
+        missing = dict(self.payload, likelihoods={'Rabies': self.payload['likelihoods']['Rabies']})
+        for payload in (self.payload, invalid, missing, dict(self.payload, likelihoods=[]), dict(self.payload, top_k=0),
+                        {'signs': ['Fever']}):
+            with self.subTest(payload=payload):
+                streamed, parsed = self.post_both(json.dumps(payload), content_type='application/json')
+                self.assertEqual(streamed.status_code, parsed.status_code)
+                self.assertEqual(streamed.json, parsed.json)
+
+    def test_packed_matrix_is_cached(self):
+        import matrix_cache as mc
+        with mock.patch.object(mc, 'custom_matrices', mc.MatrixCache(4, 1 << 20)):
+            first = self.client.post('/diagnosis/custom_diagnose', json=self.payload).json
+            self.assertEqual(self.client.post('/diagnosis/custom_diagnose', json=self.payload).json, first)
+            self.assertEqual(mc.custom_matrices.stats()['hits'], 1)
+
+    def test_invalid_json(self):
+        streamed, parsed = self.post_both('{"diseases": [', content_type='application/json')
+        self.assertEqual(streamed.status_code, 400)
+        self.assertEqual(parsed.status_code, 400)
+
+
+class TestReadiness(unittest.TestCase):
+    def test_ready_once_warmed(self):
+        response = app.test_client().get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['dataset_version'], dh.get_dataset_version())
+
+    def test_not_ready_while_loading(self):
+        with mock.patch.object(dh, '_ready', False):
+            response = app.test_client().get('/ready')
+        self.assertEqual(response.status_code, 503)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        saved = vars(profiling.settings).copy()
+        self.addCleanup(vars(profiling.settings).update, saved)
+        vars(profiling.settings).update(enabled=True, sample_rate=0, directory=self.directory, max_files=2,
+                                        token='secret')
+        self.client = app.test_client()
+        self.payload = {'animal': 'Goat', 'signs': dict.fromkeys(dh.get_signs('Goat'), 0)}
+
+    def test_profiles_requests_with_token(self):
+        for _ in range(3):
+            response = self.client.post('/diagnosis/diagnose/', json=self.payload, headers={'X-Profile': 'secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(os.path.exists(os.path.join(self.directory, response.headers['X-Profile-File'])))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_skips_requests_without_token(self):
+        response = self.client.post('/diagnosis/diagnose/', json=self.payload, headers={'X-Profile': 'wrong'})
+        self.assertNotIn('X-Profile-File', response.headers)
+        self.assertFalse(os.path.exists(self.directory) and os.listdir(self.directory))
+
+    def test_disabled(self):
+        profiling.settings.enabled = False
+        response = self.client.post('/diagnosis/diagnose/', json=self.payload, headers={'X-Profile': 'secret'})
+        self.assertNotIn('X-Profile-File', response.headers)
+
+    def test_settings_shared_with_other_workers(self):
+        # Another worker's view of the same profile directory
+        other = SharedFile(os.path.join(self.directory, 'settings.json'), 0)
+        with mock.patch.object(profiling, '_shared', SharedFile(other.path, 0)):
+            profiling.configure(enabled=False, sample_rate=0.5)
+            self.assertTrue(profiling.publish())
+            self.assertEqual(other.poll(), {'enabled': False, 'sample_rate': 0.5, 'max_files': 2})
+            other.write({'enabled': True, 'sample_rate': 0, 'max_files': 3})
+            response = self.client.post('/diagnosis/diagnose/', json=self.payload, headers={'X-Profile': 'secret'})
+        self.assertIn('X-Profile-File', response.headers)
+        self.assertEqual(profiling.settings.max_files, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
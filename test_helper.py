@@ -1,7 +1,19 @@
+import collections
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
 from werkzeug.exceptions import BadRequest
 
-from diagnosis_helper import validate_priors, validate_likelihoods, calculate_results, normalise, validate_animal
+from diagnosis_helper import validate_priors, validate_likelihoods, calculate_results, normalise, validate_animal, \
+    LikelihoodMatrix, calculate_posteriors, get_model, rank_posteriors, validate_ranking, information_gain, \
+    parse_positional_signs
+import diagnosis_helper
+from worker_sync import SharedFile
 
 
 class TestValidatePriors(unittest.TestCase):
@@ -135,6 +147,310 @@ class TestNormalise(unittest.TestCase):
         self.assertDictEqual(normalise(results), expected_results)
 
 
+class TestCalculatePosteriors(unittest.TestCase):
+    likelihoods = {'disease1': {'sign1': 0.3, 'sign2': 0.4, 'sign3': 0.2, 'sign4': 0.1},
+                   'disease2': {'sign1': 0.1, 'sign2': 0.2, 'sign3': 0.3, 'sign4': 0.4},
+                   'disease3': {'sign1': 0.2, 'sign2': 0.3, 'sign3': 0.2, 'sign4': 0.3}}
+    diseases = ['disease1', 'disease2', 'disease3']
+    signs = ['sign1', 'sign2', 'sign3', 'sign4']
+
+    def test_numpy_engine_matches_dict_engine(self):
+        matrix = LikelihoodMatrix(self.diseases, self.signs, self.likelihoods)
+        shown_signs = {'sign1': 1, 'sign2': 1, 'sign3': -1, 'sign4': -1}
+        priors = {'disease1': 30, 'disease2': 50, 'disease3': 20}
+        expected_results = calculate_posteriors(matrix, shown_signs, priors, engine='dict')
+        results = calculate_posteriors(matrix, shown_signs, priors, engine='numpy')
+        self.assertEqual(list(results), self.diseases)
+        for disease in self.diseases:
+            self.assertAlmostEqual(results[disease], expected_results[disease], places=10)
+
+    def test_long_sign_vector_does_not_underflow(self):
+        signs = [f'sign{i}' for i in range(2000)]
+        likelihoods = {'disease1': {sign: 0.01 for sign in signs}, 'disease2': {sign: 0.02 for sign in signs}}
+        matrix = LikelihoodMatrix(['disease1', 'disease2'], signs, likelihoods)
+        shown_signs = {sign: 1 for sign in signs}
+        priors = {'disease1': 50, 'disease2': 50}
+        results = calculate_posteriors(matrix, shown_signs, priors, engine='numpy')
+        self.assertAlmostEqual(results['disease1'], 0.0)
+        self.assertAlmostEqual(results['disease2'], 100.0)
+
+    def test_invalid_shown_sign(self):
+        matrix = LikelihoodMatrix(self.diseases, self.signs, self.likelihoods)
+        with self.assertRaises(BadRequest) as cm:
+            calculate_posteriors(matrix, {'sign5': 1}, {'disease1': 30, 'disease2': 50, 'disease3': 20})
+        self.assertEqual(str(cm.exception), "400 Bad Request: Sign 'sign5' in 'shown_signs' is not a valid sign.")
+
+    def test_batch_posteriors_match_single_cases(self):
+        matrix = LikelihoodMatrix(self.diseases, self.signs, self.likelihoods)
+        cases = [{'sign1': 1, 'sign2': 0, 'sign3': -1, 'sign4': 0}, {'sign1': -1, 'sign2': -1, 'sign3': 1, 'sign4': 1}]
+        priors = {'disease1': 30, 'disease2': 50, 'disease3': 20}
+        evidence = np.vstack([matrix.evidence(case) for case in cases])
+        results = matrix.batch_posteriors(evidence, matrix.log_priors(priors))
+        for case, row in zip(cases, results):
+            np.testing.assert_allclose(row, matrix.posteriors(case, priors))
+
+
+class TestRankPosteriors(unittest.TestCase):
+    diseases = ['disease1', 'disease2', 'disease3', 'disease4', 'disease5']
+    posteriors = np.array([10.0, 30.0, 20.0, 30.0, 10.0])
+
+    def test_top_k(self):
+        self.assertEqual(rank_posteriors(self.diseases, self.posteriors, top_k=3),
+                         [('disease2', 30.0), ('disease4', 30.0), ('disease3', 20.0)])
+
+    def test_ties_at_the_cut_keep_disease_order(self):
+        self.assertEqual(rank_posteriors(self.diseases, self.posteriors, top_k=4)[-1], ('disease1', 10.0))
+
+    def test_min_probability(self):
+        self.assertEqual(rank_posteriors(self.diseases, self.posteriors, min_probability=20),
+                         [('disease2', 30.0), ('disease4', 30.0), ('disease3', 20.0)])
+        self.assertEqual(rank_posteriors(self.diseases, self.posteriors, top_k=1, min_probability=50), [])
+
+    def test_matches_full_sort(self):
+        posteriors = np.random.default_rng(0).random(500)
+        diseases = [f'disease{i}' for i in range(500)]
+        expected = sorted(zip(diseases, posteriors.tolist()), key=lambda item: -item[1])[:25]
+        self.assertEqual(rank_posteriors(diseases, posteriors, top_k=25), expected)
+
+    def test_invalid_options(self):
+        for top_k, min_probability in ((0, None), (1.5, None), (True, None), (None, -1), (None, 101), (None, '5')):
+            with self.assertRaises(BadRequest):
+                validate_ranking(top_k, min_probability)
+
+
+class TestInformationGain(unittest.TestCase):
+    @staticmethod
+    def entropy(posteriors):
+        posteriors = posteriors[posteriors > 0]
+        return -np.sum(posteriors * np.log2(posteriors))
+
+    def test_matches_expected_entropy_reduction(self):
+        model = get_model('Cattle')
+        scores = model.matrix.scores({'Anrx': 1, 'Lymph': -1}, model.default_priors)
+        posteriors = np.exp(scores - scores.max())
+        posteriors /= posteriors.sum()
+        gains = information_gain(model.matrix, scores)
+        for index in range(len(model.signs)):
+            likelihoods = model.matrix.values[:, index]
+            present = posteriors @ likelihoods
+            expected = (present * self.entropy(posteriors * likelihoods / present) +
+                        (1 - present) * self.entropy(posteriors * (1 - likelihoods) / (1 - present)))
+            self.assertAlmostEqual(gains[index], self.entropy(posteriors) - expected)
+
+    def test_uninformative_sign(self):
+        matrix = LikelihoodMatrix(['disease1', 'disease2'], ['sign1', 'sign2'],
+                                  {'disease1': {'sign1': 0.5, 'sign2': 0.9}, 'disease2': {'sign1': 0.5, 'sign2': 0.1}})
+        gains = information_gain(matrix, matrix.log_priors({'disease1': 50, 'disease2': 50}))
+        self.assertAlmostEqual(gains[0], 0)
+        self.assertGreater(gains[1], 0.5)
+
+
+class TestParsePositionalSigns(unittest.TestCase):
+    def test_string_and_list(self):
+        np.testing.assert_array_equal(parse_positional_signs('+0-', 3, 'Cattle'), [1, 0, -1])
+        np.testing.assert_array_equal(parse_positional_signs([1, 0, -1], 3, 'Cattle'), [1, 0, -1])
+
+    def test_invalid_signs(self):
+        for signs in ('+0', '+0x', '+0\u00e9', [1, 0], [1, 0, 2], [1, 0, True], {'a': 1}):
+            with self.assertRaises(BadRequest):
+                parse_positional_signs(signs, 3, 'Cattle')
+
+    def test_positional_evidence_matches_evidence(self):
+        model = get_model('Cattle')
+        values = np.zeros(len(model.signs), dtype=np.int8)
+        values[[0, 3]], values[5] = 1, -1
+        shown_signs = dict(zip(model.signs, values.tolist()))
+        np.testing.assert_array_equal(model.matrix.positional_evidence(values), model.matrix.evidence(shown_signs))
+
+
+class TestDiagnosisValidator(unittest.TestCase):
+    def setUp(self):
+        self.model = get_model('Cattle')
+        self.validator = self.model.validator
+        self.likelihoods = self.model.matrix.likelihoods
+
+    def assertSameError(self, compiled, reference, *args):
+        with self.assertRaises(BadRequest) as expected:
+            reference(*args)
+        with self.assertRaises(BadRequest) as actual:
+            compiled(args[0])
+        self.assertEqual(actual.exception.description, expected.exception.description)
+
+    def test_packs_likelihoods(self):
+        matrix = self.validator.likelihoods(self.likelihoods)
+        np.testing.assert_array_equal(matrix.values, self.model.matrix.values)
+        np.testing.assert_array_equal(matrix.log_table, self.model.matrix.log_table)
+
+    def test_rejects_nested_likelihoods(self):
+        disease, sign = self.model.diseases[1], self.model.signs[2]
+        ragged = dict(self.likelihoods, **{disease: dict(self.likelihoods[disease], **{sign: [0.5]})})
+        nested = {disease: {sign: [0.5] for sign in row} for disease, row in self.likelihoods.items()}
+        for likelihoods in (ragged, nested):
+            with self.assertRaises(BadRequest):
+                self.validator.likelihoods(likelihoods)
+
+    def test_likelihood_errors_match(self):
+        disease, sign = self.model.diseases[1], self.model.signs[2]
+        cases = [dict(self.likelihoods, Unknown={}), {disease: self.likelihoods[disease]}]
+        for change in ({'Unknown': 0.5}, {sign: 1}, {sign: 0}):
+            cases.append(dict(self.likelihoods, **{disease: dict(self.likelihoods[disease], **change)}))
+        cases.append(dict(self.likelihoods, **{disease: {sign: 0.5}}))
+        for likelihoods in cases:
+            self.assertSameError(self.validator.likelihoods, validate_likelihoods, likelihoods, self.model.diseases,
+                                 self.model.signs)
+
+    def test_prior_errors_match(self):
+        exact = dict.fromkeys(self.model.diseases, 0)
+        exact[self.model.diseases[0]] = 100
+        self.assertIs(self.validator.priors(exact), exact)
+        for priors in (dict(exact, Unknown=1), {self.model.diseases[0]: 100},
+                       dict(exact, **{self.model.diseases[1]: 1})):
+            self.assertSameError(self.validator.priors, validate_priors, priors, self.model.diseases)
+
+    def test_sign_errors_match(self):
+        signs = dict.fromkeys(self.model.signs, 0)
+        self.assertIs(self.validator.shown_signs(signs), signs)
+        for shown_signs in (dict(signs, Unknown=0), dict(signs, **{self.model.signs[0]: 2})):
+            self.assertSameError(self.validator.shown_signs, diagnosis_helper.validate_shown_signs, shown_signs,
+                                 self.model.sign_set, 'Cattle')
+
+    def test_rejects_values_of_the_wrong_type(self):
+        disease, sign = self.model.diseases[0], self.model.signs[0]
+        with self.assertRaises(BadRequest):
+            row = dict(self.likelihoods[disease], **{sign: 'x'})
+            self.validator.likelihoods(dict(self.likelihoods, **{disease: row}))
+        with self.assertRaises(BadRequest):
+            self.validator.likelihoods(dict(self.likelihoods, **{disease: []}))
+        with self.assertRaises(BadRequest):
+            self.validator.priors(dict.fromkeys(self.model.diseases, 'x'))
+
+
+class TestAnimalModel(unittest.TestCase):
+    def test_model_indexes(self):
+        model = get_model('Cattle')
+        self.assertEqual(model.disease_set, frozenset(model.diseases))
+        self.assertEqual([model.sign_index[sign] for sign in model.signs], list(range(len(model.signs))))
+        self.assertAlmostEqual(sum(model.default_priors.values()), 100)
+
+    def test_model_is_immutable(self):
+        model = get_model('Cattle')
+        with self.assertRaises(AttributeError):
+            model.diseases = ()
+
+    def test_validators_accept_model_sets(self):
+        model = get_model('Cattle')
+        priors = dict(model.default_priors)
+        self.assertEqual(validate_priors(priors, model.diseases, model.disease_set), priors)
+        del priors[model.diseases[-1]]
+        with self.assertRaises(BadRequest):
+            validate_priors(priors, model.diseases, model.disease_set)
+
+
+class TestReloadModels(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(diagnosis_helper._data_directory, 'data.json')) as f:
+            self.data = json.load(f)
+        self.path = os.path.join(directory, 'data.json')
+        self.trigger = os.path.join(directory, '.reload')
+        for patch in (mock.patch.object(diagnosis_helper, '_data_directory', directory),
+                      mock.patch.object(diagnosis_helper, '_snapshot', diagnosis_helper.current_snapshot()),
+                      mock.patch.object(diagnosis_helper, '_history', collections.OrderedDict()),
+                      mock.patch.object(diagnosis_helper, '_reload_trigger', SharedFile(self.trigger, 0))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_pinned_snapshot_survives_reload(self):
+        self.data['dataset_version'] = 'reloaded'
+        del self.data['animals']['Cattle']
+        with open(self.path, 'w') as f:
+            json.dump(self.data, f)
+
+        pinned = diagnosis_helper.pin_snapshot()
+        self.addCleanup(diagnosis_helper.unpin_snapshot)
+        diagnosis_helper.reload_models()
+        self.assertIs(diagnosis_helper.current_snapshot(), pinned)
+        self.assertEqual(validate_animal('Cattle'), 'Cattle')
+
+        diagnosis_helper.unpin_snapshot()
+        self.assertEqual(diagnosis_helper.get_dataset_version(), 'reloaded')
+        self.assertEqual(validate_animal('Cattle'), False)
+
+    def test_replaced_snapshots_are_kept(self):
+        original = diagnosis_helper.current_snapshot()
+        for version in range(diagnosis_helper.SNAPSHOT_HISTORY + 1):
+            self.data['dataset_version'] = f'reloaded-{version}'
+            with open(self.path, 'w') as f:
+                json.dump(self.data, f)
+            latest = diagnosis_helper.reload_models(force=True)
+        self.assertIs(diagnosis_helper.get_snapshot(latest.version), latest)
+        self.assertIsNotNone(diagnosis_helper.get_snapshot('reloaded-1'))
+        self.assertIsNone(diagnosis_helper.get_snapshot(original.version))
+        self.assertEqual(len(diagnosis_helper._history), diagnosis_helper.SNAPSHOT_HISTORY)
+
+    def test_reload_triggered_by_another_worker(self):
+        self.data['dataset_version'] = 'triggered'
+        with open(self.path, 'w') as f:
+            json.dump(self.data, f)
+        diagnosis_helper.check_reload_trigger()
+        self.assertNotEqual(diagnosis_helper.get_dataset_version(), 'triggered')
+
+        # The worker which handled /admin/reload writes the trigger and reloads itself, the others reload on polling
+        self.assertTrue(SharedFile(self.trigger, 0).write({'pid': 0}))
+        diagnosis_helper.check_reload_trigger()
+        self.assertEqual(diagnosis_helper.get_dataset_version(), 'triggered')
+        snapshot, notified = diagnosis_helper.trigger_reload()
+        self.assertEqual((snapshot.version, notified), ('triggered', True))
+        with mock.patch.object(diagnosis_helper, 'reload_models') as reload_models:
+            diagnosis_helper.check_reload_trigger()
+        reload_models.assert_not_called()
+
+
+class TestReloadWatcher(unittest.TestCase):
+    def test_one_watcher_per_process(self):
+        register_at_fork = mock.Mock()
+        for patch in (mock.patch.object(diagnosis_helper, '_watcher', None),
+                      mock.patch.object(diagnosis_helper, '_watcher_interval', None),
+                      mock.patch('os.register_at_fork', register_at_fork)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        watcher = diagnosis_helper.start_reload_watcher(3600)
+        self.assertIs(diagnosis_helper.start_reload_watcher(3600), watcher)
+        self.assertTrue(watcher.is_alive())
+        register_at_fork.assert_called_once()
+
+
+class TestLazyLoading(unittest.TestCase):
+    def test_models_compiled_on_first_use(self):
+        version, models = diagnosis_helper.load_models(diagnosis_helper._data_directory)
+        self.assertIn('Cattle', models)
+        self.assertEqual(models._models, {})
+        model = models['Cattle']
+        self.assertIs(models['Cattle'], model)
+        self.assertEqual(list(models._models), ['Cattle'])
+
+    def test_set_data_path(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(diagnosis_helper._data_directory, 'data.json')) as f:
+            data = json.load(f)
+        data['dataset_version'] = 'elsewhere'
+        with open(os.path.join(directory, 'data.json'), 'w') as f:
+            json.dump(data, f)
+        for patch in (mock.patch.object(diagnosis_helper, '_data_directory'),
+                      mock.patch.object(diagnosis_helper, '_data_state'),
+                      mock.patch.object(diagnosis_helper, '_snapshot'),
+                      mock.patch.object(diagnosis_helper, '_ready')):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        diagnosis_helper.set_data_path(directory)
+        self.assertIsNone(diagnosis_helper._snapshot)
+        self.assertFalse(diagnosis_helper.is_ready())
+        self.assertEqual(diagnosis_helper.get_dataset_version(), 'elsewhere')
+
+
 class TestValidateAnimal(unittest.TestCase):
     def test_valid_animal(self):
         animal = 'Cattle'
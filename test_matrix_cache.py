@@ -0,0 +1,54 @@
+import unittest
+
+from diagnosis_helper import LikelihoodMatrix
+from matrix_cache import MatrixCache, matrix_key
+
+
+def make_matrix(value):
+    return LikelihoodMatrix(['disease1', 'disease2'], ['sign1', 'sign2'],
+                            {'disease1': {'sign1': value, 'sign2': 0.5}, 'disease2': {'sign1': 0.5, 'sign2': value}})
+
+
+class TestMatrixKey(unittest.TestCase):
+    def test_key_ignores_ordering(self):
+        first = matrix_key(['disease1', 'disease2'], ['sign1', 'sign2'],
+                           {'disease1': {'sign1': 0.1, 'sign2': 0.2}, 'disease2': {'sign1': 0.3, 'sign2': 0.4}})
+        second = matrix_key(['disease2', 'disease1'], ['sign2', 'sign1'],
+                            {'disease2': {'sign2': 0.4, 'sign1': 0.3}, 'disease1': {'sign2': 0.2, 'sign1': 0.1}})
+        self.assertEqual(first, second)
+
+    def test_key_depends_on_values(self):
+        self.assertNotEqual(matrix_key(['d'], ['s'], {'d': {'s': 0.1}}), matrix_key(['d'], ['s'], {'d': {'s': 0.2}}))
+
+
+class TestMatrixCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = MatrixCache(max_entries=2, max_bytes=1024 * 1024)
+        matrix = make_matrix(0.1)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', matrix)
+        self.assertIs(cache.get('a'), matrix)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = MatrixCache(max_entries=2, max_bytes=1024 * 1024)
+        cache.put('a', make_matrix(0.1))
+        cache.put('b', make_matrix(0.2))
+        cache.get('a')
+        cache.put('c', make_matrix(0.3))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_memory_cap(self):
+        matrix = make_matrix(0.1)
+        cache = MatrixCache(max_entries=10, max_bytes=matrix.nbytes)
+        self.assertTrue(cache.put('a', matrix))
+        cache.put('b', make_matrix(0.2))
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertFalse(MatrixCache(max_entries=10, max_bytes=matrix.nbytes - 1).put('a', matrix))
+
+
+if __name__ == '__main__':
+    unittest.main()
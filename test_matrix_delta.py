@@ -0,0 +1,71 @@
+import collections
+import unittest
+from unittest import mock
+
+import diagnosis_helper as dh
+import matrix_delta as md
+from diagnosis_helper import LikelihoodMatrix
+
+
+def make_matrix(likelihoods):
+    diseases = list(likelihoods)
+    return LikelihoodMatrix(diseases, list(likelihoods[diseases[0]]), likelihoods)
+
+
+class TestComputeDelta(unittest.TestCase):
+    def setUp(self):
+        self.old = make_matrix({'Rabies': {'Fever': 0.5, 'Cough': 0.1}, 'Cold': {'Fever': 0.9, 'Cough': 0.9}})
+
+    def test_unchanged(self):
+        delta, cells = md.compute_delta(self.old, make_matrix(self.old.likelihoods))
+        self.assertEqual(cells, 0)
+        self.assertEqual(delta, {'changed': {}, 'added_diseases': {}, 'removed_diseases': [], 'added_signs': {},
+                                 'removed_signs': []})
+
+    def test_changed_cell(self):
+        likelihoods = self.old.likelihoods
+        likelihoods['Cold']['Cough'] = 0.8
+        delta, cells = md.compute_delta(self.old, make_matrix(likelihoods))
+        self.assertEqual((delta['changed'], cells), ({'Cold': {'Cough': 0.8}}, 1))
+
+    def test_added_and_removed(self):
+        new = make_matrix({'Cold': {'Fever': 0.9, 'Rash': 0.2}, 'Flu': {'Fever': 0.7, 'Rash': 0.3}})
+        delta, cells = md.compute_delta(self.old, new)
+        self.assertEqual(delta['changed'], {})
+        self.assertEqual(delta['added_diseases'], {'Flu': {'Fever': 0.7, 'Rash': 0.3}})
+        self.assertEqual(delta['removed_diseases'], ['Rabies'])
+        self.assertEqual(delta['added_signs'], {'Rash': {'Cold': 0.2}})
+        self.assertEqual(delta['removed_signs'], ['Cough'])
+        self.assertEqual(cells, 3)
+
+
+class TestMatrixDelta(unittest.TestCase):
+    def setUp(self):
+        self.model = dh.get_model('Cattle')
+        for patch in (mock.patch.object(dh, '_snapshot', dh.current_snapshot()),
+                      mock.patch.object(dh, '_history', collections.OrderedDict())):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.old_version = dh.get_dataset_version()
+
+    def install(self, likelihoods):
+        model = dh.AnimalModel('Cattle', make_matrix(likelihoods), self.model.disease_wiki_ids,
+                               self.model.sign_names_and_codes)
+        dh.install_snapshot('updated', {'Cattle': model})
+
+    def test_small_change_is_sent_as_delta(self):
+        likelihoods = self.model.matrix.likelihoods
+        disease, sign = self.model.diseases[0], self.model.signs[0]
+        likelihoods[disease][sign] = 0.5
+        self.install(likelihoods)
+        response = md.matrix_delta('Cattle', self.old_version)
+        self.assertFalse(response['full'])
+        self.assertEqual(response['dataset_version'], 'updated')
+        self.assertEqual(response['changed'], {disease: {sign: 0.5}})
+
+    def test_large_change_or_unknown_version_is_sent_in_full(self):
+        self.install({disease: dict.fromkeys(self.model.signs, 0.5) for disease in self.model.diseases})
+        for since in (self.old_version, 'unknown', None):
+            response = md.matrix_delta('Cattle', since)
+            self.assertTrue(response['full'])
+            self.assertEqual(response['likelihoods'], dh.get_likelihood_data('Cattle'))
@@ -0,0 +1,30 @@
+import unittest
+
+from metrics import Counter, Histogram
+
+
+class TestCounter(unittest.TestCase):
+    def test_render(self):
+        counter = Counter('requests_total', 'Requests.', ('endpoint', 'status'))
+        counter.inc('/a', '200')
+        counter.inc('/a', '200')
+        counter.inc('/b"', '404')
+        self.assertEqual(counter.render(), ['# HELP requests_total Requests.', '# TYPE requests_total counter',
+                                            'requests_total{endpoint="/a",status="200"} 2',
+                                            'requests_total{endpoint="/b\\"",status="404"} 1'])
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ('stage',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'parse')
+        self.assertEqual(histogram.render()[2:], ['latency_seconds_bucket{stage="parse",le="0.1"} 2',
+                                                  'latency_seconds_bucket{stage="parse",le="1.0"} 3',
+                                                  'latency_seconds_bucket{stage="parse",le="+Inf"} 4',
+                                                  'latency_seconds_sum{stage="parse"} 2.65',
+                                                  'latency_seconds_count{stage="parse"} 4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
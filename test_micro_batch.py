@@ -0,0 +1,56 @@
+import threading
+import unittest
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+import diagnosis_helper as dh
+from micro_batch import MicroBatcher, BATCH_SIZE
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.model = dh.get_model('Cattle')
+        self.matrix = self.model.matrix
+
+    def submit_concurrently(self, batcher, cases):
+        results = [None] * len(cases)
+
+        def submit(i, evidence, log_priors):
+            try:
+                results[i] = batcher.posteriors('Cattle', self.matrix, evidence, log_priors)
+            except BadRequest as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=submit, args=(i,) + case) for i, case in enumerate(cases)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def case(self, i):
+        shown_signs = dict.fromkeys(self.model.signs, 0)
+        shown_signs[self.model.signs[i]] = 1
+        return self.matrix.evidence(shown_signs), self.model.default_log_priors, shown_signs
+
+    def test_results_match_unbatched(self):
+        cases = [self.case(i) for i in range(4)]
+        before = sum(sum(series[:-1]) for series in BATCH_SIZE._series.values())
+        # A long window, so the batch is evaluated as soon as it is full
+        results = self.submit_concurrently(MicroBatcher(5, 4), [case[:2] for case in cases])
+        for result, (_, _, shown_signs) in zip(results, cases):
+            np.testing.assert_allclose(result, self.matrix.posteriors(shown_signs, self.model.default_priors))
+        self.assertEqual(sum(sum(series[:-1]) for series in BATCH_SIZE._series.values()) - before, 1)
+
+    def test_window_closes_partial_batch(self):
+        evidence, log_priors, _ = self.case(0)
+        result = MicroBatcher(0.001, 32).posteriors('Cattle', self.matrix, evidence, log_priors)
+        self.assertAlmostEqual(float(result.sum()), 100)
+
+    def test_impossible_case_only_fails_itself(self):
+        evidence, log_priors, _ = self.case(0)
+        impossible = np.full_like(log_priors, -np.inf)
+        results = self.submit_concurrently(MicroBatcher(5, 2), [(evidence, log_priors), (evidence, impossible)])
+        self.assertAlmostEqual(float(results[0].sum()), 100)
+        self.assertIsInstance(results[1], BadRequest)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from model_bundle import BundleError, read_bundle, write_bundle
+
+DATA = {'dataset_version': 'test', 'animals': {'Dog': {
+    'diseases': ['disease1', 'disease2'],
+    'signs': ['sign1', 'sign2', 'sign3'],
+    'likelihoods': {'disease1': {'sign1': 0.3, 'sign2': 0.4, 'sign3': 0.2},
+                    'disease2': {'sign1': 0.1, 'sign2': 0.2, 'sign3': 0.3}},
+    'disease_wiki_ids': {'disease1': 'Q1'},
+    'sign_names_and_codes': {'sign1': {'name': 'Sign 1', 'code': 'Q2'}}}}}
+
+
+class TestModelBundle(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'data.bin')
+
+    def test_round_trip(self):
+        write_bundle(DATA, self.path)
+        header, arrays = read_bundle(self.path)
+        self.assertEqual(header['dataset_version'], 'test')
+        self.assertEqual(header['animals']['Dog']['signs'], ['sign1', 'sign2', 'sign3'])
+        values, log_table = arrays['Dog']
+        np.testing.assert_array_equal(values, [[0.3, 0.4, 0.2], [0.1, 0.2, 0.3]])
+        np.testing.assert_allclose(log_table, np.hstack([np.log(values), np.log1p(-values)]))
+        self.assertFalse(values.flags.writeable)
+
+    def test_float32(self):
+        write_bundle(DATA, self.path, dtype='float32')
+        _, arrays = read_bundle(self.path)
+        self.assertEqual(arrays['Dog'][0].dtype, np.float32)
+        np.testing.assert_allclose(arrays['Dog'][0], [[0.3, 0.4, 0.2], [0.1, 0.2, 0.3]], rtol=1e-6)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"animals": {}}')
+        with self.assertRaises(BundleError):
+            read_bundle(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
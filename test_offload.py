@@ -0,0 +1,66 @@
+import threading
+import unittest
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+import diagnosis_helper as dh
+import offload
+
+
+class TestOffloadPool(unittest.TestCase):
+    def setUp(self):
+        self.diseases = ['Rabies', 'Cold']
+        self.signs = ['Fever', 'Cough']
+        self.likelihoods = {'Rabies': {'Fever': 0.6, 'Cough': 0.1}, 'Cold': {'Fever': 0.9, 'Cough': 0.9}}
+        self.shown_signs = {'Fever': 1, 'Cough': -1}
+
+    def make_pool(self, **settings):
+        pool = offload.OffloadPool(**dict({'min_cells': 1, 'workers': 1, 'max_pending': 1, 'timeout': 30},
+                                          **settings))
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_should_offload(self):
+        self.assertTrue(self.make_pool(min_cells=3).should_offload(2, 2))
+        self.assertFalse(self.make_pool(min_cells=4).should_offload(2, 2))
+        self.assertFalse(self.make_pool(min_cells=0).should_offload(1000, 1000))
+
+    def test_matches_inline(self):
+        posteriors = self.make_pool().custom_diagnosis(self.diseases, self.signs, self.likelihoods, self.shown_signs,
+                                                       None)
+        matrix = dh.LikelihoodMatrix(self.diseases, self.signs, self.likelihoods)
+        np.testing.assert_array_equal(
+            posteriors, dh.calculate_posterior_vector(matrix, self.shown_signs, dh.get_default_priors(self.diseases)))
+
+    def test_packed_matches_inline(self):
+        matrix = dh.LikelihoodMatrix(self.diseases, self.signs, self.likelihoods)
+        posteriors = self.make_pool().packed_diagnosis(self.diseases, self.signs, matrix.values, self.shown_signs,
+                                                       None)
+        np.testing.assert_array_equal(
+            posteriors, dh.calculate_posterior_vector(matrix, self.shown_signs, dh.get_default_priors(self.diseases)))
+
+    def test_invalid_table_keeps_message(self):
+        self.likelihoods['Cold']['Cough'] = 1
+        with self.assertRaises(BadRequest) as raised:
+            self.make_pool().custom_diagnosis(self.diseases, self.signs, self.likelihoods, self.shown_signs, None)
+        self.assertIn("Likelihood for sign 'Cough' in disease 'Cold'", raised.exception.description)
+
+    def test_rejects_when_saturated(self):
+        pool = self.make_pool()
+        pool._slots.acquire()
+        try:
+            with self.assertRaises(offload.PoolSaturated):
+                pool.custom_diagnosis(self.diseases, self.signs, self.likelihoods, self.shown_signs, None)
+        finally:
+            pool._slots.release()
+
+    def test_slot_released_after_timeout(self):
+        pool = self.make_pool(timeout=0)
+        with self.assertRaises(offload.PoolTimeout):
+            pool.custom_diagnosis(self.diseases, self.signs, self.likelihoods, self.shown_signs, None)
+        released = threading.Event()
+        pool._executor.submit(int).add_done_callback(lambda _: released.set())
+        self.assertTrue(released.wait(30))
+        self.assertTrue(pool._slots.acquire(timeout=30))
+        pool._slots.release()
@@ -0,0 +1,63 @@
+import itertools
+import unittest
+
+from result_cache import ResultCache, pack_signs
+
+
+class TestPackSigns(unittest.TestCase):
+    def test_every_vector_has_its_own_key(self):
+        signs = ['sign1', 'sign2', 'sign3']
+        keys = {pack_signs(signs, dict(zip(signs, values))) for values in itertools.product((-1, 0, 1), repeat=3)}
+        self.assertEqual(keys, set(range(27)))
+
+    def test_ignores_dictionary_order(self):
+        signs = ['sign1', 'sign2']
+        self.assertEqual(pack_signs(signs, {'sign1': 1, 'sign2': -1}), pack_signs(signs, {'sign2': -1, 'sign1': 1}))
+
+    def test_float_values_keep_every_digit(self):
+        signs = [f'sign{i}' for i in range(40)]
+        first = dict.fromkeys(signs, 1.0)
+        second = dict(first, sign0=0.0)
+        self.assertIsInstance(pack_signs(signs, first), int)
+        self.assertNotEqual(pack_signs(signs, first), pack_signs(signs, second))
+        self.assertEqual(pack_signs(signs, first), pack_signs(signs, dict.fromkeys(signs, 1)))
+
+
+class TestResultCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ResultCache(max_entries=2)
+        self.assertIsNone(cache.get('Cattle', 'v1', 5))
+        cache.put('Cattle', 'v1', 5, 'body')
+        self.assertEqual(cache.get('Cattle', 'v1', 5), 'body')
+        self.assertIsNone(cache.get('Goat', 'v1', 5))
+        stats = cache.stats()['animals']
+        self.assertEqual((stats['Cattle']['hits'], stats['Cattle']['misses']), (1, 1))
+        self.assertEqual(stats['Cattle']['hit_ratio'], 0.5)
+
+    def test_evicts_least_recently_used_per_animal(self):
+        cache = ResultCache(max_entries=2)
+        for key in (1, 2):
+            cache.put('Cattle', 'v1', key, str(key))
+        cache.put('Goat', 'v1', 1, 'goat')
+        cache.get('Cattle', 'v1', 1)
+        cache.put('Cattle', 'v1', 3, '3')
+        self.assertIsNone(cache.get('Cattle', 'v1', 2))
+        self.assertEqual(cache.get('Cattle', 'v1', 1), '1')
+        self.assertEqual(cache.get('Goat', 'v1', 1), 'goat')
+        self.assertEqual(cache.stats()['animals']['Cattle']['evictions'], 1)
+
+    def test_new_dataset_version_drops_bodies(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('Cattle', 'v1', 1, 'old')
+        self.assertIsNone(cache.get('Cattle', 'v2', 1))
+        self.assertIsNone(cache.get('Cattle', 'v1', 1))
+        self.assertEqual(cache.stats()['animals']['Cattle']['misses'], 2)
+
+    def test_disabled(self):
+        cache = ResultCache(max_entries=0)
+        cache.put('Cattle', 'v1', 1, 'body')
+        self.assertIsNone(cache.get('Cattle', 'v1', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
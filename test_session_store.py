@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import diagnosis_helper as dh
+from session_store import DiagnosisSession, SessionStore
+
+
+class TestDiagnosisSession(unittest.TestCase):
+    def test_updates_match_full_calculation(self):
+        model = dh.get_model('Cattle')
+        session = DiagnosisSession(model, model.default_log_priors)
+        rng = np.random.default_rng(0)
+        shown_signs = dict.fromkeys(model.signs, 0)
+        for _ in range(50):
+            sign = model.signs[rng.integers(len(model.signs))]
+            shown_signs[sign] = int(rng.integers(-1, 2))
+            session.update({sign: shown_signs[sign]})
+            np.testing.assert_allclose(dh.log_normalise(session.scores),
+                                       model.matrix.posteriors(shown_signs, model.default_priors))
+        self.assertEqual(session.signs(), shown_signs)
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        model = dh.get_model('Cattle')
+        self.make_session = lambda: DiagnosisSession(model, model.default_log_priors)
+
+    def test_get_and_remove(self):
+        store = SessionStore(max_sessions=2, ttl=60)
+        session = self.make_session()
+        store.add(session)
+        self.assertIs(store.get(session.id), session)
+        self.assertTrue(store.remove(session.id))
+        self.assertIsNone(store.get(session.id))
+        self.assertFalse(store.remove(session.id))
+
+    def test_evicts_least_recently_used(self):
+        store = SessionStore(max_sessions=2, ttl=60)
+        first, second, third = self.make_session(), self.make_session(), self.make_session()
+        store.add(first)
+        store.add(second)
+        store.get(first.id)
+        store.add(third)
+        self.assertIsNone(store.get(second.id))
+        self.assertIs(store.get(first.id), first)
+        self.assertEqual(store.stats()['evictions'], 1)
+
+    def test_expires_after_ttl(self):
+        store = SessionStore(max_sessions=2, ttl=60)
+        session = self.make_session()
+        with mock.patch('session_store.time.monotonic', return_value=1000):
+            store.add(session)
+        with mock.patch('session_store.time.monotonic', return_value=1059):
+            self.assertIs(store.get(session.id), session)
+        with mock.patch('session_store.time.monotonic', return_value=1120):
+            self.assertIsNone(store.get(session.id))
+        self.assertEqual(store.stats()['expired'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import io
+import json
+import unittest
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+import diagnosis_helper as dh
+import streaming_payload as sp
+
+
+@unittest.skipUnless(sp.available(), 'ijson is not installed')
+class TestParseCustomDiagnosis(unittest.TestCase):
+    def setUp(self):
+        self.payload = {'diseases': ['Rabies', 'Cold'], 'signs': ['Fever', 'Cough'],
+                        'likelihoods': {'Rabies': {'Fever': 0.6, 'Cough': 0.1}, 'Cold': {'Fever': 0.9, 'Cough': 0.9}},
+                        'shown_signs': {'Fever': 1, 'Cough': -1}, 'top_k': 1}
+
+    def parse(self, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        return sp.parse_custom_diagnosis(io.BytesIO(body))
+
+    def assert_same_error(self, payload):
+        # The streamed checks report the same problem as validate_likelihoods
+        with self.assertRaises(BadRequest) as expected:
+            dh.validate_likelihoods(payload['likelihoods'], payload['diseases'], payload['signs'])
+        with self.assertRaises(BadRequest) as raised:
+            data = self.parse(payload)
+            data['likelihoods'].pack(data['diseases'], data['signs'])
+        self.assertEqual(raised.exception.description, expected.exception.description)
+
+    def test_matches_likelihood_matrix(self):
+        data = self.parse(self.payload)
+        self.assertEqual(data['shown_signs'], self.payload['shown_signs'])
+        self.assertEqual(data['top_k'], 1)
+        values = data['likelihoods'].pack(data['diseases'], data['signs'])
+        expected = dh.LikelihoodMatrix(self.payload['diseases'], self.payload['signs'], self.payload['likelihoods'])
+        np.testing.assert_array_equal(values, expected.values)
+
+    def test_likelihoods_before_names(self):
+        payload = {'likelihoods': {'Cold': {'Cough': 0.9, 'Fever': 0.9}, 'Rabies': {'Fever': 0.6, 'Cough': 0.1}},
+                   'diseases': ['Rabies', 'Cold'], 'signs': ['Fever', 'Cough']}
+        data = self.parse(payload)
+        values = data['likelihoods'].pack(data['diseases'], data['signs'])
+        np.testing.assert_array_equal(values, [[0.6, 0.1], [0.9, 0.9]])
+
+    def test_no_diseases(self):
+        data = self.parse({'likelihoods': {}, 'diseases': [], 'signs': ['Fever', 'Cough']})
+        self.assertEqual(data['likelihoods'].pack(data['diseases'], data['signs']).shape, (0, 2))
+
+    def test_same_errors_as_validate_likelihoods(self):
+        cases = [('Rabies', 'Fever', 1), ('Cold', 'Cough', 0), ('Cold', 'Sneeze', 0.5)]
+        for disease, sign, value in cases:
+            for names_first in (True, False):
+                with self.subTest(disease=disease, sign=sign, names_first=names_first):
+                    payload = json.loads(json.dumps(self.payload))
+                    payload['likelihoods'][disease][sign] = value
+                    if not names_first:
+                        payload = dict(likelihoods=payload.pop('likelihoods'), **payload)
+                    self.assert_same_error(payload)
+
+        payload = json.loads(json.dumps(self.payload))
+        del payload['likelihoods']['Cold']['Cough']
+        self.assert_same_error(payload)
+        payload['likelihoods']['Flu'] = payload['likelihoods'].pop('Cold')
+        self.assert_same_error(payload)
+
+    def test_fails_on_first_invalid_value(self):
+        # The rest of the body is never read, so its syntax error is not reached
+        body = b'{"diseases": ["Rabies"], "signs": ["Fever"], "likelihoods": {"Rabies": {"Fever": 2}}, oops'
+        with self.assertRaises(BadRequest) as raised:
+            self.parse(body)
+        self.assertIn("Likelihood for sign 'Fever' in disease 'Rabies'", raised.exception.description)
+
+    def test_non_object_likelihoods_are_kept(self):
+        self.assertEqual(self.parse(dict(self.payload, likelihoods=[1, 2]))['likelihoods'], [1, 2])
+        self.assertEqual(self.parse([1, {'a': 2}]), [1, {'a': 2}])
+
+    def test_invalid_json(self):
+        with self.assertRaises(sp.JSONError):
+            self.parse(b'{"diseases": [')
+        with self.assertRaises(sp.JSONError):
+            self.parse(b'{} {}')
+
+
+if __name__ == '__main__':
+    unittest.main()
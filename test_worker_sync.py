@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from worker_sync import SharedFile
+
+
+class TestSharedFile(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'shared.json')
+
+    def test_other_workers_see_each_write_once(self):
+        writer, reader = SharedFile(self.path, 0), SharedFile(self.path, 0)
+        self.assertIsNone(reader.poll())
+        for value in ({'enabled': True}, {'enabled': False}):
+            self.assertTrue(writer.write(value))
+            self.assertEqual(reader.poll(), value)
+            self.assertIsNone(reader.poll())
+            # The writer has already applied its own change
+            self.assertIsNone(writer.poll())
+
+    def test_existing_file_is_not_a_change(self):
+        SharedFile(self.path, 0).write({'pid': 1})
+        self.assertIsNone(SharedFile(self.path, 0).poll())
+
+    def test_checks_at_most_once_per_interval(self):
+        reader = SharedFile(self.path, 60)
+        self.assertIsNone(reader.poll())
+        SharedFile(self.path, 0).write({'pid': 1})
+        self.assertIsNone(reader.poll())
+        with mock.patch('time.monotonic', return_value=reader._next_check):
+            self.assertEqual(reader.poll(), {'pid': 1})
+
+    def test_unwritable_directory(self):
+        with mock.patch('os.replace', side_effect=PermissionError):
+            self.assertFalse(SharedFile(self.path, 0).write({'pid': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
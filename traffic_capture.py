@@ -0,0 +1,147 @@
+"""
+An opt-in capture mode which samples real /diagnosis/* and /data/* requests to an append-only NDJSON file, so they can
+be replayed against a local server by benchmarks/replay.py.
+
+Capture is enabled by setting DIAGNOSIS_CAPTURE_FILE to the file to append to. DIAGNOSIS_CAPTURE_RATE sets the
+fraction of requests which are sampled (default 1.0) and DIAGNOSIS_CAPTURE_MAX_BODY the largest body which is
+recorded, in bytes (default 1 MiB).
+"""
+
+import base64
+import json
+import random
+import threading
+import time
+
+from flask import g, request
+
+import metrics
+
+CAPTURED_PREFIXES = ('/diagnosis/', '/data/')
+STREAMED_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+class _Tee:
+    """
+    A wrapper for the stream of a request body which is parsed while it is read, keeping a copy of what is read for
+    the capture until it is larger than the limit
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self.limit = limit
+        self.data = bytearray()
+        self.overflowed = False
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        if not self.overflowed:
+            if len(self.data) + len(chunk) > self.limit:
+                self.overflowed = True
+                self.data = bytearray()
+            else:
+                self.data += chunk
+        return chunk
+
+    def drain(self):
+        """
+        Read the rest of the body, which is left unread when a request is rejected part way through
+        :return: The whole body, or None if it is larger than the limit
+        """
+        while not self.overflowed and self.read(64 * 1024):
+            pass
+        return None if self.overflowed else bytes(self.data)
+
+
+class TrafficCapture:
+    """
+    Appends a sample of the requests handled by a Flask app to a file, one JSON object per line
+    """
+
+    def __init__(self, path, rate=1.0, max_body=1024 * 1024):
+        """
+        :param path: The file to append the captured requests to
+        :param rate: The fraction of requests to capture, between 0 and 1
+        :param max_body: Requests with a larger body than this many bytes are not captured
+        """
+        self.path = path
+        self.rate = rate
+        self.max_body = max_body
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def init_app(self, app):
+        """
+        Register the capture hooks on a Flask app
+        """
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def close(self):
+        """
+        Close the capture file
+        """
+        with self._lock:
+            self._file.close()
+
+    def _before_request(self):
+        # Decide whether to sample the request before it is handled, so unsampled requests cost one comparison
+        if request.path.startswith(CAPTURED_PREFIXES) and random.random() < self.rate:
+            g.capture_start = time.perf_counter()
+            if metrics.streams_body():
+                # The body is parsed while it is read, so it is copied as it goes rather than read again afterwards
+                g.capture_tee = request.stream = _Tee(request.stream, self.max_body)
+
+    def _after_request(self, response):
+        start = g.pop('capture_start', None)
+        tee = g.pop('capture_tee', None)
+        if start is None:
+            return response
+        if request.content_length is not None and request.content_length > self.max_body:
+            return response
+
+        record = {'ts': time.time(), 'method': request.method, 'path': request.full_path.rstrip('?'),
+                  'content_type': request.content_type, 'status': response.status_code,
+                  'duration_ms': (time.perf_counter() - start) * 1000}
+        if tee is not None:
+            # A body parsed incrementally was copied as it was read
+            body = tee.drain()
+            if body is None:
+                return response
+        elif request.mimetype in STREAMED_MIMETYPES:
+            # A streamed body, such as an NDJSON batch, is read by the response while it is sent, so it must not be
+            # read here
+            body = b''
+            record['body_omitted'] = True
+        else:
+            # The body has usually been parsed already, in which case it is cached rather than read again
+            body = request.get_data(cache=True)
+        try:
+            record['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            record['body'] = base64.b64encode(body).decode('ascii')
+            record['body_encoding'] = 'base64'
+
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+        return response
+
+
+def read_capture(path):
+    """
+    A function used to read a capture file
+    :param path: The capture file
+    :return: A generator of the captured requests, with the body decoded to bytes
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.pop('body_encoding', None) == 'base64':
+                record['body'] = base64.b64decode(record['body'])
+            else:
+                record['body'] = record.get('body', '').encode('utf-8')
+            yield record
@@ -0,0 +1,83 @@
+"""
+Changes made through the admin endpoints, shared between the workers of a pre-fork server. An admin request is
+handled by whichever worker receives it, so the change is also written to a small file which every worker checks at
+the start of its requests, at most once every DIAGNOSIS_SYNC_INTERVAL seconds, and applies in its own process.
+"""
+
+import json
+import os
+import threading
+import time
+
+# The number of seconds between checks of a shared file by each worker
+SYNC_INTERVAL = float(os.environ.get('DIAGNOSIS_SYNC_INTERVAL', 1))
+
+
+class SharedFile:
+    """
+    A small JSON file which one worker writes and the others poll for changes
+    """
+
+    def __init__(self, path, interval=SYNC_INTERVAL):
+        """
+        :param path: The file, whose directory must be writable by every worker
+        :param interval: The number of seconds between checks of the file, 0 checks it on every poll
+        """
+        self.path = path
+        self.interval = interval
+        # A file written before this process started has already been applied, or is read by its own configuration
+        self._seen = self._state()
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _state(self):
+        # The file is replaced rather than rewritten, so a new inode shows a change even within the mtime resolution
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def write(self, value):
+        """
+        Replace the file with a value for the other workers, which this worker has already applied
+        :param value: A JSON serialisable value
+        :return: True if the file was written, otherwise False, such as when its directory is read-only
+        """
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temporary, 'w') as f:
+                json.dump(value, f)
+            os.replace(temporary, self.path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return False
+        with self._lock:
+            self._seen = self._state()
+        return True
+
+    def poll(self):
+        """
+        :return: The value written by another worker since the last poll, or None if there is no new value or the
+        file was not checked because the last check was less than interval seconds ago
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return None
+        with self._lock:
+            if now < self._next_check:
+                return None
+            self._next_check = now + self.interval
+            state = self._state()
+            if state is None or state == self._seen:
+                return None
+            self._seen = state
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
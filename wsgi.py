@@ -0,0 +1,10 @@
+"""
+
+The production entry point. Serve it with a WSGI server, for example "gunicorn -c gunicorn.conf.py", which imports
+this module once in the master process and forks the workers from it.
+
+"""
+
+from flask_app import app
+
+application = app